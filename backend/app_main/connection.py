@@ -1,17 +1,61 @@
 import json
-from typing import List, Dict
+import asyncio
+from typing import List, Dict, Optional, Set
+
+import orjson
 from fastapi import WebSocket
 
 
+def dumps_message(message: dict) -> str:
+    """序列化推送消息：优先 orjson（C 实现），不支持的对象按 str 输出；
+    orjson 仍无法处理时（如超出 64 位的整数）回退到标准库 json。"""
+    try:
+        return orjson.dumps(message, default=str, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    except TypeError:
+        return json.dumps(message, ensure_ascii=False, default=str)
+
+
+# 常量帧预先序列化，发送时直接复用（前端按文本帧解析 JSON，因此仍为 str）
+AI_RESPONSE_END_FRAME = dumps_message({"type": "ai_response_end", "content": ""})
+_PONG_FRAME_PREFIX = '{"type":"pong","timestamp":"'
+
+
+# 高频文本类消息 {"type": ..., "content": "..."} 的固定前缀，推送时只需转义正文
+_TEXT_FRAME_PREFIXES = {
+    kind: '{"type":"%s","content":' % kind
+    for kind in ("ai_response_chunk", "ai_thinking_chunk", "ai_response_start", "ai_response_end")
+}
+
+
+def text_frame(kind: str, content: str) -> str:
+    """拼接文本类消息帧（与 dumps_message 输出一致），正文由 orjson 编码为 JSON 字符串字面量"""
+    return _TEXT_FRAME_PREFIXES[kind] + orjson.dumps(content).decode("utf-8") + "}"
+
+
+def pong_frame(timestamp: str) -> str:
+    """拼接 pong 帧（时间戳为 ISO 格式，无需转义），避免逐次走序列化器"""
+    return _PONG_FRAME_PREFIX + timestamp + '"}'
+
+
 class ConnectionManager:
     """WebSocket连接管理器（从 main.py 抽离）"""
 
-    def __init__(self):
+    def __init__(self, max_connections: Optional[int] = None):
         self.active_connections: List[WebSocket] = []
         self.connection_sessions: Dict[WebSocket, str] = {}
+        self.max_connections = max_connections
+        # 即发即弃的发送任务（持有引用，避免任务在完成前被回收）
+        self._pending_sends: Set[asyncio.Task] = set()
 
-    async def connect(self, websocket: WebSocket, session_id: str):
+    async def connect(self, websocket: WebSocket, session_id: str) -> Optional[str]:
+        """接受连接并登记会话；超过连接上限时以 1013 (Try Again Later) 关闭并返回 None"""
         await websocket.accept()
+        if self.max_connections is not None and len(self.active_connections) >= self.max_connections:
+            try:
+                await websocket.close(code=1013, reason="Server busy, try again later")
+            except Exception as _:
+                pass
+            return None
         self.active_connections.append(websocket)
         self.connection_sessions[websocket] = session_id
         return session_id
@@ -25,10 +69,98 @@ class ConnectionManager:
     def get_session_id(self, websocket: WebSocket) -> str:
         return self.connection_sessions.get(websocket, "default")
 
+    async def send_raw(self, frame: str, websocket: WebSocket):
+        """发送已序列化好的文本帧"""
+        try:
+            await websocket.send_text(frame)
+        except Exception as _:
+            pass
+
+    def send_nowait(self, message: dict, websocket: WebSocket):
+        """即发即弃：序列化后交给后台任务发送，调用方不等待（用于 record_saved 等通知类消息）"""
+        self._schedule_send(dumps_message(message), websocket)
+
+    def broadcast_nowait(self, message: dict):
+        """向所有连接即发即弃地推送同一消息，只序列化一次"""
+        frame = dumps_message(message)
+        for websocket in list(self.active_connections):
+            self._schedule_send(frame, websocket)
+
+    def _schedule_send(self, frame: str, websocket: WebSocket):
+        task = asyncio.create_task(self.send_raw(frame, websocket))
+        self._pending_sends.add(task)
+        task.add_done_callback(self._pending_sends.discard)
+
     async def send_personal_message(self, message: dict, websocket: WebSocket):
         try:
-            await websocket.send_text(json.dumps(message, ensure_ascii=False))
+            await websocket.send_text(dumps_message(message))
         except Exception as _:
             pass
 
 
+class ChunkCoalescer:
+    """流式文本帧合并器：将逐 token 的 ai_response_chunk / ai_thinking_chunk 按时间窗（默认 20ms）
+    或累计长度（默认约 4KB）合并为一帧推送，其他类型消息到达前强制刷新，保证顺序不变。"""
+
+    COALESCE_TYPES = ("ai_response_chunk", "ai_thinking_chunk")
+
+    def __init__(self, manager: "ConnectionManager", websocket: WebSocket,
+                 interval: float = 0.02, max_chars: int = 4096):
+        self.manager = manager
+        self.websocket = websocket
+        self.interval = interval
+        self.max_chars = max_chars
+        self._type: Optional[str] = None
+        self._parts: List[str] = []
+        self._size = 0
+        self._send_lock = asyncio.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+
+    async def push(self, message: dict):
+        chunk_type = message.get("type")
+        if chunk_type in self.COALESCE_TYPES:
+            # 思考流与正文流不能合并到同一帧
+            if self._parts and chunk_type != self._type:
+                await self.flush()
+            piece = message.get("content") or ""
+            self._type = chunk_type
+            self._parts.append(piece)
+            self._size += len(piece)
+            # interval<=0 视为关闭合并，逐条推送
+            if self._size >= self.max_chars or self.interval <= 0:
+                await self.flush()
+            elif self._flusher is None:
+                self._flusher = asyncio.create_task(self._flush_loop())
+            return
+        await self.flush()
+        content = message.get("content")
+        async with self._send_lock:
+            if chunk_type in _TEXT_FRAME_PREFIXES and len(message) == 2 and isinstance(content, str):
+                await self.manager.send_raw(text_frame(chunk_type, content), self.websocket)
+            else:
+                await self.manager.send_personal_message(message, self.websocket)
+
+    async def flush(self):
+        if not self._parts:
+            return
+        frame = text_frame(self._type, "".join(self._parts))
+        self._parts = []
+        self._size = 0
+        async with self._send_lock:
+            await self.manager.send_raw(frame, self.websocket)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def aclose(self):
+        """停止定时刷新并推送剩余内容（可重复调用）"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except BaseException:
+                pass
+            self._flusher = None
+        await self.flush()
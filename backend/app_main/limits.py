@@ -0,0 +1,39 @@
+from typing import Optional
+
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+
+class BodySizeLimitMiddleware:
+    """按 Content-Length 在读取请求体之前拒绝过大的请求（413）。
+
+    纯 ASGI 实现，不包装响应流；未声明长度（分块传输）的请求照常放行，由处理函数边读边校验。
+    """
+
+    def __init__(self, app: ASGIApp, max_body_bytes: int):
+        self.app = app
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http":
+            declared = self._content_length(scope)
+            if declared is not None and declared > self.max_body_bytes:
+                limit_mb = self.max_body_bytes // (1024 * 1024)
+                response = JSONResponse(
+                    {"detail": f"Request body too large (max {limit_mb}MB)"},
+                    status_code=413,
+                    headers={"Connection": "close"},
+                )
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+    @staticmethod
+    def _content_length(scope: Scope) -> Optional[int]:
+        for name, value in scope.get("headers") or ():
+            if name == b"content-length":
+                try:
+                    return int(value)
+                except ValueError:
+                    return None
+        return None
@@ -0,0 +1,79 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+SavedCallback = Callable[[Optional[int]], Awaitable[None]]
+
+
+class ConversationSaver:
+    """后台对话保存器：流式任务结束时只入队，由单个后台任务按批（最多 max_batch 条或等待 max_wait 秒）
+    在一个事务内写入 SQLite，写入完成后通过回调通知前端（如推送 record_saved）。"""
+
+    def __init__(self, chat_db, max_batch: int = 25, max_wait: float = 0.05, maxsize: int = 1000):
+        self.chat_db = chat_db
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def submit(self, record: Dict[str, Any], on_saved: Optional[SavedCallback] = None) -> bool:
+        """提交一条待保存记录；未启动或队列已满时返回 False，由调用方自行同步保存"""
+        if self._task is None or self._task.done():
+            return False
+        try:
+            self._queue.put_nowait((record, on_saved))
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch: List[Tuple[Dict[str, Any], Optional[SavedCallback]]] = [item]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[Dict[str, Any], Optional[SavedCallback]]]):
+        try:
+            inserted_ids = await self.chat_db.save_conversations([record for record, _ in batch])
+        except Exception as e:
+            print(f"❌ 后台保存对话记录异常: {e}")
+            inserted_ids = [None] * len(batch)
+        for (_, on_saved), inserted_id in zip(batch, inserted_ids):
+            if on_saved is None:
+                continue
+            try:
+                await on_saved(inserted_id)
+            except Exception as e:
+                print(f"⚠️ 保存回调异常: {e}")
+
+    async def stop(self):
+        """写完队列中剩余记录后退出"""
+        if self._task is None:
+            return
+        try:
+            await self._queue.put(None)
+            await self._task
+        except Exception as e:
+            print(f"⚠️ 停止后台保存任务异常: {e}")
+        finally:
+            self._task = None
@@ -0,0 +1,69 @@
+from typing import Any, Dict, Optional
+
+import fastjsonschema
+
+
+# WebSocket 入站消息结构（导入时预编译为校验函数，避免在消息循环里逐字段手写判断）
+_BASE_SCHEMA = {
+    "type": "object",
+    "properties": {"type": {"type": "string"}},
+    "required": ["type"],
+}
+
+_USER_MSG_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "type": {"const": "user_msg"},
+        "content": {"type": ["string", "null"]},
+        "content_parts": {"type": ["array", "null"], "items": {"type": "object"}},
+        "attachments": {"type": ["array", "null"], "items": {"type": ["object", "null"]}},
+    },
+    "required": ["type"],
+    # 至少包含文本、图片或附件之一（允许纯图片消息）
+    "anyOf": [
+        {"properties": {"content": {"type": "string", "pattern": "\\S"}}, "required": ["content"]},
+        {
+            "properties": {
+                "content_parts": {
+                    "type": "array",
+                    "contains": {
+                        "type": "object",
+                        "properties": {"type": {"type": "string", "pattern": "^(?i:image_url)$"}},
+                        "required": ["type"],
+                    },
+                }
+            },
+            "required": ["content_parts"],
+        },
+        {"properties": {"attachments": {"type": "array", "minItems": 1}}, "required": ["attachments"]},
+    ],
+}
+
+_validate_base = fastjsonschema.compile(_BASE_SCHEMA)
+
+_VALIDATORS = {
+    "user_msg": fastjsonschema.compile(_USER_MSG_SCHEMA),
+}
+
+# 校验失败时回给前端的错误消息（与原处理分支的提示保持一致）
+_VALIDATION_ERRORS = {
+    "user_msg": {"type": "error", "content": "User input cannot be empty"},
+}
+
+_INVALID_FORMAT = {"type": "error", "content": "Invalid message format. Please send valid JSON."}
+
+
+def validate_ws_message(message: Any) -> Optional[Dict[str, Any]]:
+    """校验入站消息，通过返回 None，否则返回应推送给前端的错误消息"""
+    try:
+        _validate_base(message)
+    except fastjsonschema.JsonSchemaException:
+        return _INVALID_FORMAT
+    validator = _VALIDATORS.get(message["type"])
+    if validator is None:
+        return None
+    try:
+        validator(message)
+    except fastjsonschema.JsonSchemaException:
+        return _VALIDATION_ERRORS.get(message["type"], _INVALID_FORMAT)
+    return None
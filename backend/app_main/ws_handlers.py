@@ -1,12 +1,12 @@
 import json
+from datetime import datetime
 from typing import Dict
 
+from app_main.connection import AI_RESPONSE_END_FRAME, pong_frame
+
 
 async def handle_ping(websocket, manager):
-    await manager.send_personal_message({
-        "type": "pong",
-        "timestamp": __import__('datetime').datetime.now().isoformat()
-    }, websocket)
+    await manager.send_raw(pong_frame(datetime.now().isoformat()), websocket)
 
 
 async def handle_pause(websocket, manager, active_stream_tasks: Dict[str, object]):
@@ -17,7 +17,7 @@ async def handle_pause(websocket, manager, active_stream_tasks: Dict[str, object
             task.cancel()
     except Exception:
         pass
-    await manager.send_personal_message({"type": "ai_response_end", "content": ""}, websocket)
+    await manager.send_raw(AI_RESPONSE_END_FRAME, websocket)
 
 
 async def handle_resume_conversation(message, websocket, manager, mcp_agent):
@@ -31,12 +31,9 @@ async def handle_resume_conversation(message, websocket, manager, mcp_agent):
             }, websocket)
             return
         current_session_id = manager.get_session_id(websocket)
-        if not hasattr(mcp_agent, 'session_contexts'):
-            mcp_agent.session_contexts = {}
-        session_ctx = mcp_agent.session_contexts.get(current_session_id, {})
+        session_ctx = mcp_agent.session_contexts.setdefault(current_session_id, {})
         session_ctx["effective_session_id"] = target_session
         session_ctx["effective_conversation_id"] = int(target_conv)
-        mcp_agent.session_contexts[current_session_id] = session_ctx
         await manager.send_personal_message({
             "type": "resume_ok",
             "session_id": target_session,
@@ -6,32 +6,80 @@ SQLite数据库管理
 
 import os
 import json
+import asyncio
 import aiosqlite
+import orjson
 from typing import List, Dict, Any, Optional
-from datetime import datetime
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 from pathlib import Path
+
+
+_INSERT_RECORD_SQL = """
+    INSERT INTO chat_records (
+        session_id, conversation_id, msid, attachments, usage,
+        user_input, user_timestamp,
+        mcp_tools_called, mcp_results,
+        ai_response, ai_timestamp
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+# 每个连接打开后执行的 PRAGMA：NORMAL 同步（WAL 下仍保证崩溃安全）、临时表放内存、
+# 256MB mmap、64MB 页缓存，并在写锁冲突时等待而非立即报 database is locked
+_CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+def _dumps_json(value: Any) -> str:
+    """JSON 列序列化（orjson，保留中文原文；不支持的类型按 str 处理）"""
+    return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
 
 
 class ChatDatabase:
     """聊天记录数据库管理类"""
     
-    def __init__(self, db_path: str = "chat_history.db"):
+    def __init__(self, db_path: str = "chat_history.db", read_pool_size: int = 4):
         """初始化数据库连接
         
         Args:
             db_path: 数据库文件路径，默认为当前目录下的chat_history.db
+            read_pool_size: 只读连接池大小
         """
         # 确保使用绝对路径
         if not os.path.isabs(db_path):
             db_path = Path(__file__).parent / db_path
         
         self.db_path = str(db_path)
+        # 长连接写入通道：对话记录的 INSERT 复用同一连接，写入经锁串行化，保证事务边界
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        # 只读连接池：最多 read_pool_size 个长连接，按需创建，PRAGMA 只在创建时应用一次
+        self.read_pool_size = max(1, read_pool_size)
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._reader_count = 0
+        # 公开分享页专用的只读连接（mode=ro + query_only），不与写入通道和读连接池争用
+        self._readonly: Optional[aiosqlite.Connection] = None
+        # 统计信息缓存：启动时全量统计一次，写入/删除时增量维护记录数，后台定期与数据库校准
+        self._stats: Optional[Dict[str, Any]] = None
+        self._stats_task: Optional[asyncio.Task] = None
         print(f"📁 数据库路径: {self.db_path}")
     
     async def initialize(self):
         """初始化数据库表结构"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._connect() as db:
+                # WAL 为库文件级持久设置，启动时设置一次并确认生效
+                cursor = await db.execute("PRAGMA journal_mode=WAL")
+                journal_mode = (await cursor.fetchone())[0]
+                if str(journal_mode).lower() != "wal":
+                    print(f"⚠️ SQLite 未能启用 WAL 模式（当前: {journal_mode}）")
+
                 # 创建聊天会话表
                 await db.execute("""
                     CREATE TABLE IF NOT EXISTS chat_sessions (
@@ -105,6 +153,16 @@ class ChatDatabase:
                     CREATE INDEX IF NOT EXISTS idx_chat_records_created 
                     ON chat_records(created_at)
                 """)
+                # 历史查询按 (session_id, conversation_id) 过滤并按 id 排序，走索引范围扫描而非排序
+                await db.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_chat_sid_cid_id
+                    ON chat_records(session_id, conversation_id, id)
+                """)
+                # 线程列表按 msid 分组统计，覆盖索引避免回表与临时排序
+                await db.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_chat_msid_threads
+                    ON chat_records(msid, session_id, conversation_id, created_at)
+                """)
 
                 await db.execute("""
                     CREATE TABLE IF NOT EXISTS chat_conversation_files (
@@ -126,15 +184,37 @@ class ChatDatabase:
                     ON chat_conversation_files(session_id, conversation_id)
                 """)
 
+                # 上传文件内容寻址索引：同一内容（hash）只落盘一次，按原始文件名记录来源
+                await db.execute("""
+                    CREATE TABLE IF NOT EXISTS uploaded_files (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        hash TEXT NOT NULL,
+                        original_name TEXT NOT NULL,
+                        url TEXT NOT NULL,
+                        size INTEGER,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                await db.execute("""
+                    CREATE UNIQUE INDEX IF NOT EXISTS idx_uploaded_files_unique
+                    ON uploaded_files(hash, original_name)
+                """)
+
                 cursor = await db.execute("SELECT COUNT(*) FROM chat_conversation_files")
                 need_backfill = (await cursor.fetchone())[0] == 0
 
                 await db.commit()
+                # 让查询规划器获得新索引的统计信息（只分析统计过期的表，开销很小）
+                await db.execute("PRAGMA optimize")
                 print("✅ 数据库表结构初始化完成")
 
             if need_backfill:
                 await self.rebuild_all_conversation_files()
                 print("🔄 已为历史记录重建会话文件索引")
+            await self._get_writer()
+            await self.refresh_stats()
+            if self._stats_task is None:
+                self._stats_task = asyncio.create_task(self._stats_refresh_loop())
             return True
 
         except Exception as e:
@@ -144,7 +224,7 @@ class ChatDatabase:
     async def start_conversation(self, session_id: str = "default") -> int:
         """开始新的对话，返回conversation_id"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._write() as db:
                 # 确保session存在
                 await db.execute("""
                     INSERT OR IGNORE INTO chat_sessions (session_id) VALUES (?)
@@ -186,37 +266,25 @@ class ChatDatabase:
             session_id: 会话ID
             conversation_id: 对话ID，如果为None则自动生成
         """
-        need_backfill = False
         inserted_id = None
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                if conversation_id is None:
-                    conversation_id = await self.start_conversation(session_id)
-                
-                # 将工具调用和结果转换为JSON
-                mcp_tools_json = json.dumps(mcp_tools_called or [], ensure_ascii=False)
-                mcp_results_json = json.dumps(mcp_results or [], ensure_ascii=False)
-                attachments_json = json.dumps(attachments or [], ensure_ascii=False)
-                usage_json = json.dumps(usage or {}, ensure_ascii=False)
-                now_str = datetime.now().isoformat()
-                
-                cursor = await db.execute("""
-                    INSERT INTO chat_records (
-                        session_id, conversation_id, msid, attachments, usage,
-                        user_input, user_timestamp,
-                        mcp_tools_called, mcp_results,
-                        ai_response, ai_timestamp
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    session_id, conversation_id, msid, attachments_json, usage_json,
-                    user_input, now_str,
-                    mcp_tools_json, mcp_results_json,
-                    ai_response, now_str
-                ))
-                
-                await db.commit()
+            if conversation_id is None:
+                conversation_id = await self.start_conversation(session_id)
+            params = self._record_params(
+                user_input, mcp_tools_called, mcp_results, ai_response,
+                session_id, conversation_id, msid, attachments, usage
+            )
+            async with self._write_lock:
+                db = await self._get_writer()
+                try:
+                    cursor = await db.execute(_INSERT_RECORD_SQL, params)
+                    await db.commit()
+                except Exception:
+                    await db.rollback()
+                    raise
                 inserted_id = cursor.lastrowid if cursor else None
-                print(f"💾 对话记录已保存 (session={session_id}, conversation={conversation_id}, id={inserted_id})")
+            self._bump_stats(1)
+            print(f"💾 对话记录已保存 (session={session_id}, conversation={conversation_id}, id={inserted_id})")
         except Exception as e:
             print(f"❌ 保存对话记录失败: {e}")
             return None
@@ -232,10 +300,80 @@ class ChatDatabase:
 
         return inserted_id
 
+    async def save_conversations(self, records: List[Dict[str, Any]]) -> List[Optional[int]]:
+        """批量保存对话记录：同一事务内 executemany 插入，返回与 records 顺序一致的记录ID列表
+
+        Args:
+            records: 每项为 save_conversation 的关键字参数字典
+        """
+        if not records:
+            return []
+        # 未指定线程的记录先分配 conversation_id
+        for record in records:
+            if record.get("conversation_id") is None:
+                record["conversation_id"] = await self.start_conversation(record.get("session_id") or "default")
+        inserted_ids: List[Optional[int]] = []
+        try:
+            rows = [self._record_params(
+                record.get("user_input") or "",
+                record.get("mcp_tools_called"),
+                record.get("mcp_results"),
+                record.get("ai_response") or "",
+                record.get("session_id") or "default",
+                record.get("conversation_id"),
+                record.get("msid"),
+                record.get("attachments"),
+                record.get("usage"),
+            ) for record in records]
+            async with self._write_lock:
+                db = await self._get_writer()
+                try:
+                    await db.executemany(_INSERT_RECORD_SQL, rows)
+                    # 同一事务内持有写锁，AUTOINCREMENT 分配的ID连续，可由最后一个ID反推整段范围
+                    cursor = await db.execute("SELECT last_insert_rowid()")
+                    last_id = (await cursor.fetchone())[0]
+                    await db.commit()
+                    inserted_ids = list(range(last_id - len(rows) + 1, last_id + 1))
+                except Exception:
+                    await db.rollback()
+                    raise
+            self._bump_stats(len(inserted_ids))
+            print(f"💾 批量保存对话记录 {len(inserted_ids)} 条 (ids={inserted_ids})")
+        except Exception as e:
+            print(f"❌ 批量保存对话记录失败: {e}")
+            return [None] * len(records)
+
+        for record in records:
+            try:
+                await self.register_conversation_files(
+                    session_id=record.get("session_id") or "default",
+                    conversation_id=record.get("conversation_id"),
+                    attachments=record.get("attachments")
+                )
+            except Exception as e:
+                print(f"⚠️ 记录会话文件失败: {e}")
+
+        return inserted_ids
+
+    @staticmethod
+    def _record_params(user_input, mcp_tools_called, mcp_results, ai_response,
+                       session_id, conversation_id, msid, attachments, usage) -> tuple:
+        """构造 chat_records 插入参数（工具调用、结果、附件、用量转换为JSON）"""
+        now_str = datetime.now().isoformat()
+        return (
+            session_id, conversation_id, msid,
+            _dumps_json(attachments or []),
+            _dumps_json(usage or {}),
+            user_input, now_str,
+            _dumps_json(mcp_tools_called or []),
+            _dumps_json(mcp_results or []),
+            ai_response, now_str
+        )
+
     async def get_threads_by_msid(self, msid: int, limit: int = 100) -> List[Dict[str, Any]]:
         """按 msid 返回线程列表（每个线程对应一组 session_id+conversation_id）。"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._read() as db:
                 cursor = await db.execute(
                     """
                     SELECT session_id, conversation_id,
@@ -250,7 +388,7 @@ class ChatDatabase:
                            COALESCE(
                                (SELECT user_input FROM chat_records cr2 
                                 WHERE cr2.session_id = cr.session_id AND cr2.conversation_id = cr.conversation_id 
-                                ORDER BY cr2.created_at ASC LIMIT 1),
+                                ORDER BY cr2.id ASC LIMIT 1),
                                ''
                            ) AS first_user_input
                     FROM chat_records cr
@@ -282,62 +420,49 @@ class ChatDatabase:
             conversation_id: 特定对话ID，如果指定则只返回该对话
         """
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                if conversation_id is not None:
-                    # 获取特定对话
-                    cursor = await db.execute("""
-                        SELECT * FROM chat_records 
-                        WHERE session_id = ? AND conversation_id = ?
-                        ORDER BY created_at ASC
-                    """, (session_id, conversation_id))
-                else:
-                    # 获取最近的对话记录
-                    cursor = await db.execute("""
-                        SELECT * FROM (
-                            SELECT * FROM chat_records 
-                            WHERE session_id = ?
-                            ORDER BY created_at DESC 
-                            LIMIT ?
-                        ) ORDER BY created_at ASC
-                    """, (session_id, limit))
-                
-                rows = await cursor.fetchall()
-                columns = [desc[0] for desc in cursor.description]
-                
-                records = []
-                for row in rows:
-                    record = dict(zip(columns, row))
-                    
-                    # 解析JSON字段
-                    try:
-                        record['mcp_tools_called'] = json.loads(record['mcp_tools_called'] or '[]')
-                        record['mcp_results'] = json.loads(record['mcp_results'] or '[]')
-                        record['attachments'] = json.loads(record.get('attachments') or '[]')
-                        record['usage'] = json.loads(record.get('usage') or '{}')
-                    except json.JSONDecodeError:
-                        record['mcp_tools_called'] = []
-                        record['mcp_results'] = []
-                        record['attachments'] = []
-                        record['usage'] = {}
-                    
-                    records.append(record)
-                
-                # 如果不是特定对话，需要反转顺序（最新的在前面）
-                if conversation_id is None:
-                    records.reverse()
-                
-                return records
-                
+            async with self._read() as db:
+                return await self._query_chat_history(db, session_id, limit, conversation_id)
         except Exception as e:
             print(f"❌ 获取聊天历史失败: {e}")
             return []
 
+    async def get_history_bundle(
+        self,
+        session_id: str = "default",
+        limit: int = 50,
+        conversation_id: int = None
+    ) -> Dict[str, Any]:
+        """在同一连接上读取历史记录与会话文件，并附带缓存的统计信息（供 /api/history 使用）"""
+        records: List[Dict[str, Any]] = []
+        conversation_files: List[Dict[str, Any]] = []
+        try:
+            async with self._read() as db:
+                records = await self._query_chat_history(db, session_id, limit, conversation_id)
+                if session_id and conversation_id is not None:
+                    try:
+                        conversation_files = await self._query_conversation_files(db, session_id, conversation_id)
+                    except Exception as e:
+                        print(f"⚠️ 获取会话文件失败: {e}")
+        except Exception as e:
+            print(f"❌ 获取聊天历史失败: {e}")
+        stats = await self.get_cached_stats()
+        return {"records": records, "conversation_files": conversation_files, "stats": stats}
+
+    async def get_shared_history(self, session_id: str, limit: int = 100) -> List[Dict[str, Any]]:
+        """分享页读取会话历史：走独立的只读连接"""
+        try:
+            db = await self._get_readonly()
+            return await self._query_chat_history(db, session_id, limit, None)
+        except Exception as e:
+            print(f"❌ 获取分享聊天记录失败: {e}")
+            return []
+
     async def register_conversation_files(self, session_id: str, conversation_id: int, attachments: List[Dict[str, Any]] = None):
         """将附件登记到会话级文件索引，便于后续上下文复用。"""
         if not attachments or not session_id or conversation_id is None:
             return
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._write() as db:
                 for item in attachments:
                     if not isinstance(item, dict):
                         continue
@@ -365,24 +490,28 @@ class ChatDatabase:
         except Exception as e:
             print(f"⚠️ register_conversation_files 异常: {e}")
 
+    async def register_upload(self, file_hash: str, original_name: str, url: str, size: int):
+        """登记上传文件（hash → 原始文件名）；同一内容同名重复上传只保留一条"""
+        try:
+            async with self._write() as db:
+                await db.execute(
+                    """
+                    INSERT OR IGNORE INTO uploaded_files (hash, original_name, url, size)
+                    VALUES (?, ?, ?, ?)
+                    """,
+                    (file_hash, original_name, url, size)
+                )
+                await db.commit()
+        except Exception as e:
+            print(f"⚠️ 登记上传文件失败: {e}")
+
     async def get_conversation_files(self, session_id: str, conversation_id: int) -> List[Dict[str, Any]]:
         """返回某个会话线程下登记的文件列表。"""
         if not session_id or conversation_id is None:
             return []
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute(
-                    """
-                    SELECT filename, url, first_seen_at
-                      FROM chat_conversation_files
-                     WHERE session_id = ? AND conversation_id = ?
-                     ORDER BY first_seen_at ASC, id ASC
-                    """,
-                    (session_id, conversation_id)
-                )
-                rows = await cursor.fetchall()
-                columns = [desc[0] for desc in cursor.description]
-                return [dict(zip(columns, row)) for row in rows]
+            async with self._read() as db:
+                return await self._query_conversation_files(db, session_id, conversation_id)
         except Exception as e:
             print(f"⚠️ 获取会话文件失败: {e}")
             return []
@@ -390,7 +519,7 @@ class ChatDatabase:
     async def rebuild_all_conversation_files(self) -> None:
         """当新表首次创建时，对历史记录进行一次补建。"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._read() as db:
                 cursor = await db.execute(
                     """
                     SELECT session_id, conversation_id
@@ -410,7 +539,7 @@ class ChatDatabase:
     async def delete_conversation_files(self, session_id: str, conversation_id: int) -> bool:
         """删除某条会话线程的文件索引。"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._write() as db:
                 await db.execute(
                     "DELETE FROM chat_conversation_files WHERE session_id = ? AND conversation_id = ?",
                     (session_id, conversation_id)
@@ -426,7 +555,7 @@ class ChatDatabase:
         if not session_id or conversation_id is None:
             return
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._write() as db:
                 await db.execute(
                     "DELETE FROM chat_conversation_files WHERE session_id = ? AND conversation_id = ?",
                     (session_id, conversation_id)
@@ -476,32 +605,59 @@ class ChatDatabase:
             print(f"⚠️ 重建会话文件索引失败: {e}")
 
     async def clear_history(self, session_id: str = "default") -> bool:
-        """清空指定会话的聊天历史"""
+        """清空指定会话的聊天历史（session_id 为空时清空全部）"""
+        if not session_id:
+            return await self._wipe_all_history()
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                if session_id:
-                    await db.execute(
-                        "DELETE FROM chat_records WHERE session_id = ?",
-                        (session_id,)
-                    )
-                    await db.execute(
-                        "DELETE FROM chat_sessions WHERE session_id = ?",
-                        (session_id,)
-                    )
-                    await db.execute(
-                        "DELETE FROM chat_conversation_files WHERE session_id = ?",
-                        (session_id,)
-                    )
-                else:
-                    await db.execute("DELETE FROM chat_records")
-                    await db.execute("DELETE FROM chat_sessions")
-                    await db.execute("DELETE FROM chat_conversation_files")
+            async with self._write() as db:
+                cursor = await db.execute(
+                    "DELETE FROM chat_records WHERE session_id = ?",
+                    (session_id,)
+                )
+                deleted = cursor.rowcount
+                await db.execute(
+                    "DELETE FROM chat_sessions WHERE session_id = ?",
+                    (session_id,)
+                )
+                await db.execute(
+                    "DELETE FROM chat_conversation_files WHERE session_id = ?",
+                    (session_id,)
+                )
                 
                 await db.commit()
-                target = session_id if session_id else "ALL"
-                print(f"🗑️ 已清空会话 {target} 的聊天历史")
+                self._bump_stats(-deleted)
+                print(f"🗑️ 已清空会话 {session_id} 的聊天历史")
                 return True
                 
+        except Exception as e:
+            print(f"❌ 清空聊天历史失败: {e}")
+            return False
+
+    async def _wipe_all_history(self) -> bool:
+        """清空全部聊天历史：在写入通道上临时关闭同步，用不带条件的 DELETE（SQLite 按整表截断处理）
+        清表后截断 WAL，避免逐页写入 WAL 与多次 fsync
+
+        WAL 模式下存在其他连接时无法切换 journal_mode，因此只调整本连接的 synchronous。
+        """
+        try:
+            async with self._write_lock:
+                db = await self._get_writer()
+                await db.execute("PRAGMA synchronous=OFF")
+                try:
+                    await db.execute("DELETE FROM chat_records")
+                    await db.execute("DELETE FROM chat_sessions")
+                    await db.execute("DELETE FROM chat_conversation_files")
+                    await db.commit()
+                except Exception:
+                    await db.rollback()
+                    raise
+                finally:
+                    await db.execute("PRAGMA synchronous=NORMAL")
+                await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            if self._stats is not None:
+                self._stats.update(total_records=0, total_sessions=0, total_conversations=0, latest_record=None)
+            print("🗑️ 已清空会话 ALL 的聊天历史")
+            return True
         except Exception as e:
             print(f"❌ 清空聊天历史失败: {e}")
             return False
@@ -509,16 +665,18 @@ class ChatDatabase:
     async def delete_conversation(self, session_id: str, conversation_id: int) -> bool:
         """删除指定会话中的某个对话线程"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute(
+            async with self._write() as db:
+                cursor = await db.execute(
                     "DELETE FROM chat_records WHERE session_id = ? AND conversation_id = ?",
                     (session_id, conversation_id),
                 )
+                deleted = cursor.rowcount
                 await db.execute(
                     "DELETE FROM chat_conversation_files WHERE session_id = ? AND conversation_id = ?",
                     (session_id, conversation_id),
                 )
                 await db.commit()
+                self._bump_stats(-deleted)
                 return True
         except Exception as e:
             print(f"❌ 删除对话线程失败: {e}")
@@ -533,12 +691,13 @@ class ChatDatabase:
             from_id_inclusive: 起始记录ID（包含）
         """
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute(
+            async with self._write() as db:
+                cursor = await db.execute(
                     "DELETE FROM chat_records WHERE session_id = ? AND conversation_id = ? AND id >= ?",
                     (session_id, conversation_id, from_id_inclusive),
                 )
                 await db.commit()
+                self._bump_stats(-cursor.rowcount)
                 print(f"🪓 已从 (session={session_id}, conversation={conversation_id}) 起始ID {from_id_inclusive} 删除后续记录")
             await self.rebuild_conversation_files(session_id, conversation_id)
             return True
@@ -549,7 +708,7 @@ class ChatDatabase:
     async def get_stats(self) -> Dict[str, Any]:
         """获取数据库统计信息"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._read() as db:
                 # 总记录数
                 cursor = await db.execute("SELECT COUNT(*) FROM chat_records")
                 total_records = (await cursor.fetchone())[0]
@@ -578,6 +737,187 @@ class ChatDatabase:
             print(f"❌ 获取统计信息失败: {e}")
             return {}
     
+    async def get_cached_stats(self) -> Dict[str, Any]:
+        """返回缓存的统计信息（不查询数据库）；尚未统计过时先全量统计一次"""
+        if self._stats is None:
+            await self.refresh_stats()
+        return dict(self._stats or {})
+
+    async def refresh_stats(self):
+        """全量重新统计并覆盖缓存（会话数/对话数等无法增量维护的字段由此校准）"""
+        stats = await self.get_stats()
+        if stats:
+            self._stats = stats
+
+    def _bump_stats(self, delta: int):
+        """写入/删除后增量维护缓存的记录数"""
+        if self._stats is None or not delta:
+            return
+        self._stats["total_records"] = max(0, (self._stats.get("total_records") or 0) + delta)
+        if delta > 0:
+            # 与 created_at 的 CURRENT_TIMESTAMP 格式一致（UTC）
+            self._stats["latest_record"] = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+    async def _stats_refresh_loop(self, interval: float = 60.0):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh_stats()
+            except Exception as e:
+                print(f"⚠️ 刷新统计信息失败: {e}")
+
+    @staticmethod
+    async def _query_chat_history(db: aiosqlite.Connection, session_id: str, limit: int,
+                                  conversation_id: Optional[int]) -> List[Dict[str, Any]]:
+        if conversation_id is not None:
+            # 获取特定对话
+            cursor = await db.execute("""
+                SELECT * FROM chat_records 
+                WHERE session_id = ? AND conversation_id = ?
+                ORDER BY id ASC
+            """, (session_id, conversation_id))
+        else:
+            # 获取最近的对话记录
+            cursor = await db.execute("""
+                SELECT * FROM (
+                    SELECT * FROM chat_records 
+                    WHERE session_id = ?
+                    ORDER BY id DESC 
+                    LIMIT ?
+                ) ORDER BY id ASC
+            """, (session_id, limit))
+        
+        rows = await cursor.fetchall()
+        columns = [desc[0] for desc in cursor.description]
+        
+        records = []
+        for row in rows:
+            record = dict(zip(columns, row))
+        
+            # 解析JSON字段（orjson.JSONDecodeError 是 json.JSONDecodeError 的子类）
+            try:
+                record['mcp_tools_called'] = orjson.loads(record['mcp_tools_called'] or '[]')
+                record['mcp_results'] = orjson.loads(record['mcp_results'] or '[]')
+                record['attachments'] = orjson.loads(record.get('attachments') or '[]')
+                record['usage'] = orjson.loads(record.get('usage') or '{}')
+            except json.JSONDecodeError:
+                record['mcp_tools_called'] = []
+                record['mcp_results'] = []
+                record['attachments'] = []
+                record['usage'] = {}
+        
+            records.append(record)
+        
+        # 如果不是特定对话，需要反转顺序（最新的在前面）
+        if conversation_id is None:
+            records.reverse()
+        
+        return records
+
+    @staticmethod
+    async def _query_conversation_files(db: aiosqlite.Connection, session_id: str,
+                                        conversation_id: int) -> List[Dict[str, Any]]:
+        cursor = await db.execute(
+            """
+            SELECT filename, url, first_seen_at
+              FROM chat_conversation_files
+             WHERE session_id = ? AND conversation_id = ?
+             ORDER BY first_seen_at ASC, id ASC
+            """,
+            (session_id, conversation_id)
+        )
+        rows = await cursor.fetchall()
+        columns = [desc[0] for desc in cursor.description]
+        return [dict(zip(columns, row)) for row in rows]
+
+    @staticmethod
+    async def _apply_pragmas(db: aiosqlite.Connection):
+        for pragma in _CONNECTION_PRAGMAS:
+            await db.execute(pragma)
+
+    @asynccontextmanager
+    async def _connect(self):
+        """打开短连接并应用统一的 PRAGMA 设置"""
+        async with aiosqlite.connect(self.db_path) as db:
+            await self._apply_pragmas(db)
+            yield db
+
+    @asynccontextmanager
+    async def _read(self):
+        """从只读连接池借用一个连接，用完归还；池满时等待其他请求归还"""
+        try:
+            db = self._readers.get_nowait()
+        except asyncio.QueueEmpty:
+            if self._reader_count < self.read_pool_size:
+                self._reader_count += 1
+                try:
+                    db = await aiosqlite.connect(self.db_path)
+                    await self._apply_pragmas(db)
+                except BaseException:
+                    self._reader_count -= 1
+                    raise
+            else:
+                db = await self._readers.get()
+        try:
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def _write(self):
+        """独占写入通道（与对话保存共用长连接与写锁，符合 SQLite 单写者模型）；异常时回滚未提交的修改"""
+        async with self._write_lock:
+            db = await self._get_writer()
+            try:
+                yield db
+            except BaseException:
+                await db.rollback()
+                raise
+
+    async def _get_readonly(self) -> aiosqlite.Connection:
+        """获取（必要时打开）只读连接"""
+        if self._readonly is None:
+            db = await aiosqlite.connect(f"{Path(self.db_path).as_uri()}?mode=ro", uri=True)
+            await self._apply_pragmas(db)
+            await db.execute("PRAGMA query_only=1")
+            self._readonly = db
+        return self._readonly
+
+    async def _get_writer(self) -> aiosqlite.Connection:
+        """获取（必要时打开）长连接写入通道"""
+        if self._writer is None:
+            db = await aiosqlite.connect(self.db_path)
+            await self._apply_pragmas(db)
+            self._writer = db
+        return self._writer
+
     async def close(self):
-        """关闭数据库连接（在aiosqlite中不需要显式关闭）"""
-        pass
+        """停止统计校准任务，关闭读连接池、只读连接与长连接写入通道"""
+        if self._stats_task is not None:
+            self._stats_task.cancel()
+            try:
+                await self._stats_task
+            except BaseException:
+                pass
+            self._stats_task = None
+        if self._writer is not None:
+            try:
+                await self._writer.close()
+            except Exception as e:
+                print(f"⚠️ 关闭数据库写连接失败: {e}")
+            finally:
+                self._writer = None
+        if self._readonly is not None:
+            try:
+                await self._readonly.close()
+            except Exception as e:
+                print(f"⚠️ 关闭数据库只读连接失败: {e}")
+            finally:
+                self._readonly = None
+        while not self._readers.empty():
+            db = self._readers.get_nowait()
+            self._reader_count -= 1
+            try:
+                await db.close()
+            except Exception as e:
+                print(f"⚠️ 关闭数据库读连接失败: {e}")
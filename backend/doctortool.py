@@ -9,9 +9,9 @@ Doctor Agent 专属工具模块 (简化版)
 
 import os
 import re
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional
 
-import pymysql
+from mcp_modules.mysql_pool import MySQLPool
 import pdfplumber
 from langchain_core.tools import StructuredTool
 from pydantic import BaseModel, Field
@@ -81,8 +81,9 @@ def create_doctor_tools(
     db_name: str,
     db_port: int,
     session_contexts: Dict[str, Dict[str, Any]],
-    current_session_id_ctx,
+    get_current_session_id: Callable[[], Optional[str]],
     agent_type: str = "DOCTOR_M",
+    db_pool: Optional[MySQLPool] = None,
 ) -> List[StructuredTool]:
     """
     创建 Doctor Agent 专属工具（简化版，只有2个工具）
@@ -90,16 +91,19 @@ def create_doctor_tools(
     Args:
         db_host/db_user/db_password/db_name/db_port: 数据库连接配置
         session_contexts: 会话上下文映射
-        current_session_id_ctx: 当前会话ID上下文变量
+        get_current_session_id: 返回当前会话ID的函数
         agent_type: Agent 类型 (DOCTOR_M 或 DOCTOR_S)
+        db_pool: 共享的 MySQL 连接池；未传入时按上述配置创建
     
     Returns:
         [show_pdfs, read_pdf] 两个工具
     """
+    if db_pool is None:
+        db_pool = MySQLPool(host=db_host, user=db_user, password=db_password, database=db_name, port=db_port)
     
     def _get_current_msid() -> Optional[int]:
         """获取当前会话的 msid"""
-        session_id = current_session_id_ctx.get()
+        session_id = get_current_session_id()
         ctx = session_contexts.get(session_id) or {}
         return ctx.get("msid")
     
@@ -118,17 +122,8 @@ def create_doctor_tools(
         if msid is None:
             return "错误: 未关联项目，无法获取 PDF 列表"
         
-        conn = pymysql.connect(
-            host=db_host,
-            user=db_user,
-            password=db_password,
-            database=db_name,
-            port=db_port,
-            charset='utf8mb4',
-            cursorclass=pymysql.cursors.DictCursor,
-        )
         try:
-            with conn:
+            with db_pool.connection() as conn:
                 with conn.cursor() as cur:
                     cur.execute("""
                         SELECT 
@@ -181,17 +176,8 @@ def create_doctor_tools(
             return "错误: 未关联项目，无法读取 PDF"
         
         # 查询 PDF 信息
-        conn = pymysql.connect(
-            host=db_host,
-            user=db_user,
-            password=db_password,
-            database=db_name,
-            port=db_port,
-            charset='utf8mb4',
-            cursorclass=pymysql.cursors.DictCursor,
-        )
         try:
-            with conn:
+            with db_pool.connection() as conn:
                 with conn.cursor() as cur:
                     cur.execute("""
                         SELECT id, name, orginname, path
@@ -6,7 +6,6 @@ MCP工具获取和管理模块
 import os
 import re
 import asyncio
-import logging
 from typing import Dict, List, Any, Optional, Set
 import aiohttp
 import httpx
@@ -15,6 +14,7 @@ from medicaltool import create_medical_tools
 from basictool import create_basic_tools
 from newtool import create_markdown_tools
 from doctortool import create_doctor_tools
+from mcp_modules.log_filter import install_mcp_log_filter, suppress_mcp_logs
 
 
 class MCPToolsManager:
@@ -33,23 +33,26 @@ class MCPToolsManager:
         # 存储配置以便后续创建 Agent 专属工具
         self._db_config: Dict[str, Any] = {}
         self._session_contexts: Dict[str, Dict[str, Any]] = {}
-        self._current_session_id_ctx = None
+        self._get_current_session_id = None
         
         # Agent 专属工具缓存
         self._agent_tools_cache: Dict[str, List[Any]] = {}
+
+        # 连接探测复用的 aiohttp 会话，需在 close() 中显式释放
+        self._probe_session: Optional[aiohttp.ClientSession] = None
         
     async def initialize_mcp_tools(self, server_configs: Dict[str, Dict[str, Any]], 
                                  db_config: Dict[str, Any], 
                                  session_contexts: Dict[str, Dict[str, Any]],
-                                 current_session_id_ctx,
+                                 get_current_session_id,
                                  llm_nontool) -> bool:
         """初始化MCP工具
         
         Args:
             server_configs: MCP服务器配置
-            db_config: 数据库配置 (包含 host, user, password, name, port)
+            db_config: 数据库配置 (包含 host, user, password, name, port，可选 pool 为共享连接池)
             session_contexts: 会话上下文
-            current_session_id_ctx: 当前会话ID上下文变量
+            get_current_session_id: 返回当前会话ID的函数（供本地工具识别会话）
             llm_nontool: 无工具的LLM实例
             
         Returns:
@@ -61,7 +64,7 @@ class MCPToolsManager:
             # 存储配置以便后续创建 Agent 专属工具
             self._db_config = db_config
             self._session_contexts = session_contexts
-            self._current_session_id_ctx = current_session_id_ctx
+            self._get_current_session_id = get_current_session_id
             
             # 允许没有外部MCP服务器，仅使用本地工具
             if not self.server_configs:
@@ -81,7 +84,7 @@ class MCPToolsManager:
                 await self._fetch_external_tools()
             
             # 注入本地工具
-            await self._inject_local_tools(db_config, session_contexts, current_session_id_ctx, llm_nontool)
+            await self._inject_local_tools(db_config, session_contexts, get_current_session_id, llm_nontool)
             
             # 注入基础工具
             await self._inject_basic_tools()
@@ -106,19 +109,29 @@ class MCPToolsManager:
             return False
     
     async def _test_server_connections(self):
-        """测试服务器连接"""
-        for server_name, server_config in self.server_configs.items():
-            try:
-                url = server_config.get('url')
-                if not url:
-                    print(f"⚠️ 服务器 {server_name} 缺少 url 配置，跳过连接测试")
-                    continue
-                print(f"🧪 测试连接到 {server_name}: {url}")
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+        """测试服务器连接（所有服务器共用一个探测会话，结束后立即释放连接）"""
+        try:
+            for server_name, server_config in self.server_configs.items():
+                try:
+                    url = server_config.get('url')
+                    if not url:
+                        print(f"⚠️ 服务器 {server_name} 缺少 url 配置，跳过连接测试")
+                        continue
+                    print(f"🧪 测试连接到 {server_name}: {url}")
+                    if self._probe_session is None or self._probe_session.closed:
+                        self._probe_session = aiohttp.ClientSession()
+                    async with self._probe_session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
                         print(f"✅ {server_name} 连接测试成功 (状态: {response.status})")
-            except Exception as test_e:
-                print(f"⚠️ {server_name} 连接测试失败: {test_e}")
+                except Exception as test_e:
+                    print(f"⚠️ {server_name} 连接测试失败: {test_e}")
+        finally:
+            await self._close_probe_session()
+
+    async def _close_probe_session(self):
+        """关闭探测会话，归还底层 TCP 连接"""
+        session, self._probe_session = self._probe_session, None
+        if session is not None and not session.closed:
+            await session.close()
     
     async def _create_mcp_client(self) -> MultiServerMCPClient:
         """创建MCP客户端"""
@@ -148,14 +161,9 @@ class MCPToolsManager:
             try:
                 print(f"─── 正在从服务器 '{server_name}' 获取工具 ───")
                 # 抑制MCP客户端的SSE解析错误日志（这些错误不影响功能）
-                mcp_logger = logging.getLogger('mcp')
-                original_level = mcp_logger.level
-                mcp_logger.setLevel(logging.CRITICAL)
-                
-                try:
+                install_mcp_log_filter()
+                with suppress_mcp_logs():
                     server_tools = await self.mcp_client.get_tools(server_name=server_name)
-                finally:
-                    mcp_logger.setLevel(original_level)
                     
                 # 对工具名做合法化与去重
                 sanitized_tools = []
@@ -183,7 +191,7 @@ class MCPToolsManager:
     
     async def _inject_local_tools(self, db_config: Dict[str, Any], 
                                 session_contexts: Dict[str, Dict[str, Any]],
-                                current_session_id_ctx,
+                                get_current_session_id,
                                 llm_nontool):
         """注入本地医疗工具"""
         try:
@@ -193,8 +201,9 @@ class MCPToolsManager:
                 db_password=db_config.get('password'),
                 db_name=db_config.get('name'),
                 db_port=db_config.get('port'),
+                db_pool=db_config.get('pool'),
                 session_contexts=session_contexts,
-                current_session_id_ctx=current_session_id_ctx,
+                get_current_session_id=get_current_session_id,
                 llm_nontool=llm_nontool,
             )
             for tool in local_tools:
@@ -347,8 +356,9 @@ class MCPToolsManager:
                 db_password=self._db_config.get('password'),
                 db_name=self._db_config.get('name'),
                 db_port=self._db_config.get('port'),
+                db_pool=self._db_config.get('pool'),
                 session_contexts=self._session_contexts,
-                current_session_id_ctx=self._current_session_id_ctx,
+                get_current_session_id=self._get_current_session_id,
                 agent_type=agent_upper,
             )
             
@@ -367,9 +377,13 @@ class MCPToolsManager:
         return (agent_id or "").upper() in self.DOCTOR_AGENT_IDS
     
     async def close(self):
-        """关闭连接"""
-        try:
-            if self.mcp_client and hasattr(self.mcp_client, 'close'):
-                await self.mcp_client.close()
-        except:
-            pass
+        """关闭连接：MCP 客户端与探测会话并行释放，单个失败不影响其他资源"""
+        pending = []
+        if self.mcp_client and hasattr(self.mcp_client, 'close'):
+            pending.append(self.mcp_client.close())
+        pending.append(self._close_probe_session())
+        results = await asyncio.gather(*pending, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"⚠️ 关闭MCP资源失败: {result}")
+        self.mcp_client = None
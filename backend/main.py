@@ -4,67 +4,104 @@ FastAPI 后端主文件
 提供WebSocket聊天接口和REST API
 """
 
+import io
 import json
+import hashlib
 import asyncio
+import logging
+import stat
 import uuid
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi import UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, FileResponse, ORJSONResponse
+from starlette.concurrency import run_in_threadpool
 import os
 from dotenv import load_dotenv, find_dotenv
+import orjson
 import uvicorn
 
 from mcp_agent import WebMCPAgent
 from database import ChatDatabase
-from app_main.connection import ConnectionManager
+from app_main.connection import ConnectionManager, ChunkCoalescer, AI_RESPONSE_END_FRAME
+from app_main.saver import ConversationSaver
+from app_main.limits import BodySizeLimitMiddleware
+from app_main.schemas import validate_ws_message
+from mcp_modules.cache import TTLCache
 from app_main.ws_handlers import handle_ping, handle_pause, handle_resume_conversation
 
+# 进程启动时即安装 uvloop 事件循环策略：覆盖不经 uvicorn.run 的启动方式（如 gunicorn 或脚本直接
+# asyncio.run），uvicorn.run 下与 loop="uvloop" 一致；不可用（如 Windows）时保持标准实现
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 # 全局变量
 mcp_agent = None
 chat_db = None  # SQLite数据库实例
+conversation_saver = None  # 后台批量保存器
 active_connections: List[WebSocket] = []
-# 当前会话的流式任务，支持暂停/取消
-active_stream_tasks: Dict[str, asyncio.Task] = {}
+
+def _cancel_evicted_task(session_id: str, task: asyncio.Task):
+    """流式任务因容量/超时被淘汰时一并取消，避免悬挂的后台任务"""
+    if not task.done():
+        task.cancel()
+
+# 当前会话的流式任务，支持暂停/取消；有界 LRU+TTL，异常断开的连接不会永久占用内存
+active_stream_tasks: TTLCache = TTLCache(maxsize=10000, ttl=3600, on_evict=_cancel_evicted_task)
+
+# 全局并发上限：同时进行的流式回答数（超出时排队）与 WebSocket 连接数（超出时拒绝）
+MAX_ACTIVE_STREAMS = max(1, int(os.getenv("MAX_ACTIVE_STREAMS", "200")))
+MAX_WS_CONNECTIONS = max(1, int(os.getenv("MAX_WS_CONNECTIONS", "1000")))
+_stream_slots = asyncio.Semaphore(MAX_ACTIVE_STREAMS)
+
+# 流式文本帧合并窗口：按时间（毫秒）或累计长度先到者推送一帧
+STREAM_COALESCE_MS = max(0.0, float(os.getenv("STREAM_COALESCE_MS", "20")))
+STREAM_COALESCE_BYTES = max(1, int(os.getenv("STREAM_COALESCE_BYTES", "4096")))
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
-    global mcp_agent, chat_db
+    global mcp_agent, chat_db, conversation_saver
     
     # 启动时初始化
-    print("🚀 启动 MCP Web 智能助手...")
+    logger.info("🚀 启动 MCP Web 智能助手...")
     
     # 初始化数据库
     chat_db = ChatDatabase()
     db_success = await chat_db.initialize()
     if not db_success:
-        print("❌ 数据库初始化失败")
+        logger.error("❌ 数据库初始化失败")
         raise Exception("数据库初始化失败")
+    conversation_saver = ConversationSaver(chat_db)
+    conversation_saver.start()
     
     # 初始化MCP智能体
     mcp_agent = WebMCPAgent()
     mcp_success = await mcp_agent.initialize()
     
     if not mcp_success:
-        print("❌ MCP智能体初始化失败")
+        logger.error("❌ MCP智能体初始化失败")
         raise Exception("MCP智能体初始化失败")
     
-    print("✅ MCP Web 智能助手启动成功")
+    logger.info("✅ MCP Web 智能助手启动成功")
     
     yield
     
     # 关闭时清理资源
     if mcp_agent:
         await mcp_agent.close()
+    if conversation_saver:
+        await conversation_saver.stop()
     if chat_db:
         await chat_db.close()
-    print("👋 MCP Web 智能助手已关闭")
+    logger.info("👋 MCP Web 智能助手已关闭")
 
 # 创建FastAPI应用
 # 预加载 .env（不覆盖系统变量）
@@ -73,14 +110,28 @@ try:
 except Exception:
     pass
 
+# 日志级别由 LOG_LEVEL 控制（默认 INFO）；热路径上的调试日志在 INFO 级别下不做格式化
+logging.basicConfig(
+    level=getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+logger = logging.getLogger(__name__)
+
 app = FastAPI(
     title="MCP Web智能助手",
     description="基于MCP的智能助手Web版",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    # REST 响应统一用 orjson 序列化（历史记录等大载荷明显快于标准库 json）
+    default_response_class=ORJSONResponse
 )
 
-# 配置CORS
+# 上传大小限制：按 Content-Length 先行拒绝（预留 multipart 边界开销），处理函数读取时再按实际字节数校验
+UPLOAD_MAX_BYTES = 20 * 1024 * 1024
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+app.add_middleware(BodySizeLimitMiddleware, max_body_bytes=UPLOAD_MAX_BYTES + 64 * 1024)
+
+# 配置CORS（最后添加、位于最外层，413 响应同样带上跨域头）
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # 生产环境应该限制具体域名
@@ -93,76 +144,337 @@ app.add_middleware(
 
 # ─────────── WebSocket 接口 ───────────
 
-manager = ConnectionManager()
+manager = ConnectionManager(max_connections=MAX_WS_CONNECTIONS)
 
-# 挂载上传文件静态目录
+# 上传文件目录
+UPLOADS_DIR = os.path.join(os.path.dirname(__file__), "uploads")
 try:
-    UPLOADS_DIR = os.path.join(os.path.dirname(__file__), "uploads")
     os.makedirs(UPLOADS_DIR, exist_ok=True)
-    app.mount("/uploads", StaticFiles(directory=UPLOADS_DIR), name="uploads")
 except Exception as _e:
-    print(f"⚠️ 挂载上传目录失败: {_e}")
+    print(f"⚠️ 创建上传目录失败: {_e}")
+_UPLOADS_ROOT = os.path.realpath(UPLOADS_DIR) + os.sep
+# 上传文件名为内容哈希/UUID，内容不会变化，允许客户端长期缓存
+_UPLOAD_CACHE_HEADERS = {"Cache-Control": "public, max-age=31536000, immutable"}
+
+@app.api_route("/uploads/{file_path:path}", methods=["GET", "HEAD"])
+async def serve_upload(file_path: str):
+    """返回上传文件：复用已取得的 stat 结果直接交给 FileResponse（服务器支持时走 sendfile 零拷贝）"""
+    full_path = os.path.realpath(os.path.join(UPLOADS_DIR, file_path))
+    # 只允许访问上传目录内的普通文件，隐藏目录（如写入中的 .tmp）不对外提供
+    if not full_path.startswith(_UPLOADS_ROOT) or any(part.startswith(".") for part in file_path.split("/")):
+        raise HTTPException(status_code=404, detail="Not Found")
+    try:
+        stat_result = os.stat(full_path)
+    except OSError:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise HTTPException(status_code=404, detail="Not Found")
+    return FileResponse(full_path, stat_result=stat_result, headers=_UPLOAD_CACHE_HEADERS)
+
+# ─────────── 流式 chunk 分派表 ───────────
+# 每个 chunk 类型对应一个处理函数，负责把内容记入 conversation_data；
+# 返回 _CHUNK_STARTED / _CHUNK_STOP 通知流式循环标记回复开始或终止
+
+_CHUNK_STARTED = object()
+_CHUNK_STOP = object()
+# 发送队列结束标记
+_OUTBOX_END = object()
+
+def _on_response_start(chunk: Dict[str, Any], conversation_data: Dict[str, Any]):
+    return _CHUNK_STARTED
+
+def _on_tool_start(chunk: Dict[str, Any], conversation_data: Dict[str, Any]):
+    conversation_data["mcp_tools_called"].append({
+        "tool_id": chunk.get("tool_id"),
+        "tool_name": chunk.get("tool_name"),
+        "tool_args": chunk.get("tool_args"),
+        "progress": chunk.get("progress")
+    })
+
+def _on_tool_end(chunk: Dict[str, Any], conversation_data: Dict[str, Any]):
+    conversation_data["mcp_results"].append({
+        "tool_id": chunk.get("tool_id"),
+        "tool_name": chunk.get("tool_name"),
+        "result": chunk.get("result"),
+        "success": True
+    })
+
+def _on_tool_error(chunk: Dict[str, Any], conversation_data: Dict[str, Any]):
+    conversation_data["mcp_results"].append({
+        "tool_id": chunk.get("tool_id"),
+        "error": chunk.get("error"),
+        "success": False
+    })
+
+def _on_text_chunk(chunk: Dict[str, Any], conversation_data: Dict[str, Any]):
+    conversation_data["ai_response_buf"].write(chunk.get("content") or "")
+
+def _on_token_usage(chunk: Dict[str, Any], conversation_data: Dict[str, Any]):
+    conversation_data["usage"] = {
+        "input_tokens": chunk.get("input_tokens"),
+        "output_tokens": chunk.get("output_tokens"),
+        "total_tokens": chunk.get("total_tokens")
+    }
+
+def _on_error(chunk: Dict[str, Any], conversation_data: Dict[str, Any]):
+    logger.error("❌ MCP处理错误: %s", chunk.get('content'))
+    return _CHUNK_STOP
+
+_CHUNK_HANDLERS = {
+    "ai_response_start": _on_response_start,
+    "tool_start": _on_tool_start,
+    "tool_end": _on_tool_end,
+    "tool_error": _on_tool_error,
+    "ai_response_chunk": _on_text_chunk,
+    "ai_thinking_chunk": _on_text_chunk,
+    "token_usage": _on_token_usage,
+    "error": _on_error,
+}
+
+def _has_image_part(parts: List[Dict[str, Any]]) -> bool:
+    """content_parts 中是否包含图片（各项已由消息校验保证为对象；小写字面量直接命中，其余再做大小写归一）"""
+    for part in parts:
+        part_type = part.get("type")
+        if part_type == "image_url" or (isinstance(part_type, str) and part_type.lower() == "image_url"):
+            return True
+    return False
+
+def _parse_use_tools(value: Any) -> bool:
+    """解析 use_tools 开关（查询参数或消息字段），仅明确的关闭值视为关闭"""
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() not in ("0", "false", "off", "no")
+
+def _refresh_session_caps(session_ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """解析会话当前模型档位并缓存到 session_ctx["_caps"]（连接建立与切换模型时调用）"""
+    selected_pid = session_ctx.get("model")
+    if selected_pid and selected_pid in mcp_agent.llm_profiles:
+        cfg = mcp_agent.llm_profiles.get(selected_pid)
+    else:
+        cfg = mcp_agent.llm_profiles.get(mcp_agent.default_profile_id)
+    caps = {
+        "profile_id": selected_pid if selected_pid in mcp_agent.llm_profiles else mcp_agent.default_profile_id,
+        "model_name": (cfg or {}).get("model", ""),
+        "base_url": (cfg or {}).get("base_url", ""),
+    }
+    session_ctx["_caps"] = caps
+    return caps
+
+async def _no_conversation_files() -> List[Dict[str, Any]]:
+    return []
+
+async def _load_turn_context(session_id: str, conversation_id) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """并发读取本轮所需的最近历史（最近10条）与会话文件，任一失败按空列表处理"""
+    history, conversation_files = await asyncio.gather(
+        chat_db.get_chat_history(session_id=session_id, limit=10, conversation_id=conversation_id),
+        chat_db.get_conversation_files(session_id=session_id, conversation_id=conversation_id)
+        if conversation_id is not None else _no_conversation_files(),
+        return_exceptions=True
+    )
+    if isinstance(history, BaseException):
+        logger.warning("⚠️ 获取历史记录失败: %s", history)
+        history = []
+    if isinstance(conversation_files, BaseException):
+        logger.warning("⚠️ 获取会话文件失败: %s", conversation_files)
+        conversation_files = []
+    return history, conversation_files
+
+async def _run_stream(websocket: WebSocket, user_payload, user_input: str, history, conversation_files,
+                      current_session_id: str, save_session_id: str, conversation_id, attachments,
+                      msid: Optional[int] = None):
+    """消费 chat_stream 推送到前端，结束（含暂停/异常）后保存本轮对话（user_msg 与 replay_edit 共用）"""
+    # 收集对话数据
+    conversation_data = {
+        "user_input": user_input,
+        "mcp_tools_called": [],
+        "mcp_results": [],
+        "ai_response_buf": io.StringIO()
+    }
+    coalescer = ChunkCoalescer(manager, websocket, interval=STREAM_COALESCE_MS / 1000,
+                               max_chars=STREAM_COALESCE_BYTES)
+    # 生产者/消费者：LLM 流只负责入队，独立的发送任务负责推送，慢客户端不再直接阻塞模型流
+    outbox: asyncio.Queue = asyncio.Queue(maxsize=64)
+
+    async def _sender():
+        while True:
+            chunk = await outbox.get()
+            if chunk is _OUTBOX_END:
+                break
+            await coalescer.push(chunk)
+
+    async def _finish_sending():
+        # 推送完队列中剩余的消息后再收尾（可重复调用）
+        if not sender.done():
+            await outbox.put(_OUTBOX_END)
+            try:
+                await sender
+            except Exception as e:
+                logger.warning("⚠️ 推送任务异常: %s", e)
+        await coalescer.aclose()
+
+    sender = asyncio.create_task(_sender())
+    try:
+        response_started = False
+        async for response_chunk in mcp_agent.chat_stream(
+            user_payload,
+            history=history,
+            session_id=current_session_id,
+            conversation_files=conversation_files
+        ):
+            await outbox.put(response_chunk)
+            handler = _CHUNK_HANDLERS.get(response_chunk.get("type"))
+            if handler is not None:
+                flag = handler(response_chunk, conversation_data)
+                if flag is _CHUNK_STARTED:
+                    response_started = True
+                elif flag is _CHUNK_STOP:
+                    break
+    except asyncio.CancelledError:
+        # 被暂停：结束消息但不丢已生成内容
+        await _finish_sending()
+        if response_started:
+            try:
+                await manager.send_raw(AI_RESPONSE_END_FRAME, websocket)
+            except Exception:
+                pass
+        raise
+    except Exception as e:
+        logger.error("❌ MCP流式处理异常: %s", e)
+    finally:
+        await _finish_sending()
+        ai_response_final = conversation_data["ai_response_buf"].getvalue()
+        conversation_data["ai_response_buf"].close()
+        if not ai_response_final and conversation_data["mcp_results"]:
+            error_results = [r for r in conversation_data["mcp_results"] if not r.get("success", True)]
+            if error_results:
+                ai_response_final = "处理过程中遇到错误：\n" + "\n".join([r.get("error", "未知错误") for r in error_results])
+        try:
+            if chat_db:
+                record = {
+                    "user_input": conversation_data["user_input"],
+                    "mcp_tools_called": conversation_data["mcp_tools_called"],
+                    "mcp_results": conversation_data["mcp_results"],
+                    "ai_response": ai_response_final,
+                    "session_id": save_session_id,
+                    "conversation_id": conversation_id,
+                    "msid": msid,
+                    "attachments": attachments,
+                    "usage": conversation_data.get("usage")
+                }
+
+                # 将新记录ID回传给前端，便于即时挂载操作按钮（即发即弃，慢客户端不拖慢后台保存器）
+                async def _notify_saved(inserted_id):
+                    _invalidate_read_cache(save_session_id)
+                    manager.send_nowait({
+                        "type": "record_saved",
+                        "record_id": inserted_id,
+                        "session_id": save_session_id,
+                        "conversation_id": record.get("conversation_id")
+                    }, websocket)
+
+                # 交给后台保存器批量落库；不可用或队列满时同步保存
+                if not (conversation_saver and conversation_saver.submit(record, _notify_saved)):
+                    await _notify_saved(await chat_db.save_conversation(**record))
+        except Exception as e:
+            logger.error("❌ 保存对话记录异常: %s", e)
+        finally:
+            # 仅移除自身（被新一轮替换时，登记的已是新任务）
+            if active_stream_tasks.get(current_session_id) is asyncio.current_task():
+                active_stream_tasks.pop(current_session_id, None)
+            # 连接已断开：本轮结束后释放会话上下文
+            if websocket not in manager.connection_sessions:
+                mcp_agent.session_contexts.pop(current_session_id, None)
+
+async def _start_stream(websocket: WebSocket, user_payload, current_session_id: str, **stream_kwargs) -> asyncio.Task:
+    """启动本会话的流式任务：先取消同会话仍在进行的旧任务（最多等待 0.5 秒收尾），新任务在全局并发上限内运行"""
+    previous = active_stream_tasks.pop(current_session_id, None)
+    if previous is not None and not previous.done():
+        previous.cancel()
+        await asyncio.wait({previous}, timeout=0.5)
+
+    async def _bounded():
+        async with _stream_slots:
+            await _run_stream(websocket, user_payload, current_session_id=current_session_id, **stream_kwargs)
+
+    task = asyncio.create_task(_bounded())
+    active_stream_tasks[current_session_id] = task
+    return task
+
+# 前端以 JSON.stringify({type: ...}) 发送，type 总是首个字段
+_PING_PREFIX = '{"type":"ping"'
+_PAUSE_PREFIX = '{"type":"pause"'
 
 @app.websocket("/ws/chat")
 async def websocket_chat(websocket: WebSocket):
     """WebSocket聊天接口"""
     # 为每个连接生成唯一会话ID并建立连接
     session_id = str(uuid.uuid4())
-    await manager.connect(websocket, session_id)
-    print(f"📱 新连接建立，会话ID: {session_id}，当前连接数: {len(manager.active_connections)}")
+    if await manager.connect(websocket, session_id) is None:
+        logger.warning("⚠️ 连接数已达上限 (%d)，拒绝新连接", manager.max_connections)
+        return
+    logger.info("📱 新连接建立，会话ID: %s，当前连接数: %d", session_id, len(manager.active_connections))
     # 向前端发送会话ID
     await manager.send_personal_message({"type": "session_info", "session_id": session_id}, websocket)
     # 从连接查询参数中读取 msid 与 model 并保存到会话上下文（后端隐藏使用，不回传给前端）
     try:
-        print(f"🔍 WebSocket 查询参数: {dict(websocket.query_params)}")
+        logger.debug("🔍 WebSocket 查询参数: %s", websocket.query_params)
         msid_param = websocket.query_params.get("msid")
         model_param = websocket.query_params.get("model")
-        print(f"🔍 提取的 msid 参数: {msid_param}")
-        print(f"🔍 提取的 model 参数: {model_param}")
+        logger.debug("🔍 提取的 msid 参数: %s, model 参数: %s", msid_param, model_param)
         if msid_param is not None and msid_param != "":
             try:
                 msid_value = int(msid_param)
-                if not hasattr(mcp_agent, 'session_contexts'):
-                    mcp_agent.session_contexts = {}
                 mcp_agent.session_contexts[session_id] = {"msid": msid_value}
-                print(f"🔐 已为会话 {session_id} 记录 msid={msid_value}")
-                print(f"🔍 当前所有会话上下文: {mcp_agent.session_contexts}")
+                logger.debug("🔐 已为会话 %s 记录 msid=%s", session_id, msid_value)
             except Exception as e:
-                print(f"⚠️ 解析 msid 失败: {e}")
+                logger.warning("⚠️ 解析 msid 失败: %s", e)
                 # 非法 msid 忽略
-                if not hasattr(mcp_agent, 'session_contexts'):
-                    mcp_agent.session_contexts = {}
                 mcp_agent.session_contexts[session_id] = {}
         else:
-            print(f"⚠️ msid 参数为空或不存在")
-            if not hasattr(mcp_agent, 'session_contexts'):
-                mcp_agent.session_contexts = {}
+            logger.debug("⚠️ msid 参数为空或不存在")
             mcp_agent.session_contexts[session_id] = {}
 
         # 记录模型档位（如果提供）
         try:
             if model_param is not None and model_param != "":
-                if not hasattr(mcp_agent, 'session_contexts'):
-                    mcp_agent.session_contexts = {}
-                session_ctx = mcp_agent.session_contexts.get(session_id, {})
+                session_ctx = mcp_agent.session_contexts.setdefault(session_id, {})
                 session_ctx["model"] = str(model_param)
-                mcp_agent.session_contexts[session_id] = session_ctx
-                print(f"🔐 已为会话 {session_id} 记录 model={model_param}")
+                logger.debug("🔐 已为会话 %s 记录 model=%s", session_id, model_param)
         except Exception as e:
-            print(f"⚠️ 记录 model 失败: {e}")
+            logger.warning("⚠️ 记录 model 失败: %s", e)
+
+        # 是否启用工具（use_tools=0/false/off 时本会话只做纯对话，不向模型发送工具定义）
+        use_tools_param = websocket.query_params.get("use_tools")
+        if use_tools_param is not None and use_tools_param != "":
+            session_ctx = mcp_agent.session_contexts.setdefault(session_id, {})
+            session_ctx["use_tools"] = _parse_use_tools(use_tools_param)
     except Exception as _e:
-        print(f"❌ 处理 msid 参数异常: {_e}")
-        if not hasattr(mcp_agent, 'session_contexts'):
-            mcp_agent.session_contexts = {}
+        logger.error("❌ 处理 msid 参数异常: %s", _e)
         mcp_agent.session_contexts[session_id] = {}
+    # 连接建立时解析一次模型档位能力，后续每轮直接读取
+    conn_ctx = mcp_agent.session_contexts.setdefault(session_id, {})
+    _refresh_session_caps(conn_ctx)
     
     try:
         while True:
             # 接收客户端消息
             data = await websocket.receive_text()
+            # 刷新会话上下文的存活时间（长时间空闲被淘汰后按本连接的上下文恢复）
+            mcp_agent.session_contexts.setdefault(session_id, conn_ctx)
+            # 心跳与暂停帧无需参数，按前缀直接分派，不进入 JSON 解析与校验
+            if data.startswith(_PING_PREFIX):
+                await handle_ping(websocket, manager)
+                continue
+            if data.startswith(_PAUSE_PREFIX):
+                await handle_pause(websocket, manager, active_stream_tasks)
+                continue
             
             try:
-                message = json.loads(data)
+                message = orjson.loads(data)
+                validation_error = validate_ws_message(message)
+                if validation_error is not None:
+                    await manager.send_personal_message(validation_error, websocket)
+                    continue
                 
                 if message.get("type") == "user_msg":
                     # 支持两种输入：
@@ -172,29 +484,17 @@ async def websocket_chat(websocket: WebSocket):
                     content_parts = message.get("content_parts") or []
                     attachments = message.get("attachments") or []
 
-                    user_has_text = isinstance(raw_content, str) and raw_content.strip() != ""
-                    user_has_images = isinstance(content_parts, list) and any(
-                        isinstance(p, dict) and str(p.get("type") or "").lower() == "image_url" for p in content_parts
-                    )
-                    # 允许纯图片消息
-                    if not user_has_text and not user_has_images and not attachments:
-                        await manager.send_personal_message({
-                            "type": "error",
-                            "content": "User input cannot be empty"
-                        }, websocket)
-                        continue
+                    user_has_images = _has_image_part(content_parts)
                     
-                    # 打印安全预览（文本前50字符或 [images] 提示）
-                    try:
+                    # 打印安全预览（文本前50字符或 [images] 提示），仅在 DEBUG 级别计算
+                    if logger.isEnabledFor(logging.DEBUG):
                         if isinstance(raw_content, str) and raw_content.strip():
                             _preview = raw_content[:50]
-                        elif isinstance(content_parts, list) and any((isinstance(p, dict) and str(p.get('type') or '').lower() == 'image_url') for p in content_parts):
+                        elif user_has_images:
                             _preview = "[images]"
                         else:
                             _preview = ""
-                    except Exception:
-                        _preview = ""
-                    print(f"📨 收到用户消息: {_preview}...")
+                        logger.debug("📨 收到用户消息: %s...", _preview)
                     
                     # 确认收到用户消息
                     await manager.send_personal_message({
@@ -202,21 +502,11 @@ async def websocket_chat(websocket: WebSocket):
                         "content": (raw_content if isinstance(raw_content, str) else "")
                     }, websocket)
                     
-                    # 收集对话数据
-                    conversation_data = {
-                        "user_input": raw_content if raw_content is not None else "",
-                        "mcp_tools_called": [],
-                        "mcp_results": [],
-                        "ai_response_parts": []
-                    }
-                    
                     # 获取当前连接与会话上下文
                     current_session_id = manager.get_session_id(websocket)
                     # 支持续聊：若存在生效的会话与线程，则复用；否则在生效会话上新建
                     try:
-                        if not hasattr(mcp_agent, 'session_contexts'):
-                            mcp_agent.session_contexts = {}
-                        session_ctx = mcp_agent.session_contexts.get(current_session_id, {})
+                        session_ctx = mcp_agent.session_contexts.setdefault(current_session_id, {})
                         effective_session_id = session_ctx.get("effective_session_id") or current_session_id
                         conversation_id = session_ctx.get("effective_conversation_id") or session_ctx.get("conversation_id")
                         if conversation_id is None:
@@ -226,159 +516,58 @@ async def websocket_chat(websocket: WebSocket):
                             # 若此前已设置了 effective_session_id，则也将其与该对话绑定为生效线程
                             session_ctx["effective_session_id"] = effective_session_id
                             session_ctx["effective_conversation_id"] = conversation_id
-                            mcp_agent.session_contexts[current_session_id] = session_ctx
-                            print(f"🧵 新建对话线程 conversation_id={conversation_id} 用于会话 {effective_session_id}（连接 {current_session_id}）")
+                            logger.info("🧵 新建对话线程 conversation_id=%s 用于会话 %s（连接 %s）", conversation_id, effective_session_id, current_session_id)
                     except Exception as _e:
-                        print(f"⚠️ 初始化 conversation_id 失败: {_e}")
+                        logger.warning("⚠️ 初始化 conversation_id 失败: %s", _e)
                         conversation_id = None
 
                     # 仅按生效的对话线程加载最近历史，避免串线
                     effective_session_id_for_history = session_ctx.get("effective_session_id") or current_session_id
-                    history = await chat_db.get_chat_history(
-                        session_id=effective_session_id_for_history,
-                        limit=10,
-                        conversation_id=conversation_id
-                    ) # 限制最近10条
-                    conversation_files = []
-                    try:
-                        if conversation_id is not None:
-                            conversation_files = await chat_db.get_conversation_files(
-                                session_id=effective_session_id_for_history,
-                                conversation_id=conversation_id
-                            )
-                    except Exception as _e:
-                        print(f"⚠️ 获取会话文件失败: {_e}")
+                    history, conversation_files = await _load_turn_context(effective_session_id_for_history, conversation_id)
 
-                    # 启动后台任务消费流，允许外部 pause 取消
-                    async def stream_and_persist():
+                    # 准备用户输入：
+                    # - 如为多模态（content_parts），直接传入，不拼接附件提示
+                    # - 否则为纯文本，可按需注入附件说明
+                    if isinstance(content_parts, list) and content_parts:
+                        # 如果包含图片，但当前选择的模型不支持视觉，提前报错
                         try:
-                            response_started = False
-                            # 准备用户输入：
-                            # - 如为多模态（content_parts），直接传入，不拼接附件提示
-                            # - 否则为纯文本，可按需注入附件说明
-                            user_payload = None
-                            if isinstance(content_parts, list) and content_parts:
-                                # 如果包含图片，但当前选择的模型不支持视觉，提前报错
-                                try:
-                                    selected_pid = session_ctx.get("model")
-                                    cfg = None
-                                    if selected_pid and selected_pid in mcp_agent.llm_profiles:
-                                        cfg = mcp_agent.llm_profiles.get(selected_pid)
-                                    else:
-                                        cfg = mcp_agent.llm_profiles.get(mcp_agent.default_profile_id)
-                                    model_name = (cfg or {}).get("model", "")
-                                    base_url = (cfg or {}).get("base_url", "")
-                                    if user_has_images and not mcp_agent._supports_vision(model_name, base_url):
-                                        await manager.send_personal_message({
-                                            "type": "error",
-                                            "content": "当前所选模型不支持图像解析，请切换支持视觉的模型或移除图片。",
-                                            "code": "vision_not_supported"
-                                        }, websocket)
-                                        return
-                                except Exception:
-                                    pass
-                                user_payload = content_parts
-                            else:
-                                enriched_user_input = (raw_content or "").strip()
-                                if attachments:
-                                    try:
-                                        names = ", ".join([str(a.get('filename') or '') for a in attachments if a])
-                                        urls = "; ".join([str(a.get('url') or '') for a in attachments if a])
-                                        note = f"\n\n[Attachments]\nfilenames: {names}\nurls: {urls}\nIf needed, use tool 'preview_uploaded_file' with the url string to preview content."
-                                        enriched_user_input = (enriched_user_input or '') + note
-                                    except Exception:
-                                        pass
-                                user_payload = enriched_user_input
-
-                            async for response_chunk in mcp_agent.chat_stream(
-                                user_payload,
-                                history=history,
-                                session_id=current_session_id,
-                                conversation_files=conversation_files
-                            ):
-                                await manager.send_personal_message(response_chunk, websocket)
-                                chunk_type = response_chunk.get("type")
-                                if chunk_type == "ai_response_start":
-                                    response_started = True
-                                elif chunk_type == "tool_start":
-                                    conversation_data["mcp_tools_called"].append({
-                                        "tool_id": response_chunk.get("tool_id"),
-                                        "tool_name": response_chunk.get("tool_name"),
-                                        "tool_args": response_chunk.get("tool_args"),
-                                        "progress": response_chunk.get("progress")
-                                    })
-                                elif chunk_type == "tool_end":
-                                    conversation_data["mcp_results"].append({
-                                        "tool_id": response_chunk.get("tool_id"),
-                                        "tool_name": response_chunk.get("tool_name"),
-                                        "result": response_chunk.get("result"),
-                                        "success": True
-                                    })
-                                elif chunk_type == "tool_error":
-                                    conversation_data["mcp_results"].append({
-                                        "tool_id": response_chunk.get("tool_id"),
-                                        "error": response_chunk.get("error"),
-                                        "success": False
-                                    })
-                                elif chunk_type in ("ai_response_chunk", "ai_thinking_chunk"):
-                                    conversation_data["ai_response_parts"].append(response_chunk.get("content", ""))
-                                elif chunk_type == "token_usage":
-                                    conversation_data["usage"] = {
-                                        "input_tokens": response_chunk.get("input_tokens"),
-                                        "output_tokens": response_chunk.get("output_tokens"),
-                                        "total_tokens": response_chunk.get("total_tokens")
-                                    }
-                                elif chunk_type == "error":
-                                    print(f"❌ MCP处理错误: {response_chunk.get('content')}")
-                                    break
-                        except asyncio.CancelledError:
-                            # 被暂停：结束消息但不丢已生成内容
-                            if response_started:
-                                try:
-                                    await manager.send_personal_message({"type": "ai_response_end", "content": ""}, websocket)
-                                except Exception:
-                                    pass
-                            raise
-                        except Exception as e:
-                            print(f"❌ MCP流式处理异常: {e}")
-                        finally:
-                            ai_response_final = "".join(conversation_data["ai_response_parts"]) or ""
-                            if not ai_response_final and conversation_data["mcp_results"]:
-                                error_results = [r for r in conversation_data["mcp_results"] if not r.get("success", True)]
-                                if error_results:
-                                    ai_response_final = "处理过程中遇到错误：\n" + "\n".join([r.get("error", "未知错误") for r in error_results])
+                            caps = session_ctx.get("_caps") or _refresh_session_caps(session_ctx)
+                            if user_has_images and not mcp_agent._supports_vision(caps["model_name"], caps["base_url"]):
+                                await manager.send_personal_message({
+                                    "type": "error",
+                                    "content": "当前所选模型不支持图像解析，请切换支持视觉的模型或移除图片。",
+                                    "code": "vision_not_supported"
+                                }, websocket)
+                                continue
+                        except Exception:
+                            pass
+                        user_payload = content_parts
+                    else:
+                        enriched_user_input = (raw_content or "").strip()
+                        if attachments:
                             try:
-                                if chat_db:
-                                    # 续聊：保存到生效会话+线程
-                                    effective_session_id_for_save = session_ctx.get("effective_session_id") or current_session_id
-                                    inserted_id = await chat_db.save_conversation(
-                                        user_input=conversation_data["user_input"],
-                                        mcp_tools_called=conversation_data["mcp_tools_called"],
-                                        mcp_results=conversation_data["mcp_results"],
-                                        ai_response=ai_response_final,
-                                        session_id=effective_session_id_for_save,
-                                        conversation_id=conversation_id,
-                                        msid=mcp_agent.session_contexts.get(current_session_id, {}).get("msid") if hasattr(mcp_agent, 'session_contexts') else None,
-                                        attachments=attachments,
-                                        usage=conversation_data.get("usage")
-                                    )
-                                    # 将新记录ID回传给前端，便于即时挂载操作按钮
-                                    try:
-                                        await manager.send_personal_message({
-                                            "type": "record_saved",
-                                            "record_id": inserted_id,
-                                            "session_id": effective_session_id_for_save,
-                                            "conversation_id": conversation_id
-                                        }, websocket)
-                                    except Exception:
-                                        pass
-                            except Exception as e:
-                                print(f"❌ 保存对话记录异常: {e}")
-                            finally:
-                                active_stream_tasks.pop(current_session_id, None)
-
-                    task = asyncio.create_task(stream_and_persist())
-                    active_stream_tasks[current_session_id] = task
+                                names = ", ".join([str(a.get('filename') or '') for a in attachments if a])
+                                urls = "; ".join([str(a.get('url') or '') for a in attachments if a])
+                                note = f"\n\n[Attachments]\nfilenames: {names}\nurls: {urls}\nIf needed, use tool 'preview_uploaded_file' with the url string to preview content."
+                                enriched_user_input = (enriched_user_input or '') + note
+                            except Exception:
+                                pass
+                        user_payload = enriched_user_input
+
+                    # 启动后台任务消费流，允许外部 pause 取消
+                    await _start_stream(
+                        websocket,
+                        user_payload,
+                        user_input=raw_content if raw_content is not None else "",
+                        history=history,
+                        conversation_files=conversation_files,
+                        current_session_id=current_session_id,
+                        # 续聊：保存到生效会话+线程
+                        save_session_id=session_ctx.get("effective_session_id") or current_session_id,
+                        conversation_id=conversation_id,
+                        attachments=attachments,
+                        msid=session_ctx.get("msid")
+                    )
                     continue
                 
                 elif message.get("type") == "pause":
@@ -400,15 +589,24 @@ async def websocket_chat(websocket: WebSocket):
                                 "content": "Missing model id"
                             }, websocket)
                             continue
+                        if new_model not in mcp_agent.llm_profiles:
+                            await manager.send_personal_message({
+                                "type": "model_switch_error",
+                                "content": f"Unknown model id: {new_model}"
+                            }, websocket)
+                            continue
                         current_session_id = manager.get_session_id(websocket)
-                        if not hasattr(mcp_agent, 'session_contexts'):
-                            mcp_agent.session_contexts = {}
-                        session_ctx = mcp_agent.session_contexts.get(current_session_id, {})
+                        session_ctx = mcp_agent.session_contexts.setdefault(current_session_id, {})
                         session_ctx["model"] = new_model
-                        mcp_agent.session_contexts[current_session_id] = session_ctx
+                        if payload.get("use_tools") is not None:
+                            session_ctx["use_tools"] = _parse_use_tools(payload.get("use_tools"))
+                        _refresh_session_caps(session_ctx)
+                        # 切换模型后历史记录按新模型的能力重新转换
+                        session_ctx.pop("history_records", None)
                         await manager.send_personal_message({
                             "type": "model_switched",
-                            "model": new_model
+                            "model": new_model,
+                            "use_tools": session_ctx.get("use_tools", True)
                         }, websocket)
                     except Exception as _e:
                         await manager.send_personal_message({
@@ -432,6 +630,7 @@ async def websocket_chat(websocket: WebSocket):
                         # 先删除后续记录
                         try:
                             ok = await chat_db.delete_records_after(target_session, int(target_conv), int(from_record_id))
+                            _invalidate_read_cache(target_session)
                             if not ok:
                                 await manager.send_personal_message({
                                     "type": "edit_error",
@@ -447,12 +646,9 @@ async def websocket_chat(websocket: WebSocket):
 
                         # 绑定生效会话/线程到当前连接，随后按普通 user_msg 流程处理
                         current_session_id = manager.get_session_id(websocket)
-                        if not hasattr(mcp_agent, 'session_contexts'):
-                            mcp_agent.session_contexts = {}
-                        session_ctx = mcp_agent.session_contexts.get(current_session_id, {})
+                        session_ctx = mcp_agent.session_contexts.setdefault(current_session_id, {})
                         session_ctx["effective_session_id"] = target_session
                         session_ctx["effective_conversation_id"] = int(target_conv)
-                        mcp_agent.session_contexts[current_session_id] = session_ctx
                         await manager.send_personal_message({
                             "type": "edit_ok",
                             "session_id": target_session,
@@ -460,116 +656,20 @@ async def websocket_chat(websocket: WebSocket):
                         }, websocket)
 
                         # 直接按 user_msg 流程继续生成
-                        user_input = new_user_input
-                        # 收集对话数据
-                        conversation_data = {
-                            "user_input": user_input,
-                            "mcp_tools_called": [],
-                            "mcp_results": [],
-                            "ai_response_parts": []
-                        }
                         # 在目标线程上取历史
-                        history = await chat_db.get_chat_history(
-                            session_id=target_session,
-                            limit=10,
-                            conversation_id=int(target_conv)
+                        history, conversation_files = await _load_turn_context(target_session, int(target_conv))
+                        await _start_stream(
+                            websocket,
+                            new_user_input,
+                            user_input=new_user_input,
+                            history=history,
+                            conversation_files=conversation_files,
+                            current_session_id=current_session_id,
+                            save_session_id=target_session,
+                            conversation_id=int(target_conv),
+                            attachments=[{"filename": "(edited)"}],  # 保留字段结构，后续可扩展
+                            msid=session_ctx.get("msid")
                         )
-                        conversation_files = []
-                        try:
-                            conversation_files = await chat_db.get_conversation_files(
-                                session_id=target_session,
-                                conversation_id=int(target_conv)
-                            )
-                        except Exception as _e:
-                            print(f"⚠️ 获取会话文件失败: {_e}")
-                        async def stream_and_persist_edit():
-                            try:
-                                response_started = False
-                                async for response_chunk in mcp_agent.chat_stream(
-                                    user_input,
-                                    history=history,
-                                    session_id=current_session_id,
-                                    conversation_files=conversation_files
-                                ):
-                                    await manager.send_personal_message(response_chunk, websocket)
-                                    chunk_type = response_chunk.get("type")
-                                    if chunk_type == "ai_response_start":
-                                        response_started = True
-                                    elif chunk_type == "tool_start":
-                                        conversation_data["mcp_tools_called"].append({
-                                            "tool_id": response_chunk.get("tool_id"),
-                                            "tool_name": response_chunk.get("tool_name"),
-                                            "tool_args": response_chunk.get("tool_args"),
-                                            "progress": response_chunk.get("progress")
-                                        })
-                                    elif chunk_type == "tool_end":
-                                        conversation_data["mcp_results"].append({
-                                            "tool_id": response_chunk.get("tool_id"),
-                                            "tool_name": response_chunk.get("tool_name"),
-                                            "result": response_chunk.get("result"),
-                                            "success": True
-                                        })
-                                    elif chunk_type == "tool_error":
-                                        conversation_data["mcp_results"].append({
-                                            "tool_id": response_chunk.get("tool_id"),
-                                            "error": response_chunk.get("error"),
-                                            "success": False
-                                        })
-                                    elif chunk_type in ("ai_response_chunk", "ai_thinking_chunk"):
-                                        conversation_data["ai_response_parts"].append(response_chunk.get("content", ""))
-                                    elif chunk_type == "token_usage":
-                                        conversation_data["usage"] = {
-                                            "input_tokens": response_chunk.get("input_tokens"),
-                                            "output_tokens": response_chunk.get("output_tokens"),
-                                            "total_tokens": response_chunk.get("total_tokens")
-                                        }
-                                    elif chunk_type == "error":
-                                        print(f"❌ MCP处理错误: {response_chunk.get('content')}")
-                                        break
-                            except asyncio.CancelledError:
-                                if response_started:
-                                    try:
-                                        await manager.send_personal_message({"type": "ai_response_end", "content": ""}, websocket)
-                                    except Exception:
-                                        pass
-                                raise
-                            except Exception as e:
-                                print(f"❌ MCP流式处理异常: {e}")
-                            finally:
-                                ai_response_final = "".join(conversation_data["ai_response_parts"]) or ""
-                                if not ai_response_final and conversation_data["mcp_results"]:
-                                    error_results = [r for r in conversation_data["mcp_results"] if not r.get("success", True)]
-                                    if error_results:
-                                        ai_response_final = "处理过程中遇到错误：\n" + "\n".join([r.get("error", "未知错误") for r in error_results])
-                                try:
-                                    if chat_db:
-                                        inserted_id = await chat_db.save_conversation(
-                                            user_input=conversation_data["user_input"],
-                                            mcp_tools_called=conversation_data["mcp_tools_called"],
-                                            mcp_results=conversation_data["mcp_results"],
-                                            ai_response=ai_response_final,
-                                            session_id=target_session,
-                                            conversation_id=int(target_conv),
-                                            msid=mcp_agent.session_contexts.get(current_session_id, {}).get("msid") if hasattr(mcp_agent, 'session_contexts') else None,
-                                            attachments=[{"filename": "(edited)"}],  # 保留字段结构，后续可扩展
-                                            usage=conversation_data.get("usage")
-                                        )
-                                        try:
-                                            await manager.send_personal_message({
-                                                "type": "record_saved",
-                                                "record_id": inserted_id,
-                                                "session_id": target_session,
-                                                "conversation_id": int(target_conv)
-                                            }, websocket)
-                                        except Exception:
-                                            pass
-                                except Exception as e:
-                                    print(f"❌ 保存对话记录异常: {e}")
-                                finally:
-                                    active_stream_tasks.pop(current_session_id, None)
-
-                        task = asyncio.create_task(stream_and_persist_edit())
-                        active_stream_tasks[current_session_id] = task
                         continue
                     except Exception as _e:
                         await manager.send_personal_message({
@@ -584,15 +684,13 @@ async def websocket_chat(websocket: WebSocket):
                         "content": f"未知消息类型: {message.get('type')}"
                     }, websocket)
                     
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 await manager.send_personal_message({
                     "type": "error",
                     "content": "Invalid message format. Please send valid JSON."
                 }, websocket)
             except Exception as e:
-                print(f"❌ WebSocket消息处理异常: {e}")
-                import traceback
-                traceback.print_exc()
+                logger.exception("❌ WebSocket消息处理异常: %s", e)
                 await manager.send_personal_message({
                     "type": "error",
                     "content": f"处理消息时出错: {str(e)}"
@@ -601,8 +699,12 @@ async def websocket_chat(websocket: WebSocket):
     except WebSocketDisconnect:
         manager.disconnect(websocket)
     except Exception as e:
-        print(f"❌ WebSocket错误: {e}")
+        logger.error("❌ WebSocket错误: %s", e)
         manager.disconnect(websocket)
+    finally:
+        # 无进行中的流式任务时立即释放会话上下文；否则由任务结束时释放
+        if session_id not in active_stream_tasks:
+            mcp_agent.session_contexts.pop(session_id, None)
 
 # ─────────── REST API 接口 ───────────
 
@@ -626,31 +728,58 @@ async def get_tools():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取工具列表失败: {str(e)}")
 
+def _write_and_hash(out, hasher, chunk: bytes):
+    hasher.update(chunk)
+    out.write(chunk)
+
 @app.post("/api/upload")
 async def upload_file(file: UploadFile = File(...)):
     """上传文件，返回可访问的URL路径。"""
     try:
         # 基础校验与限制（可按需调整）
         original_name = file.filename or "file"
-        ext = os.path.splitext(original_name)[1]
-        # 生成唯一文件名，避免重复
-        unique_name = f"{uuid.uuid4().hex}{ext}"
+        ext = os.path.splitext(original_name)[1].lower()
 
-        # 使用日期子目录，便于管理
-        date_dir = datetime.now().strftime("%Y%m%d")
-        target_dir = os.path.join(UPLOADS_DIR, date_dir)
-        os.makedirs(target_dir, exist_ok=True)
+        # 先写入临时文件，分块写盘的同时计算内容哈希并校验大小（上限 20MB），内存占用只与块大小相关
+        tmp_dir = os.path.join(UPLOADS_DIR, ".tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+        hasher = hashlib.blake2b(digest_size=16)
+        total = 0
+        out = await run_in_threadpool(open, tmp_path, "wb")
+        try:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                total += len(chunk)
+                if total > UPLOAD_MAX_BYTES:
+                    raise HTTPException(status_code=400, detail="File too large (max 20MB)")
+                await run_in_threadpool(_write_and_hash, out, hasher, chunk)
+        except BaseException:
+            out.close()
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        out.close()
 
+        # 内容寻址存储：uploads/<hash前两位>/<hash><ext>，相同内容重复上传时直接复用已有文件
+        file_hash = hasher.hexdigest()
+        unique_name = f"{file_hash}{ext}"
+        target_dir = os.path.join(UPLOADS_DIR, file_hash[:2])
+        os.makedirs(target_dir, exist_ok=True)
         target_path = os.path.join(target_dir, unique_name)
-        content = await file.read()
-        # 简单大小限制：20MB
-        if len(content) > 20 * 1024 * 1024:
-            raise HTTPException(status_code=400, detail="File too large (max 20MB)")
-        with open(target_path, "wb") as f:
-            f.write(content)
+        if os.path.exists(target_path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, target_path)
 
         # 返回静态访问路径（相对API根路径）
-        url_path = f"/uploads/{date_dir}/{unique_name}"
+        url_path = f"/uploads/{file_hash[:2]}/{unique_name}"
+        if chat_db:
+            await chat_db.register_upload(file_hash, original_name, url_path, total)
         return {"success": True, "data": {"filename": original_name, "stored_as": unique_name, "url": url_path}}
     except HTTPException:
         raise
@@ -667,40 +796,46 @@ async def get_models():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取模型列表失败: {str(e)}")
 
+# 只读接口（历史/线程/分享）的进程内短时缓存：10 秒过期且读取不续期，写入路径按会话主动失效
+api_read_cache: TTLCache = TTLCache(maxsize=2048, ttl=10, refresh_on_read=False)
+
+def _invalidate_read_cache(session_id: Optional[str] = None):
+    """会话数据变更后失效缓存：该会话的历史与分享（未指定会话时全部）以及线程列表"""
+    for key in list(api_read_cache):
+        if key[0] in ("history", "share") and session_id is not None and key[1] != session_id:
+            continue
+        api_read_cache.pop(key, None)
+
 @app.get("/api/history")
 async def get_history(limit: int = 50, session_id: str = "default", conversation_id: int = None):
     """获取聊天历史"""
     if not chat_db:
         raise HTTPException(status_code=503, detail="数据库未初始化")
     
+    cache_key = ("history", session_id, conversation_id, limit)
+    cached = api_read_cache.get(cache_key)
+    if cached is not None:
+        return cached
     try:
-        records = await chat_db.get_chat_history(
-            session_id=session_id, 
+        # 历史记录与会话文件在同一连接上读取，统计信息来自内存缓存
+        bundle = await chat_db.get_history_bundle(
+            session_id=session_id,
             limit=limit,
             conversation_id=conversation_id
         )
-        conversation_files = []
-        if conversation_id is not None:
-            try:
-                conversation_files = await chat_db.get_conversation_files(
-                    session_id=session_id,
-                    conversation_id=conversation_id
-                )
-            except Exception as _e:
-                print(f"⚠️ 获取会话文件失败: {_e}")
-        
-        # 获取统计信息
-        stats = await chat_db.get_stats()
+        records = bundle["records"]
         
-        return {
+        result = {
             "success": True,
             "data": records,
-            "total": stats.get("total_records", 0),
+            "total": bundle["stats"].get("total_records", 0),
             "returned": len(records),
             "session_id": session_id,
             "conversation_id": conversation_id,
-            "conversation_files": conversation_files
+            "conversation_files": bundle["conversation_files"]
         }
+        api_read_cache[cache_key] = result
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取历史记录失败: {str(e)}")
 
@@ -709,17 +844,28 @@ async def get_threads(msid: int, limit: int = 100):
     """按 msid 获取对话线程列表（左侧侧栏用）。"""
     if not chat_db:
         raise HTTPException(status_code=503, detail="数据库未初始化")
+    cache_key = ("threads", msid, limit)
+    cached = api_read_cache.get(cache_key)
+    if cached is not None:
+        return cached
     try:
         threads = await chat_db.get_threads_by_msid(msid=msid, limit=limit)
-        return {"success": True, "data": threads}
+        result = {"success": True, "data": threads}
+        api_read_cache[cache_key] = result
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取线程列表失败: {str(e)}")
 
 @app.delete("/api/history")
-async def clear_history(session_id: str = None):
-    """清空聊天历史"""
+async def clear_history(session_id: str = None, confirm: bool = False):
+    """清空聊天历史（不指定 session_id 时清空全部，需 confirm=true 且无进行中的回答）"""
     if not chat_db:
         raise HTTPException(status_code=503, detail="数据库未初始化")
+    if not session_id:
+        if not confirm:
+            raise HTTPException(status_code=400, detail="清空全部历史需要 confirm=true")
+        if any(not task.done() for task in active_stream_tasks.values()):
+            raise HTTPException(status_code=409, detail="仍有进行中的回答，请稍后再清空全部历史")
     
     try:
         # 如果没有提供session_id，则清空所有历史（保持向后兼容）
@@ -729,6 +875,7 @@ async def clear_history(session_id: str = None):
         else:
             success = await chat_db.clear_history()
             message = "所有聊天历史已清空"
+        _invalidate_read_cache(session_id or None)
         
         if success:
             return {"success": True, "message": message}
@@ -744,6 +891,7 @@ async def delete_thread(session_id: str, conversation_id: int):
         raise HTTPException(status_code=503, detail="数据库未初始化")
     try:
         ok = await chat_db.delete_conversation(session_id=session_id, conversation_id=conversation_id)
+        _invalidate_read_cache(session_id)
         if ok:
             return {"success": True}
         raise HTTPException(status_code=500, detail="删除对话线程失败")
@@ -791,7 +939,7 @@ async def get_status():
     db_stats = {}
     if chat_db:
         try:
-            db_stats = await chat_db.get_stats()
+            db_stats = await chat_db.get_cached_stats()
         except Exception as e:
             print(f"⚠️ 获取数据库统计失败: {e}")
     
@@ -833,18 +981,17 @@ async def get_shared_chat(session_id: str, limit: int = 100):
         raise HTTPException(status_code=503, detail="数据库未初始化")
     
     try:
-        # 获取指定会话的聊天历史
-        records = await chat_db.get_chat_history(
-            session_id=session_id, 
-            limit=limit
-        )
+        # 获取指定会话的聊天历史（只读连接 + 短时缓存，重复打开分享页不再访问 SQLite）
+        cache_key = ("share", session_id, limit)
+        records = api_read_cache.get(cache_key)
+        if records is None:
+            records = await chat_db.get_shared_history(session_id=session_id, limit=limit)
+            if records:
+                api_read_cache[cache_key] = records
         
         if not records:
             raise HTTPException(status_code=404, detail="未找到该会话的聊天记录")
         
-        # 获取会话统计信息
-        stats = await chat_db.get_stats()
-        
         return {
             "success": True,
             "data": records,
@@ -870,10 +1017,32 @@ if __name__ == "__main__":
         port = int(os.getenv("BACKEND_PORT", "8003"))
     except Exception:
         port = 8003
+    # 工作进程数：WEB_CONCURRENCY>1 时多进程各占一核；每个 WebSocket 连接及其会话上下文、
+    # 暂停信号都固定在同一进程内，无需跨进程共享状态。多进程模式下不启用热重载
+    try:
+        workers = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+    except Exception:
+        workers = 1
+    # 事件循环与 HTTP 解析器：uvloop/httptools 随 uvicorn[standard] 安装，
+    # 显著降低流式小帧推送的调度开销；不可用（如 Windows）时回退到标准实现
+    try:
+        import uvloop  # noqa: F401
+        loop_impl = "uvloop"
+    except ImportError:
+        loop_impl = "asyncio"
+    try:
+        import httptools  # noqa: F401
+        http_impl = "httptools"
+    except ImportError:
+        http_impl = "h11"
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=port,
-        reload=True,
+        reload=workers <= 1,
+        workers=workers,
+        loop=loop_impl,
+        http=http_impl,
+        ws="websockets",
         log_level="info"
     )
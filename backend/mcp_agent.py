@@ -4,15 +4,17 @@ MCP智能体封装 - 为Web后端使用
 """
 
 import os
-import json
+import hashlib
 import asyncio
-from typing import Dict, List, Any, AsyncGenerator, Optional
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Any, AsyncGenerator, Optional, Tuple
 from pathlib import Path
 from datetime import datetime, timedelta
 
 from dotenv import load_dotenv, find_dotenv
+import orjson
 import re
-from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage
 import contextvars
 import pymysql
@@ -22,13 +24,90 @@ from mcp_modules.config import MCPConfig
 from mcp_modules.multimodal import MultimodalProcessor
 from mcp_modules.model_manager import ModelManager
 from mcp_modules.message_processor import MessageProcessor
+from mcp_modules.cache import TTLCache
+from mcp_modules.response_cache import ResponseCache
+from mcp_modules.mysql_pool import MySQLPool
+from mcp_modules.log_filter import install_mcp_log_filter, suppress_mcp_logs
 from get_mcp_tools import MCPToolsManager
 from prompt.loader import load_prompts
 
+install_mcp_log_filter()
+
 # ─────────── 1. MCP配置管理 ───────────
 # 已移至 mcp_agent/config.py
 
 
+@lru_cache(maxsize=32)
+def _load_tools_prompt_template(profile_id: Optional[str]) -> str:
+    """按档位加载工具阶段提示词模板（提示词模块只在首次使用时加载，修改后需重启生效）"""
+    return load_prompts(profile_id).get("tools_system_prompt_template", "")
+
+
+@dataclass(frozen=True)
+class AgentEnv:
+    """智能体运行参数（来自环境变量，进程内只解析一次）"""
+    public_base_url: str
+    history_image_max_file_bytes: int
+    history_images_max_total: int
+    history_images_max_per_record: int
+    history_images_max_total_bytes: int
+    history_max_messages: int
+    db_host: str
+    db_user: str
+    db_password: str
+    db_name: str
+    db_port: int
+    db_pool_size: int
+    model_caps_cache: str
+    tools_max_concurrency: int
+    tools_decision_mode: str
+    debug_stream_log: bool
+    provider_prompt_cache: bool
+    response_cache_ttl: float
+    response_cache_size: int
+
+
+def _env_number(name: str, default, cast=int, minimum=None):
+    """读取数值型环境变量；缺失或非法时使用默认值（非法时给出提示）"""
+    raw = os.getenv(name)
+    if raw is None or not raw.strip():
+        return default
+    try:
+        value = cast(raw.strip())
+    except ValueError:
+        print(f"⚠️ 环境变量 {name}={raw!r} 无效，使用默认值 {default}")
+        return default
+    if minimum is not None and value < minimum:
+        return minimum
+    return value
+
+
+@lru_cache(maxsize=1)
+def _load_env() -> AgentEnv:
+    """解析智能体所需的环境变量（首次创建 WebMCPAgent 时调用，此时 .env 已加载）"""
+    return AgentEnv(
+        public_base_url=os.getenv("PUBLIC_BASE_URL", "").strip(),
+        history_image_max_file_bytes=_env_number("HISTORY_IMAGE_MAX_FILE_BYTES", 2 * 1024 * 1024),
+        history_images_max_total=_env_number("HISTORY_IMAGES_MAX_TOTAL", 6),
+        history_images_max_per_record=_env_number("HISTORY_IMAGES_MAX_PER_RECORD", 3),
+        history_images_max_total_bytes=_env_number("HISTORY_IMAGES_MAX_TOTAL_BYTES", 8 * 1024 * 1024),
+        history_max_messages=_env_number("HISTORY_MAX_MESSAGES", 40),
+        db_host=os.getenv("DB_HOST", "18.119.46.208"),
+        db_user=os.getenv("DB_USER", "root"),
+        db_password=os.getenv("DB_PASSWORD", "zkshi0101"),
+        db_name=os.getenv("DB_NAME", "ry_vuebak"),
+        db_port=_env_number("DB_PORT", 3306),
+        db_pool_size=_env_number("DB_POOL_SIZE", 25, minimum=1),
+        model_caps_cache=os.getenv("MODEL_CAPS_CACHE", ".model_caps.json"),
+        tools_max_concurrency=_env_number("MCP_TOOLS_MAX_CONCURRENCY", 8, minimum=1),
+        tools_decision_mode=(os.getenv("TOOLS_DECISION_MODE", "astream") or "astream").strip().lower(),
+        debug_stream_log=os.getenv("DEBUG_STREAM_LOG", "0").strip() == "1",
+        provider_prompt_cache=os.getenv("PROVIDER_PROMPT_CACHE", "0").strip() == "1",
+        response_cache_ttl=_env_number("RESPONSE_CACHE_TTL", 3600.0, cast=float),
+        response_cache_size=_env_number("RESPONSE_CACHE_SIZE", 512),
+    )
+
+
 # ─────────── 3. Web版MCP智能体 ───────────
 class WebMCPAgent:
     """Web版MCP智能体 - 支持流式推送"""
@@ -68,49 +147,61 @@ class WebMCPAgent:
         self.temperature = self.model_manager.temperature
         self.timeout = self.model_manager.timeout
 
-        # 将关键配置同步到环境（供底层SDK使用），不覆盖外部已设值
-        if self.api_key and not os.getenv("OPENAI_API_KEY"):
-            os.environ["OPENAI_API_KEY"] = self.api_key
-        if self.base_url and not os.getenv("OPENAI_BASE_URL"):
-            os.environ["OPENAI_BASE_URL"] = self.base_url
-
-        # 会话上下文（存放每个 session 的 msid 等）
-        self.session_contexts: Dict[str, Dict[str, Any]] = {}
+        # 会话上下文（存放每个 session 的 msid 等）；有界 LRU+TTL，异常断开的连接不会永久占用内存
+        self.session_contexts: TTLCache = TTLCache(maxsize=10000, ttl=3600)
         
+        env = _load_env()
+        self.env = env
+
         # 历史图片配置
-        try:
-            public_base_url = os.getenv("PUBLIC_BASE_URL", "").strip()
-            history_image_max_file_bytes = int(os.getenv("HISTORY_IMAGE_MAX_FILE_BYTES", str(2 * 1024 * 1024)))
-        except Exception:
-            public_base_url = ""
-            history_image_max_file_bytes = 2 * 1024 * 1024
-            
-        self.multimodal_processor = MultimodalProcessor(public_base_url, history_image_max_file_bytes)
-        
-        try:
-            history_images_max_total = int(os.getenv("HISTORY_IMAGES_MAX_TOTAL", "6"))
-            history_images_max_per_record = int(os.getenv("HISTORY_IMAGES_MAX_PER_RECORD", "3"))
-        except Exception:
-            history_images_max_total = 6
-            history_images_max_per_record = 3
-            
-        self.message_processor = MessageProcessor(self.multimodal_processor, history_images_max_total, history_images_max_per_record)
+        self.multimodal_processor = MultimodalProcessor(env.public_base_url, env.history_image_max_file_bytes)
+        self.message_processor = MessageProcessor(
+            self.multimodal_processor, env.history_images_max_total, env.history_images_max_per_record,
+            env.history_images_max_total_bytes,
+            env.history_max_messages,
+        )
 
         # 数据库配置（从环境读取，提供默认值）
-        self.db_host = os.getenv("DB_HOST", "18.119.46.208")
-        self.db_user = os.getenv("DB_USER", "root")
-        self.db_password = os.getenv("DB_PASSWORD", "zkshi0101")
-        self.db_name = os.getenv("DB_NAME", "ry_vuebak")
-        try:
-            self.db_port = int(os.getenv("DB_PORT", "3306"))
-        except Exception:
-            self.db_port = 3306
+        self.db_host = env.db_host
+        self.db_user = env.db_user
+        self.db_password = env.db_password
+        self.db_name = env.db_name
+        self.db_port = env.db_port
+        # 本地工具共享的 MySQL 连接池（initialize 时创建，close 时释放）
+        self.db_pool: Optional[MySQLPool] = None
 
         # 当前会话ID上下文变量（用于工具在运行时识别会话）
         self._current_session_id_ctx: contextvars.ContextVar = contextvars.ContextVar("current_session_id", default=None)
         
-        # 记录不支持多模态的模型（避免重复尝试）
-        self._non_multimodal_models: set = set()
+        # 记录不支持多模态的模型（避免重复尝试）；持久化到 MODEL_CAPS_CACHE，重启后无需再次失败重试
+        caps_path = Path(env.model_caps_cache)
+        if not caps_path.is_absolute():
+            caps_path = Path(__file__).parent / caps_path
+        self._model_caps_path = caps_path
+        self._non_multimodal_models: set = self._load_caps()
+
+        # 已渲染的工具阶段系统提示词：同一天内按档位复用，跨天时整体重建
+        self._rendered_tools_prompts: Dict[Tuple[Optional[str], str], str] = {}
+
+        # 同一轮多个工具调用并发执行的上限（MCP_TOOLS_MAX_CONCURRENCY）
+        self._tool_semaphore = asyncio.Semaphore(env.tools_max_concurrency)
+
+        # 工具判定方式：astream 边生成边推送（默认）；ainvoke 先非流式判定，无工具调用时直接下发完整回答
+        self.tools_decision_mode = env.tools_decision_mode
+
+        # 逐片段打印流式输出（调试用，默认关闭；每个片段一次 stdout 写入）
+        self._debug_stream_log = env.debug_stream_log
+
+        # 各档位工具集合指纹（工具名排序后取 md5），工具初始化后重新计算
+        self._tools_fingerprints: Dict[Optional[str], str] = {}
+        # 各档位的工具名索引（工具列表对象与长度不变时复用），执行工具调用时按名称直接查找
+        self._tool_indexes: Dict[Optional[str], Tuple[List[Any], int, Dict[str, Any]]] = {}
+
+        # 回答缓存：同一模型、同一消息序列与工具集合下的无工具轮次直接回放（RESPONSE_CACHE_TTL=0 关闭）
+        self.response_cache: Optional[ResponseCache] = (
+            ResponseCache(maxsize=env.response_cache_size, ttl=env.response_cache_ttl)
+            if env.response_cache_ttl > 0 else None
+        )
 
     # 已移至 mcp_agent/model_manager.py
 
@@ -130,40 +221,14 @@ class WebMCPAgent:
         """判断是否为多模态格式不支持的错误"""
         return MultimodalProcessor.is_multimodal_error(error_str)
 
+    def _supports_vision(self, model_name: str, base_url: str) -> bool:
+        """模型是否可接收图片输入（曾因多模态格式报错而降级的模型视为不支持）"""
+        return f"{model_name}@{base_url}" not in self._non_multimodal_models
+
 
     def get_models_info(self) -> Dict[str, Any]:
         """对外暴露的模型档位信息（用于前端展示）。"""
-        profiles = self.llm_profiles or {}
-        ids = list(profiles.keys())
-        non_default_ids = [pid for pid in ids if pid != "default"]
-
-        # 计算有效默认档位：优先采用 LLM_DEFAULT 指定且存在的ID；
-        # 否则若存在非 default 档位，取第一个；否则只能是 default（单模型旧兼容）
-        if self.default_profile_id and self.default_profile_id != "default" and self.default_profile_id in profiles:
-            effective_default = self.default_profile_id
-        elif non_default_ids:
-            effective_default = non_default_ids[0]
-        else:
-            effective_default = "default"
-
-        # 展示策略：
-        # - 若存在任意非 default 档位，则完全隐藏 default（它只作为别名/回退，不单独显示）。
-        # - 若只有 default 一个档位，则显示它（旧版单模型场景）。
-        show_ids = non_default_ids if non_default_ids else (["default"] if "default" in profiles else [])
-
-        # 不去重，允许同一 (base_url, model) 的多个档位同时显示
-        models = []
-        for pid in show_ids:
-            cfg = profiles.get(pid, {})
-            models.append({
-                "id": pid,
-                "label": cfg.get("label", pid),
-                "model": cfg.get("model", ""),
-                "is_default": pid == effective_default,
-            })
-
-        # 极端兜底：如果最终一个都没有（理论不会发生），返回空列表与默认ID
-        return {"models": models, "default": effective_default}
+        return self.model_manager.get_models_info()
 
     def _get_or_create_llm_instances(self, profile_id: str) -> Dict[str, Any]:
         """根据档位获取/创建对应的 LLM 实例集合：llm、llm_nontool、llm_tools。
@@ -210,40 +275,36 @@ class WebMCPAgent:
             if startup_cfg is None:
                 raise RuntimeError("缺少可用的模型档位或 OPENAI_API_KEY，请在 .env 中配置 LLM_PROFILES 对应的 *_API_KEY 或提供 OPENAI_API_KEY")
 
-            # 临时写入环境供底层 SDK 使用
-            if startup_cfg.get("api_key"):
-                os.environ["OPENAI_API_KEY"] = startup_cfg["api_key"]
-            if startup_cfg.get("base_url"):
-                os.environ["OPENAI_BASE_URL"] = startup_cfg["base_url"]
-
-            # ChatOpenAI 支持从环境变量读取 base_url
-            base_llm = ChatOpenAI(
-                model=startup_cfg.get("model", self.model_name),
-                temperature=startup_cfg.get("temperature", self.temperature),
-                timeout=startup_cfg.get("timeout", self.timeout),
-                max_retries=3,
-            )
+            # 与档位实例共用同一个 ChatOpenAI（相同端点与参数只创建一次，共享连接池；
+            # api_key/base_url 直接传给构造函数，不写进程环境变量）
+            base_llm = self.model_manager.get_chat_model(startup_cfg)
             # 主引用向后兼容
             self.llm = base_llm
-            # 无工具实例：当前与 base_llm 相同（无需绑定工具），供工具内部调用
-            self.llm_nontool = ChatOpenAI(
-                model=startup_cfg.get("model", self.model_name),
-                temperature=startup_cfg.get("temperature", self.temperature),
-                timeout=startup_cfg.get("timeout", self.timeout),
-                max_retries=3,
-            )
+            # 无工具实例：与 base_llm 参数相同（无需绑定工具），直接共用，供工具内部调用
+            self.llm_nontool = base_llm
 
             # 加载MCP配置并连接
             mcp_config = self.config.load_config()
             server_configs = mcp_config.get("servers", {})
             
-            # 准备数据库配置
+            # 准备数据库配置与共享连接池
+            self.db_pool = MySQLPool(
+                host=self.db_host,
+                user=self.db_user,
+                password=self.db_password,
+                database=self.db_name,
+                port=self.db_port,
+                maxsize=self.env.db_pool_size,
+            )
+            # 后台预热少量连接，不阻塞启动（数据库不可用时只打印警告）
+            asyncio.get_running_loop().run_in_executor(None, self.db_pool.prefill, min(4, self.env.db_pool_size))
             db_config = {
                 'host': self.db_host,
                 'user': self.db_user,
                 'password': self.db_password,
                 'name': self.db_name,
-                'port': self.db_port
+                'port': self.db_port,
+                'pool': self.db_pool
             }
             
             # 使用工具管理器初始化工具
@@ -251,7 +312,7 @@ class WebMCPAgent:
                 server_configs=server_configs,
                 db_config=db_config,
                 session_contexts=self.session_contexts,
-                current_session_id_ctx=self._current_session_id_ctx,
+                get_current_session_id=self.get_current_session_id,
                 llm_nontool=self.llm_nontool
             )
             
@@ -260,6 +321,8 @@ class WebMCPAgent:
             
             # 更新引用（工具管理器可能已更新这些属性）
             self.mcp_client = self.tools_manager.mcp_client
+            self._tools_fingerprints.clear()
+            self._tool_indexes.clear()
 
             # 创建工具判定实例（默认档位），其余档位在第一次使用时按需创建
             self.llm_tools = base_llm.bind_tools(self.tools)
@@ -285,13 +348,117 @@ class WebMCPAgent:
         """用于工具判定/执行阶段的系统提示词：按档位加载模板并格式化上下文。"""
         now = datetime.now()
         current_date = now.strftime("%Y年%m月%d日")
+        key = (profile_id, current_date)
+        rendered = self._rendered_tools_prompts.get(key)
+        if rendered is not None:
+            return rendered
+        if any(cached_date != current_date for _, cached_date in self._rendered_tools_prompts):
+            self._rendered_tools_prompts.clear()
         current_weekday = ["周一", "周二", "周三", "周四", "周五", "周六", "周日"][now.weekday()]
-        prompts = load_prompts(profile_id)
-        template = prompts.get("tools_system_prompt_template", "")
+        template = _load_tools_prompt_template(profile_id)
         try:
-            return template.format(current_date=current_date, current_weekday=current_weekday)
+            rendered = template.format(current_date=current_date, current_weekday=current_weekday)
         except Exception:
-            return template
+            rendered = template
+        self._rendered_tools_prompts[key] = rendered
+        return rendered
+
+    def _get_tools_fingerprint(self, profile_id: Optional[str], active_tools) -> str:
+        """工具集合指纹：工具增减后旧的回答缓存自然失效"""
+        fingerprint = self._tools_fingerprints.get(profile_id)
+        if fingerprint is None:
+            names = ",".join(sorted(getattr(t, "name", "") for t in active_tools or []))
+            fingerprint = hashlib.md5(names.encode("utf-8")).hexdigest()
+            self._tools_fingerprints[profile_id] = fingerprint
+        return fingerprint
+
+    def _with_prompt_cache(self, messages: List[Dict[str, Any]], style: Optional[str]) -> List[Dict[str, Any]]:
+        """整理发送给模型的消息：编码延迟生成的历史图片，并按服务端缓存方式处理
+        （仅 Anthropic 式需要改写消息内容）"""
+        messages = MultimodalProcessor.materialize_image_urls(messages)
+        if style == "anthropic":
+            return self.message_processor.mark_prompt_cache_breakpoints(messages)
+        return messages
+
+    def get_current_session_id(self) -> Optional[str]:
+        """当前会话ID：优先读取当前流式任务上记录的会话；工具子任务与执行器线程中回退到 ContextVar"""
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        session_id = getattr(task, "session_id", None)
+        if session_id is not None:
+            return session_id
+        return self._current_session_id_ctx.get()
+
+    def _load_caps(self) -> set:
+        """读取已知不支持多模态的模型标识（model@base_url）"""
+        try:
+            if self._model_caps_path.exists():
+                data = orjson.loads(self._model_caps_path.read_bytes())
+                return set(data.get("non_multimodal_models") or [])
+        except Exception as e:
+            print(f"⚠️ 读取模型能力缓存失败: {e}")
+        return set()
+
+    def _save_caps(self):
+        """写入模型能力缓存（仅在新发现不支持多模态的模型时调用，先写临时文件再替换）"""
+        try:
+            tmp_path = self._model_caps_path.with_name(self._model_caps_path.name + ".tmp")
+            tmp_path.write_bytes(orjson.dumps(
+                {"non_multimodal_models": sorted(self._non_multimodal_models)},
+                option=orjson.OPT_INDENT_2
+            ))
+            os.replace(tmp_path, self._model_caps_path)
+        except Exception as e:
+            print(f"⚠️ 保存模型能力缓存失败: {e}")
+
+    @staticmethod
+    def _extract_usage(output) -> Optional[Dict[str, Any]]:
+        """从模型输出中提取真实 token 用量（若底层返回），统一为 input/output/total 三个字段"""
+        try:
+            usage = getattr(output, 'usage_metadata', None)
+            if not usage:
+                meta = getattr(output, 'response_metadata', None) or {}
+                # 兼容不同SDK字段
+                usage = meta.get('token_usage') or {
+                    k: meta.get(k) for k in ("input_tokens", "output_tokens", "total_tokens") if k in meta
+                }
+            if usage:
+                # 规范化为dict
+                if not isinstance(usage, dict):
+                    try:
+                        usage = dict(usage)
+                    except Exception:
+                        usage = {"raw": str(usage)}
+                return {
+                    "input_tokens": usage.get("input_tokens"),
+                    "output_tokens": usage.get("output_tokens"),
+                    "total_tokens": usage.get("total_tokens") or (
+                        (usage.get("input_tokens") or 0) + (usage.get("output_tokens") or 0)
+                    )
+                }
+        except Exception:
+            pass
+        return None
+
+    async def _invoke_tool_limited(self, tool, args: Dict[str, Any]):
+        """在并发上限内执行单个工具调用"""
+        async with self._tool_semaphore:
+            return await tool.ainvoke(args)
+
+    def _get_tool_index(self, profile_id: Optional[str], active_tools) -> Dict[str, Any]:
+        """按档位获取工具名 -> 工具的索引；工具列表被替换或增减后自动重建"""
+        tools = active_tools or []
+        cached = self._tool_indexes.get(profile_id)
+        if cached is not None and cached[0] is tools and cached[1] == len(tools):
+            return cached[2]
+        index: Dict[str, Any] = {}
+        for tool in tools:
+            # 同名时保留先出现的工具（与逐个查找的结果一致）
+            index.setdefault(getattr(tool, "name", ""), tool)
+        self._tool_indexes[profile_id] = (tools, len(tools), index)
+        return index
 
     def _get_stream_system_prompt(self) -> str:
         """保持接口以兼容旧调用，但当前不再使用流式回答提示词。"""
@@ -311,6 +478,9 @@ class WebMCPAgent:
             if session_id:
                 try:
                     self._current_session_id_ctx.set(session_id)
+                    task = asyncio.current_task()
+                    if task is not None:
+                        task.session_id = session_id
                 except Exception:
                     pass
             try:
@@ -336,17 +506,48 @@ class WebMCPAgent:
             # 获取当前 Agent 对应的工具列表（Doctor Agent 使用专属工具）
             active_tools = self.tools_manager.get_tools_for_agent(profile_id) if profile_id else self.tools
 
+            # 没有可用工具或会话关闭了工具（use_tools=False）时改用未绑定工具的实例：
+            # 请求不再携带工具 schema，模型不会发起工具调用，首轮即为最终回答
+            use_tools = bool(active_tools)
+            try:
+                if session_id and (self.session_contexts.get(session_id) or {}).get("use_tools") is False:
+                    use_tools = False
+            except Exception:
+                pass
+            if not use_tools:
+                current_llm_tools = llm_bundle.get("llm") or self.llm
+
             # 1) 构建共享消息历史（不包含系统提示，便于两套系统提示分别注入）
             # 检查当前模型是否已知不支持多模态
             current_model_key = self._get_current_model_key(session_id)
             force_text_only = current_model_key in self._non_multimodal_models
             
+            # 已转换过的历史记录按 id 缓存在会话上下文中，每轮只转换新增记录（不重复编码历史图片）
+            record_cache = None
+            try:
+                session_ctx = self.session_contexts.get(session_id) if session_id else None
+                if isinstance(session_ctx, dict):
+                    record_cache = session_ctx.setdefault("history_records", {})
+            except Exception:
+                record_cache = None
             shared_history = self.message_processor.build_shared_history(
                 history,
                 user_input,
                 force_text_only,
-                conversation_files=conversation_files
+                conversation_files=conversation_files,
+                record_cache=record_cache
+            )
+
+            tools_fingerprint = self._get_tools_fingerprint(profile_id, active_tools) if use_tools else "no-tools"
+
+            # 服务端提示词缓存（PROVIDER_PROMPT_CACHE=1）：Claude 系标记 cache_control 断点，
+            # OpenAI 官方接口附带 prompt_cache_key，使多轮之间不变的前缀命中缓存
+            prompt_cache_style = (
+                self.model_manager.get_prompt_cache_style(profile_id) if self.env.provider_prompt_cache else None
             )
+            llm_call_kwargs: Dict[str, Any] = {}
+            if prompt_cache_style == "openai":
+                llm_call_kwargs["extra_body"] = {"prompt_cache_key": tools_fingerprint}
 
             max_rounds = 25
             round_index = 0
@@ -364,76 +565,78 @@ class WebMCPAgent:
                 content_preview = ""
                 response_started = False
                 multimodal_fallback_attempted = False
+
+                # 命中回答缓存：按小片回放上次的最终回答，跳过本轮模型调用
+                cache_key = None
+                if self.response_cache is not None:
+                    cache_key = ResponseCache.make_key(current_model_key, tools_messages, tools_fingerprint)
+                    cached = self.response_cache.lookup(cache_key)
+                    if cached is not None and not cached.get("tool_calls"):
+                        print(f"⚡ 第 {round_index} 轮命中回答缓存")
+                        if not combined_response_started:
+                            yield {"type": "ai_response_start", "content": "AI正在回复..."}
+                            combined_response_started = True
+                        text = cached["text"]
+                        for start in range(0, len(text), 64):
+                            yield {"type": "ai_response_chunk", "content": text[start:start + 64]}
+                            await asyncio.sleep(0)
+                        yield {"type": "ai_response_end", "content": ""}
+                        return
                 
                 try:
                     # 抑制MCP客户端在判定工具时的SSE解析错误日志
-                    import logging
-                    mcp_logger = logging.getLogger('mcp')
-                    original_level = mcp_logger.level
-                    mcp_logger.setLevel(logging.CRITICAL)
-                    
-                    try:
-                        async for event in current_llm_tools.astream_events(tools_messages, version="v1"):
-                            ev = event.get("event")
-                            if ev == "on_chat_model_stream":
-                                data = event.get("data", {})
-                                chunk = data.get("chunk")
-                                if chunk is None:
-                                    continue
-                                try:
-                                    content_piece = getattr(chunk, 'content', None)
-                                except Exception:
-                                    content_piece = None
-                                if content_piece:
-                                    # 立即向前端流式下发作为最终回复（合并模式：仅首次发送 start）
-                                    if not combined_response_started:
-                                        yield {"type": "ai_response_start", "content": "AI正在回复..."}
-                                        combined_response_started = True
-                                    response_started = True
-                                    buffered_chunks.append(content_piece)
+                    with suppress_mcp_logs():
+                        if self.tools_decision_mode == "ainvoke":
+                            # 非流式判定：一次拿到完整结果，决定调用工具的轮次不再生成并丢弃流式片段
+                            output = await current_llm_tools.ainvoke(
+                                self._with_prompt_cache(tools_messages, prompt_cache_style), **llm_call_kwargs
+                            )
+                            tool_calls_check = getattr(output, 'tool_calls', None)
+                            content_preview = getattr(output, 'content', None) or ""
+                            last_usage = self._extract_usage(output) or last_usage
+                            if content_preview:
+                                if not combined_response_started:
+                                    yield {"type": "ai_response_start", "content": "AI正在回复..."}
+                                    combined_response_started = True
+                                response_started = True
+                                buffered_chunks.append(content_preview)
+                                yield {"type": "ai_response_chunk", "content": content_preview}
+                        else:
+                            async for event in current_llm_tools.astream_events(
+                                self._with_prompt_cache(tools_messages, prompt_cache_style), version="v1", **llm_call_kwargs
+                            ):
+                                ev = event.get("event")
+                                if ev == "on_chat_model_stream":
+                                    data = event.get("data", {})
+                                    chunk = data.get("chunk")
+                                    if chunk is None:
+                                        continue
                                     try:
-                                        print(f"📤 [判定LLM流] {content_piece}")
+                                        content_piece = getattr(chunk, 'content', None)
                                     except Exception:
-                                        pass
-                                    yield {"type": "ai_response_chunk", "content": content_piece}
-                            elif ev == "on_chat_model_end":
-                                data = event.get("data", {})
-                                output = data.get("output")
-                                try:
-                                    tool_calls_check = getattr(output, 'tool_calls', None)
-                                except Exception:
-                                    tool_calls_check = None
-                                try:
-                                    content_preview = getattr(output, 'content', None) or ""
-                                except Exception:
-                                    content_preview = ""
-                                # 捕获真实token用量（若底层返回）
-                                try:
-                                    usage = getattr(output, 'usage_metadata', None)
-                                    if not usage:
-                                        meta = getattr(output, 'response_metadata', None) or {}
-                                        # 兼容不同SDK字段
-                                        usage = meta.get('token_usage') or {
-                                            k: meta.get(k) for k in ("input_tokens", "output_tokens", "total_tokens") if k in meta
-                                        }
-                                    if usage:
-                                        # 规范化为dict
-                                        if not isinstance(usage, dict):
-                                            try:
-                                                usage = dict(usage)
-                                            except Exception:
-                                                usage = {"raw": str(usage)}
-                                        last_usage = {
-                                            "input_tokens": usage.get("input_tokens"),
-                                            "output_tokens": usage.get("output_tokens"),
-                                            "total_tokens": usage.get("total_tokens") or (
-                                                (usage.get("input_tokens") or 0) + (usage.get("output_tokens") or 0)
-                                            )
-                                        }
-                                except Exception:
-                                    last_usage = last_usage
-                    finally:
-                        mcp_logger.setLevel(original_level)
+                                        content_piece = None
+                                    if content_piece:
+                                        # 立即向前端流式下发作为最终回复（合并模式：仅首次发送 start）
+                                        if not combined_response_started:
+                                            yield {"type": "ai_response_start", "content": "AI正在回复..."}
+                                            combined_response_started = True
+                                        response_started = True
+                                        buffered_chunks.append(content_piece)
+                                        if self._debug_stream_log:
+                                            print(f"📤 [判定LLM流] {content_piece}")
+                                        yield {"type": "ai_response_chunk", "content": content_piece}
+                                elif ev == "on_chat_model_end":
+                                    data = event.get("data", {})
+                                    output = data.get("output")
+                                    try:
+                                        tool_calls_check = getattr(output, 'tool_calls', None)
+                                    except Exception:
+                                        tool_calls_check = None
+                                    try:
+                                        content_preview = getattr(output, 'content', None) or ""
+                                    except Exception:
+                                        content_preview = ""
+                                    last_usage = self._extract_usage(output) or last_usage
                 except Exception as e:
                     error_msg = str(e)
                     print(f"⚠️ 工具判定(流式)失败：{error_msg}")
@@ -444,6 +647,7 @@ class WebMCPAgent:
                         
                         # 标记该模型不支持多模态
                         self._non_multimodal_models.add(current_model_key)
+                        self._save_caps()
                         
                         # 发送降级提示
                         if not combined_response_started:
@@ -457,9 +661,10 @@ class WebMCPAgent:
                         
                         try:
                             # 降级重试时也抑制MCP错误日志
-                            mcp_logger.setLevel(logging.CRITICAL)
-                            try:
-                                async for event in current_llm_tools.astream_events(text_only_messages, version="v1"):
+                            with suppress_mcp_logs():
+                                async for event in current_llm_tools.astream_events(
+                                    self._with_prompt_cache(text_only_messages, prompt_cache_style), version="v1", **llm_call_kwargs
+                                ):
                                     ev = event.get("event")
                                     if ev == "on_chat_model_stream":
                                         data = event.get("data", {})
@@ -473,10 +678,8 @@ class WebMCPAgent:
                                         if content_piece:
                                             response_started = True
                                             buffered_chunks.append(content_piece)
-                                            try:
+                                            if self._debug_stream_log:
                                                 print(f"📤 [降级LLM流] {content_piece}")
-                                            except Exception:
-                                                pass
                                             yield {"type": "ai_response_chunk", "content": content_piece}
                                     elif ev == "on_chat_model_end":
                                         data = event.get("data", {})
@@ -489,8 +692,6 @@ class WebMCPAgent:
                                             content_preview = getattr(output, 'content', None) or ""
                                         except Exception:
                                             content_preview = ""
-                            finally:
-                                mcp_logger.setLevel(original_level)
                         except Exception as fallback_e:
                             print(f"❌ 降级重试也失败：{fallback_e}")
                             tool_calls_check = None
@@ -498,6 +699,15 @@ class WebMCPAgent:
                     else:
                         tool_calls_check = None
                         content_preview = ""
+                    # 本轮出错或降级，结果不写入缓存
+                    cache_key = None
+
+                # 每轮只输出一行摘要（逐片段日志需 DEBUG_STREAM_LOG=1）
+                try:
+                    output_chars = sum(len(c) for c in buffered_chunks) if buffered_chunks else len(content_preview or "")
+                    print(f"📤 第 {round_index} 轮输出 {output_chars} 字符，工具调用 {len(tool_calls_check or [])} 个，用量 {last_usage}")
+                except Exception:
+                    pass
 
                 if tool_calls_check:
                     # 合并模式：不结束消息，插入分隔后继续执行工具，最终一并结束
@@ -517,8 +727,8 @@ class WebMCPAgent:
                     except Exception:
                         shared_history.append({"role": "assistant", "content": ""})
 
-                    # 执行工具（非流式）
-                    exit_to_stream = False
+                    # 执行工具（非流式）：先解析并下发全部 tool_start，再并发执行，按完成顺序推送结果
+                    calls = []
                     for i, tool_call in enumerate(tool_calls_to_run, 1):
                         if isinstance(tool_call, dict):
                             tool_id = tool_call.get('id') or f"call_{i}"
@@ -533,7 +743,7 @@ class WebMCPAgent:
                         # 解析参数
                         if isinstance(tool_args_raw, str):
                             try:
-                                parsed_args = json.loads(tool_args_raw) if tool_args_raw else {}
+                                parsed_args = orjson.loads(tool_args_raw) if tool_args_raw else {}
                             except Exception:
                                 parsed_args = {"$raw": tool_args_raw}
                         elif isinstance(tool_args_raw, dict):
@@ -541,61 +751,63 @@ class WebMCPAgent:
                         else:
                             parsed_args = {"$raw": str(tool_args_raw)}
 
+                        calls.append((tool_id, tool_name, parsed_args))
                         yield {"type": "tool_start", "tool_id": tool_id, "tool_name": tool_name, "tool_args": parsed_args, "progress": f"{i}/{len(tool_calls_to_run)}"}
 
-                        try:
-                            target_tool = None
-                            for tool in active_tools:
-                                if tool.name == tool_name:
-                                    target_tool = tool
-                                    break
+                    tool_results: Dict[str, str] = {}
+                    tasks: Dict[asyncio.Task, Tuple[str, str]] = {}
+                    # 抑制MCP客户端在工具调用时的SSE解析错误日志（工具任务创建时继承该标记）
+                    tool_index = self._get_tool_index(profile_id, active_tools)
+                    with suppress_mcp_logs():
+                        for tool_id, tool_name, parsed_args in calls:
+                            target_tool = tool_index.get(tool_name)
                             if target_tool is None:
                                 error_msg = f"工具 '{tool_name}' 未找到"
                                 print(f"❌ {error_msg}")
                                 yield {"type": "tool_error", "tool_id": tool_id, "error": error_msg}
-                                tool_result = f"错误: {error_msg}"
-                            else:
-                                # 抑制MCP客户端在工具调用时的SSE解析错误日志
-                                import logging
-                                mcp_logger = logging.getLogger('mcp')
-                                original_level = mcp_logger.level
-                                mcp_logger.setLevel(logging.CRITICAL)
-                                
+                                tool_results[tool_id] = f"错误: {error_msg}"
+                                continue
+                            task = asyncio.create_task(self._invoke_tool_limited(target_tool, parsed_args))
+                            tasks[task] = (tool_id, tool_name)
+
+                    pending = set(tasks)
+                    try:
+                        while pending:
+                            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                            for task in done:
+                                tool_id, tool_name = tasks[task]
                                 try:
-                                    tool_result = await target_tool.ainvoke(parsed_args)
+                                    tool_result = task.result()
                                     yield {"type": "tool_end", "tool_id": tool_id, "tool_name": tool_name, "result": str(tool_result)}
-                                    # 不再支持退出工具模式
-                                finally:
-                                    mcp_logger.setLevel(original_level)
-                        except Exception as e:
-                            error_msg = f"工具执行出错: {e}"
-                            print(f"❌ {error_msg}")
-                            yield {"type": "tool_error", "tool_id": tool_id, "error": error_msg}
-                            tool_result = f"错误: {error_msg}"
-
-                        # 始终追加 tool 消息，满足 OpenAI 函数调用协议要求
-                        # 对于退出工具模式，内容为简单状态，不影响后续回答质量
+                                except Exception as e:
+                                    error_msg = f"工具执行出错: {e}"
+                                    print(f"❌ {error_msg}")
+                                    yield {"type": "tool_error", "tool_id": tool_id, "error": error_msg}
+                                    tool_result = f"错误: {error_msg}"
+                                tool_results[tool_id] = str(tool_result)
+                    finally:
+                        # 被暂停/中断时取消仍在执行的工具
+                        for task in pending:
+                            task.cancel()
+
+                    # 始终按原调用顺序追加 tool 消息，满足 OpenAI 函数调用协议要求
+                    for tool_id, tool_name, _ in calls:
                         shared_history.append({
                             "role": "tool",
                             "tool_call_id": tool_id,
                             "name": tool_name,
-                            "content": str(tool_result)
+                            "content": tool_results.get(tool_id, "")
                         })
 
-                        if exit_to_stream:
-                            break
-
-                    if exit_to_stream:
-                        # 不再支持提前强制切流式，按原逻辑继续下一轮
-                        pass
-                    else:
-                        # 工具后继续下一轮
-                        continue
+                    # 工具后继续下一轮
+                    continue
 
                 # 3) 无工具：合并模式
                 # 若先前已经流式输出过片段，则此处不再把所有片段再发一次，只发送结束标记；
                 # 若此前尚未开始（无流式片段），则一次性发送最终文本再结束。
                 final_text = "".join(buffered_chunks) if buffered_chunks else (content_preview or "")
+                if cache_key is not None:
+                    self.response_cache.update(cache_key, final_text, usage=last_usage)
                 if combined_response_started:
                     # 已经开始过，避免重复内容
                     yield {"type": "ai_response_end", "content": ""}
@@ -603,10 +815,8 @@ class WebMCPAgent:
                     yield {"type": "ai_response_start", "content": "AI正在回复..."}
                     combined_response_started = True
                     if final_text:
-                        try:
+                        if self._debug_stream_log:
                             print(f"📤 [最终回复流] {final_text}")
-                        except Exception:
-                            pass
                         yield {"type": "ai_response_chunk", "content": final_text}
                     yield {"type": "ai_response_end", "content": ""}
                 # 在结束后补发token用量（若可用）
@@ -639,5 +849,16 @@ class WebMCPAgent:
         """关闭连接"""
         try:
             await self.tools_manager.close()
-        except:
-            pass
+        except Exception as e:
+            print(f"⚠️ 关闭工具管理器失败: {e}")
+        self.mcp_client = None
+        if self.db_pool is not None:
+            try:
+                self.db_pool.close()
+            except Exception as e:
+                print(f"⚠️ 关闭数据库连接池失败: {e}")
+            self.db_pool = None
+        try:
+            await self.model_manager.aclose()
+        except Exception as e:
+            print(f"⚠️ 关闭模型连接池失败: {e}")
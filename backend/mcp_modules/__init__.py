@@ -6,10 +6,19 @@ from .config import MCPConfig
 from .multimodal import MultimodalProcessor
 from .model_manager import ModelManager
 from .message_processor import MessageProcessor
+from .cache import TTLCache
+from .response_cache import ResponseCache
+from .mysql_pool import MySQLPool
+from .log_filter import install_mcp_log_filter, suppress_mcp_logs
 
 __all__ = [
     'MCPConfig',
     'MultimodalProcessor', 
     'ModelManager',
-    'MessageProcessor'
+    'MessageProcessor',
+    'TTLCache',
+    'ResponseCache',
+    'MySQLPool',
+    'install_mcp_log_filter',
+    'suppress_mcp_logs'
 ]
@@ -0,0 +1,82 @@
+"""
+有界缓存模块
+"""
+
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Any, Callable, Hashable, Iterator, Optional, Tuple
+
+
+class TTLCache(MutableMapping):
+    """有界 LRU + TTL 映射
+
+    - 读写都会刷新条目的过期时间并移到队尾（按最近使用排序）；refresh_on_read=False 时
+      读取不续期，条目自写入起 ttl 秒后过期（适合作为只读接口的短时结果缓存）
+    - 超过 maxsize 时淘汰最久未使用的条目；过期条目在访问时顺带清理
+    - 因容量或过期被淘汰时调用 on_evict(key, value)（显式 del/pop 不触发）
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 3600.0,
+                 on_evict: Optional[Callable[[Hashable, Any], None]] = None,
+                 timer: Callable[[], float] = time.monotonic,
+                 refresh_on_read: bool = True):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.refresh_on_read = refresh_on_read
+        self.on_evict = on_evict
+        self._timer = timer
+        self._data: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+
+    def __getitem__(self, key):
+        value, expires_at = self._data[key]
+        now = self._timer()
+        if expires_at <= now:
+            self._evict(key)
+            raise KeyError(key)
+        if self.refresh_on_read:
+            self._data[key] = (value, now + self.ttl)
+            self._data.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = (value, self._timer() + self.ttl)
+        self._data.move_to_end(key)
+        self.expire()
+        while len(self._data) > self.maxsize:
+            self._evict(next(iter(self._data)))
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __contains__(self, key) -> bool:
+        item = self._data.get(key)
+        return item is not None and item[1] > self._timer()
+
+    def __iter__(self) -> Iterator:
+        self.expire()
+        return iter(list(self._data))
+
+    def __len__(self) -> int:
+        self.expire()
+        return len(self._data)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(maxsize={self.maxsize}, ttl={self.ttl}, size={len(self._data)})"
+
+    def expire(self):
+        """清理已过期条目（条目按过期时间有序，从队首开始检查即可）"""
+        now = self._timer()
+        while self._data:
+            key, (_, expires_at) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            self._evict(key)
+
+    def _evict(self, key):
+        value, _ = self._data.pop(key)
+        if self.on_evict is not None:
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                print(f"⚠️ 缓存淘汰回调异常: {e}")
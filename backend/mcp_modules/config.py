@@ -2,9 +2,12 @@
 MCP配置管理模块
 """
 
+import copy
 import json
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+
+import orjson
 
 
 class MCPConfig:
@@ -13,13 +16,24 @@ class MCPConfig:
     def __init__(self, config_file: str = "mcp.json"):
         self.config_file = config_file
         self.default_config = {}
+        # 已解析的配置及其对应的文件修改时间：文件未变化时不再重复读取和解析
+        self._cached: Optional[Dict[str, Any]] = None
+        self._mtime: Optional[int] = None
 
     def load_config(self) -> Dict[str, Any]:
-        """加载配置文件"""
-        if Path(self.config_file).exists():
+        """加载配置文件（按 mtime 缓存，返回副本，调用方修改不影响缓存）"""
+        path = Path(self.config_file)
+        try:
+            mtime = path.stat().st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime is not None:
+            if self._cached is not None and mtime == self._mtime:
+                return copy.deepcopy(self._cached)
             try:
-                with open(self.config_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                self._cached = orjson.loads(path.read_bytes())
+                self._mtime = mtime
+                return copy.deepcopy(self._cached)
             except Exception as e:
                 print(f"⚠️ 配置文件加载失败，使用默认配置: {e}")
 
@@ -32,5 +46,6 @@ class MCPConfig:
         try:
             with open(self.config_file, 'w', encoding='utf-8') as f:
                 json.dump(config, f, indent=2, ensure_ascii=False)
+            self._cached = None
         except Exception as e:
             print(f"❌ 配置文件保存失败: {e}")
@@ -0,0 +1,43 @@
+"""
+MCP 客户端日志抑制模块
+"""
+
+import contextvars
+import logging
+from contextlib import contextmanager
+
+# 当前上下文是否抑制 mcp 日志：按协程/任务隔离，并发会话互不影响（取代全局切换 logger 级别）
+_suppress_mcp = contextvars.ContextVar("suppress_mcp_logs", default=False)
+
+
+class _MCPLogFilter(logging.Filter):
+    """抑制标记为真时丢弃 mcp 日志（SSE 解析等噪声错误，不影响功能）"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return not _suppress_mcp.get()
+
+
+_FILTER = _MCPLogFilter()
+
+
+def install_mcp_log_filter():
+    """给 mcp 及其子 logger 挂上过滤器（可重复调用；logger 的过滤器不作用于子 logger 传播上来的记录，需逐个挂载）"""
+    names = ["mcp"] + [name for name in list(logging.root.manager.loggerDict) if name.startswith("mcp.")]
+    for name in names:
+        logger = logging.getLogger(name)
+        if _FILTER not in logger.filters:
+            logger.addFilter(_FILTER)
+
+
+@contextmanager
+def suppress_mcp_logs():
+    """在当前上下文内抑制 mcp 日志；其间创建的任务会继承该标记"""
+    token = _suppress_mcp.set(True)
+    try:
+        yield
+    finally:
+        try:
+            _suppress_mcp.reset(token)
+        except ValueError:
+            # 在其他上下文中收尾（如异步生成器被回收时）
+            _suppress_mcp.set(False)
@@ -3,7 +3,14 @@
 """
 
 from typing import List, Dict, Any, Optional
-from .multimodal import MultimodalProcessor
+from .multimodal import IMAGE_EXTS, MultimodalProcessor
+
+
+def _as_str(value: Any) -> str:
+    """附件字段转字符串：数据库中通常已是 str，直接返回，其余值再转换（空值为空串）"""
+    if isinstance(value, str):
+        return value
+    return str(value) if value else ''
 
 
 class MessageProcessor:
@@ -11,98 +18,218 @@ class MessageProcessor:
     
     def __init__(self, multimodal_processor: MultimodalProcessor, 
                  history_images_max_total: int = 6, 
-                 history_images_max_per_record: int = 3):
+                 history_images_max_per_record: int = 3,
+                 history_images_max_total_bytes: int = 8 * 1024 * 1024,
+                 history_max_messages: int = 40):
         self.multimodal = multimodal_processor
         self.history_images_max_total = history_images_max_total
         self.history_images_max_per_record = history_images_max_per_record
+        self.history_images_max_total_bytes = history_images_max_total_bytes
+        # 注入模型的历史消息条数上限（<= 0 表示不限制）
+        self.history_max_messages = history_max_messages
+
+    @staticmethod
+    def _image_url_cost(image_url: Any) -> int:
+        """估算一张历史图片在请求体中占用的字节数：延迟 dataURL 按 base64 后长度，其余按 URL 长度"""
+        size = getattr(image_url, "size", None)
+        if size is not None:
+            return (size + 2) // 3 * 4
+        return len(image_url)
+
+    def _convert_history_record(self, record: Dict[str, Any], with_images: bool) -> Dict[str, Any]:
+        """将单条历史记录转换为可复用的中间结果（每条最多 per_record 张历史图片；
+        dataURL 模式下为 LazyDataURL，发送前才编码）"""
+        attachments = record.get('attachments') or []
+        user_text = record.get('user_input') or ""
+
+        # 尝试将历史图片作为多模态注入
+        image_urls: List[Any] = []
+        if with_images and attachments:
+            max_per_record = self.history_images_max_per_record
+            build_url = self.multimodal.build_image_url_from_relative
+            try:
+                for att in attachments:
+                    if len(image_urls) >= max_per_record:
+                        break
+                    url = _as_str(att.get('url')).strip()
+                    if not url:
+                        continue
+                    # 内联 attachment_is_image 的扩展名判断（只看最后一段路径），省去逐个附件的方法调用
+                    stem, _, ext = (_as_str(att.get('filename')) or url).rpartition('/')[2].rpartition('.')
+                    if not stem or ('.' + ext.lower()) not in IMAGE_EXTS:
+                        continue
+                    # 构造图片可用URL（公网URL或延迟编码的dataURL）
+                    image_url = build_url(url, lazy=True)
+                    if not image_url:
+                        continue
+                    image_urls.append(image_url)
+            except Exception as _e:
+                try:
+                    print(f"⚠️ 注入历史图片失败，已跳过: {_e}")
+                except Exception:
+                    pass
+
+        # 无文本与图片时的回退：附上附件说明文本（保持向后兼容）
+        fallback_text = user_text
+        if attachments:
+            try:
+                # 一次遍历同时收集文件名与URL
+                names, urls = [], []
+                for a in attachments:
+                    if not a:
+                        continue
+                    names.append(_as_str(a.get('filename')))
+                    urls.append(_as_str(a.get('url')))
+                note = f"\n\n[Attachments]\nfilenames: {', '.join(names)}\nurls: {'; '.join(urls)}\nIf needed, use tool 'preview_uploaded_file' with the url string to preview content."
+                fallback_text = (fallback_text or '') + note
+            except Exception:
+                pass
+
+        # 回放历史中的工具结果（作为摘要文本，便于模型参考；不走函数调用协议）
+        tool_summary = None
+        mcp_results = record.get('mcp_results') or []
+        if mcp_results:
+            try:
+                snippets = (
+                    f"- {r.get('tool_name') or r.get('name') or 'tool'} => "
+                    f"{'OK' if r.get('success', True) else 'ERROR'}: {r.get('result') or r.get('error') or ''}"
+                    for r in (r or {} for r in mcp_results)
+                )
+                tool_summary = "[Previous tool results]\n" + "\n".join(snippets)
+            except Exception:
+                pass
+
+        return {
+            # 消息片段随记录缓存一次构建，之后每轮直接复用（下游只读，改写时会先复制）
+            "text_part": {"type": "text", "text": user_text} if isinstance(user_text, str) and user_text.strip() else None,
+            "with_images": with_images,
+            # (去重键, 字节开销, 图片片段)
+            "image_parts": [
+                (getattr(image_url, "rel_url", image_url), self._image_url_cost(image_url),
+                 {"type": "image_url", "image_url": {"url": image_url}})
+                for image_url in image_urls
+            ],
+            "fallback_text": fallback_text,
+            "tool_summary": tool_summary,
+            "ai_response": record.get('ai_response'),
+        }
+
+    @staticmethod
+    def mark_prompt_cache_breakpoints(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """为 Anthropic 式提示词缓存标记断点：系统提示，以及最后一条消息之前最近的一条用户消息。
+
+        返回新的消息列表，被标记的消息复制后改写，不修改共享历史。
+        """
+        def _mark(message: Dict[str, Any]) -> Dict[str, Any]:
+            content = message.get("content")
+            if isinstance(content, str):
+                blocks = [{"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}]
+            else:
+                blocks = [dict(part) if isinstance(part, dict) else part for part in content]
+                blocks[-1]["cache_control"] = {"type": "ephemeral"}
+            return {**message, "content": blocks}
+
+        def _markable(message: Dict[str, Any]) -> bool:
+            # 只标记 system/user：兼容层会把 assistant 的内容块重新整理，附加字段无法保留
+            if message.get("role") not in ("system", "user"):
+                return False
+            content = message.get("content")
+            if isinstance(content, list):
+                return bool(content) and isinstance(content[-1], dict)
+            return isinstance(content, str) and bool(content)
+
+        marked = list(messages)
+        if marked and marked[0].get("role") == "system" and _markable(marked[0]):
+            marked[0] = _mark(marked[0])
+        for idx in range(len(marked) - 2, 0, -1):
+            if _markable(marked[idx]):
+                marked[idx] = _mark(marked[idx])
+                break
+        return marked
 
     def build_shared_history(self, history: List[Dict[str, Any]], 
                            user_input, force_text_only: bool = False,
-                           conversation_files: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
-        """构建共享消息历史"""
+                           conversation_files: Optional[List[Dict[str, Any]]] = None,
+                           record_cache: Optional[Dict[Any, Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+        """构建共享消息历史
+
+        record_cache: 会话级的历史记录转换缓存（按记录 id），传入时已转换过的记录直接复用，
+        不再重复读取/编码历史图片；本次历史中已不存在的记录会被清理
+
+        历史部分最多注入 history_max_messages 条消息：从最新记录往前按整轮保留，
+        更早的记录整轮丢弃（不会拆开用户/助手消息，也不再为其读取/编码图片）
+        """
         shared_history: List[Dict[str, Any]] = []
+        append = shared_history.append
+        convert = self._convert_history_record
+        with_images = not force_text_only
+        max_total = self.history_images_max_total
+        max_total_bytes = self.history_images_max_total_bytes
         injected_images_total = 0
+        injected_bytes = 0
+        # 已注入的历史图片（按相对路径/URL）：同一张图在多条历史中出现时只发送一次，也不重复占用配额
+        attached_images = set()
+        seen_ids = set()
 
-        if history:
-            for record in history:
-                # 历史用户消息
-                try:
-                    attachments = record.get('attachments') or []
-                except Exception:
-                    attachments = []
-                user_text = record.get('user_input') or ""
-
-                # 尝试将历史图片作为多模态注入
-                content_parts: List[Any] = []
-                if isinstance(user_text, str) and user_text.strip():
-                    content_parts.append({"type": "text", "text": user_text})
-
-                if not force_text_only and attachments and injected_images_total < self.history_images_max_total:
-                    try:
-                        # 逐条记录内限制
-                        per_record = 0
-                        for att in attachments:
-                            if injected_images_total >= self.history_images_max_total:
-                                break
-                            if per_record >= self.history_images_max_per_record:
-                                break
-                            url = str(att.get('url') or '').strip()
-                            filename = str(att.get('filename') or '')
-                            if not url:
-                                continue
-                            if not self.multimodal.attachment_is_image(filename or url):
-                                continue
-                            # 构造图片可用URL（公网或dataURL）
-                            image_url = self.multimodal.build_image_url_from_relative(url)
-                            if not image_url:
-                                continue
-                            content_parts.append({"type": "image_url", "image_url": {"url": image_url}})
-                            per_record += 1
-                            injected_images_total += 1
-                    except Exception as _e:
-                        try:
-                            print(f"⚠️ 注入历史图片失败，已跳过: {_e}")
-                        except Exception:
-                            pass
-
-                # 若存在图片或文本，则以 parts 形式注入；否则退回到空串（避免传空对象）
-                if content_parts:
-                    shared_history.append({"role": "user", "content": content_parts})
-                else:
-                    # 保持向后兼容：无图片时，附上附件说明文本
-                    fallback_text = user_text
-                    if attachments:
-                        try:
-                            names = ", ".join([str(a.get('filename') or '') for a in attachments if a])
-                            urls = "; ".join([str(a.get('url') or '') for a in attachments if a])
-                            note = f"\n\n[Attachments]\nfilenames: {names}\nurls: {urls}\nIf needed, use tool 'preview_uploaded_file' with the url string to preview content."
-                            fallback_text = (fallback_text or '') + note
-                        except Exception:
-                            pass
-                    shared_history.append({"role": "user", "content": fallback_text})
-
-                # 回放历史中的工具结果（作为摘要文本，便于模型参考；不走函数调用协议）
-                try:
-                    mcp_results = record.get('mcp_results') or []
-                except Exception:
-                    mcp_results = []
-                if mcp_results:
-                    try:
-                        snippets = []
-                        for r in mcp_results:
-                            tool_name = str((r or {}).get('tool_name') or (r or {}).get('name') or 'tool')
-                            ok = (r or {}).get('success', True)
-                            res_text = str((r or {}).get('result') or (r or {}).get('error') or '')
-                            snippets.append(f"- {tool_name} => {'OK' if ok else 'ERROR'}: {res_text}")
-                        if snippets:
-                            summary_text = "[Previous tool results]\n" + "\n".join(snippets)
-                            shared_history.append({"role": "assistant", "content": summary_text})
-                    except Exception:
-                        pass
-
-                # 历史助手消息
-                if record.get('ai_response'):
-                    shared_history.append({"role": "assistant", "content": record['ai_response']})
+        entries: List[Dict[str, Any]] = []
+        remaining_messages = self.history_max_messages if self.history_max_messages > 0 else None
+        for record in reversed(history or []):
+            record_id = record.get('id')
+            entry = None
+            if record_cache is not None and record_id is not None:
+                entry = record_cache.get(record_id)
+                # 之前按纯文本转换过的记录，需要图片时重新转换
+                if entry is not None and with_images and not entry["with_images"]:
+                    entry = None
+            if entry is None:
+                entry = convert(record, with_images=with_images)
+                if record_cache is not None and record_id is not None:
+                    record_cache[record_id] = entry
+            if remaining_messages is not None:
+                message_count = 1 + bool(entry["tool_summary"]) + bool(entry["ai_response"])
+                if message_count > remaining_messages:
+                    break
+                remaining_messages -= message_count
+            if record_id is not None:
+                seen_ids.add(record_id)
+            entries.append(entry)
+
+        for entry in reversed(entries):
+            # 历史用户消息
+            content_parts: List[Any] = []
+            if entry["text_part"] is not None:
+                content_parts.append(entry["text_part"])
+            image_parts = entry["image_parts"]
+            if with_images and image_parts and injected_images_total < max_total:
+                for image_key, cost, image_part in image_parts:
+                    if injected_images_total >= max_total:
+                        break
+                    if image_key in attached_images:
+                        continue
+                    # 按字节预算限制：放不下的图片跳过，后续更小的图片仍可注入
+                    if injected_bytes + cost > max_total_bytes:
+                        continue
+                    injected_bytes += cost
+                    attached_images.add(image_key)
+                    content_parts.append(image_part)
+                    injected_images_total += 1
+
+            # 若存在图片或文本，则以 parts 形式注入；否则退回到附件说明文本（避免传空对象）
+            if content_parts:
+                append({"role": "user", "content": content_parts})
+            else:
+                append({"role": "user", "content": entry["fallback_text"]})
+
+            if entry["tool_summary"]:
+                append({"role": "assistant", "content": entry["tool_summary"]})
+
+            # 历史助手消息
+            if entry["ai_response"]:
+                append({"role": "assistant", "content": entry["ai_response"]})
+
+        if record_cache is not None:
+            for stale_id in [k for k in record_cache if k not in seen_ids]:
+                del record_cache[stale_id]
         
         if conversation_files:
             lines = ["[Conversation files]"]
@@ -3,10 +3,33 @@
 """
 
 import os
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
+
+import httpx
+import orjson
 from langchain_openai import ChatOpenAI
 
 
+class _OrjsonAsyncClient(httpx.AsyncClient):
+    """请求体用 orjson 序列化的 httpx 客户端。
+
+    多模态请求体中含数 MB 的 base64 图片字符串，标准库 json 编码较慢；SDK 以 json= 传入请求体时
+    改由 orjson 编码为 bytes（无法编码时回退到 httpx 默认行为），已自行序列化的请求不受影响。
+    """
+
+    def build_request(self, method, url, *, content=None, json=None, headers=None, **kwargs):
+        if json is not None and content is None:
+            try:
+                content = orjson.dumps(json)
+            except TypeError:
+                content = None
+            else:
+                json = None
+                headers = httpx.Headers(headers)
+                headers.setdefault("Content-Type", "application/json")
+        return super().build_request(method, url, content=content, json=json, headers=headers, **kwargs)
+
+
 class ModelManager:
     """模型档位管理器"""
     
@@ -15,7 +38,15 @@ class ModelManager:
         self.default_profile_id = os.getenv("LLM_DEFAULT", "default").strip() or "default"
         if self.default_profile_id not in self.llm_profiles:
             self.default_profile_id = "default"
-        self._llm_cache: Dict[str, Dict[str, Any]] = {}
+        # 档位来自环境变量，启动后不变：前端展示用的档位列表只计算一次
+        self._models_info = self._compute_models_info()
+        # 按 (档位, 工具名元组) 缓存实例集合：同一档位传入不同工具子集时各自绑定，互不覆盖
+        self._llm_cache: Dict[Tuple[str, Tuple[str, ...]], Dict[str, Any]] = {}
+        # 同一端点与参数只创建一个 ChatOpenAI，所有实例共用一个 HTTP 连接池（提高 keep-alive 复用）
+        self._chat_models: Dict[Tuple[Any, ...], ChatOpenAI] = {}
+        self._http_async_client: Optional[httpx.AsyncClient] = None
+        # 同步客户端同样共用一个（否则每个 ChatOpenAI 会各自创建一个同步连接池）
+        self._http_client: Optional[httpx.Client] = None
         
         # 数值配置，带默认
         try:
@@ -87,7 +118,10 @@ class ModelManager:
         return profiles
 
     def get_models_info(self) -> Dict[str, Any]:
-        """对外暴露的模型档位信息（用于前端展示）。"""
+        """对外暴露的模型档位信息（用于前端展示）；返回启动时计算好的同一对象，调用方只读。"""
+        return self._models_info
+
+    def _compute_models_info(self) -> Dict[str, Any]:
         profiles = self.llm_profiles or {}
         ids = list(profiles.keys())
         non_default_ids = [pid for pid in ids if pid != "default"]
@@ -106,6 +140,7 @@ class ModelManager:
         # - 若只有 default 一个档位，则显示它（旧版单模型场景）。
         show_ids = non_default_ids if non_default_ids else (["default"] if "default" in profiles else [])
 
+        # 不去重，允许同一 (base_url, model) 的多个档位同时显示
         models = []
         for pid in show_ids:
             cfg = profiles.get(pid, {})
@@ -134,46 +169,82 @@ class ModelManager:
         except Exception:
             return "unknown"
 
+    def get_prompt_cache_style(self, profile_id: Optional[str]) -> Optional[str]:
+        """判断档位可用的服务端提示词缓存方式：
+        - "anthropic"：Claude 系模型（直连或经兼容网关），需在消息内容块上标记 cache_control
+        - "openai"：OpenAI 官方接口，可传 prompt_cache_key 提高前缀缓存命中
+        - None：其他兼容接口，不附加任何字段（避免未知参数被拒绝）
+        """
+        pid = profile_id if profile_id in self.llm_profiles else self.default_profile_id
+        cfg = self.llm_profiles.get(pid, {})
+        model_name = str(cfg.get("model", self.model_name) or "").lower()
+        base_url = str(cfg.get("base_url") or os.getenv("OPENAI_BASE_URL", "") or "").lower()
+        if "claude" in model_name or "anthropic" in base_url:
+            return "anthropic"
+        if not base_url or "api.openai.com" in base_url:
+            return "openai"
+        return None
+
+    def get_chat_model(self, cfg: Dict[str, Any]) -> ChatOpenAI:
+        """按 (base_url, api_key, model, temperature, timeout) 复用 ChatOpenAI 实例"""
+        api_key = cfg.get("api_key") or os.getenv("OPENAI_API_KEY") or None
+        base_url = cfg.get("base_url") or os.getenv("OPENAI_BASE_URL") or None
+        model = cfg.get("model", self.model_name)
+        temperature = cfg.get("temperature", self.temperature)
+        timeout = cfg.get("timeout", self.timeout)
+        key = (base_url, api_key, model, temperature, timeout)
+        llm = self._chat_models.get(key)
+        if llm is None:
+            if self._http_async_client is None:
+                self._http_async_client = _OrjsonAsyncClient(
+                    limits=httpx.Limits(max_keepalive_connections=50, max_connections=100)
+                )
+            if self._http_client is None:
+                self._http_client = httpx.Client(
+                    limits=httpx.Limits(max_keepalive_connections=10, max_connections=20)
+                )
+            llm = ChatOpenAI(
+                model=model,
+                temperature=temperature,
+                timeout=timeout,
+                max_retries=3,
+                api_key=api_key,
+                base_url=base_url,
+                http_async_client=self._http_async_client,
+                http_client=self._http_client,
+            )
+            self._chat_models[key] = llm
+        return llm
+
+    async def aclose(self):
+        """释放共享的 HTTP 连接池"""
+        client, self._http_async_client = self._http_async_client, None
+        sync_client, self._http_client = self._http_client, None
+        self._chat_models.clear()
+        self._llm_cache.clear()
+        if sync_client is not None:
+            sync_client.close()
+        if client is not None:
+            await client.aclose()
+
     def get_or_create_llm_instances(self, profile_id: str, tools: list) -> Dict[str, Any]:
         """根据档位获取/创建对应的 LLM 实例集合：llm、llm_nontool、llm_tools。"""
         pid = profile_id or self.default_profile_id
         if pid not in self.llm_profiles:
             pid = self.default_profile_id
 
-        if pid in self._llm_cache:
-            return self._llm_cache[pid]
+        tools_key = tuple(str(getattr(t, "name", None) or id(t)) for t in tools or [])
+        cache_key = (pid, tools_key)
+        bundle = self._llm_cache.get(cache_key)
+        if bundle is not None:
+            return bundle
 
         cfg = self.llm_profiles[pid]
-
-        # 临时切换环境变量，构造实例
-        prev_key = os.getenv("OPENAI_API_KEY")
-        prev_base = os.getenv("OPENAI_BASE_URL")
-        try:
-            if cfg.get("api_key"):
-                os.environ["OPENAI_API_KEY"] = cfg["api_key"]
-            if cfg.get("base_url"):
-                os.environ["OPENAI_BASE_URL"] = cfg["base_url"]
-
-            base_llm = ChatOpenAI(
-                model=cfg.get("model", self.model_name),
-                temperature=cfg.get("temperature", self.temperature),
-                timeout=cfg.get("timeout", self.timeout),
-                max_retries=3,
-            )
-            llm_nontool = ChatOpenAI(
-                model=cfg.get("model", self.model_name),
-                temperature=cfg.get("temperature", self.temperature),
-                timeout=cfg.get("timeout", self.timeout),
-                max_retries=3,
-            )
-            llm_tools = base_llm.bind_tools(tools)
-        finally:
-            # 还原环境，避免影响其他逻辑
-            if prev_key is not None:
-                os.environ["OPENAI_API_KEY"] = prev_key
-            if prev_base is not None:
-                os.environ["OPENAI_BASE_URL"] = prev_base
+        # 基础实例由 get_chat_model 按参数复用，不同工具集合之间共享；无工具实例与基础实例参数相同，直接共用
+        base_llm = self.get_chat_model(cfg)
+        llm_nontool = base_llm
+        llm_tools = base_llm.bind_tools(tools)
 
         bundle = {"llm": base_llm, "llm_nontool": llm_nontool, "llm_tools": llm_tools}
-        self._llm_cache[pid] = bundle
+        self._llm_cache[cache_key] = bundle
         return bundle
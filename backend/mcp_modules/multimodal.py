@@ -3,11 +3,156 @@
 """
 
 import os
-import base64
+import binascii
 import mimetypes
-from pathlib import Path
+import re
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import List, Dict, Any, Optional
 
+# base64 编码优先使用 pybase64（SIMD 加速，直接返回 str），未安装时回退到标准库
+# （binascii 直接编码，省去 base64.b64encode 的参数处理与换行处理）
+try:
+    import pybase64
+
+    def _b64encode_str(data: bytes) -> str:
+        return pybase64.b64encode_as_string(data)
+except ImportError:
+    def _b64encode_str(data: bytes) -> str:
+        return binascii.b2a_base64(data, newline=False).decode("ascii")
+
+
+# 多模态格式不支持时服务端报错中的特征片段（预编译为单个正则，一次扫描完成匹配）
+_MULTIMODAL_ERROR_RE = re.compile(
+    "|".join(map(re.escape, (
+        "failed to deserialize",
+        "chatcompletionrequestcontent",
+        "data did not match any variant",
+        "untagged enum",
+        "invalid content format",
+        "unsupported message format",
+    ))),
+    re.IGNORECASE,
+)
+
+IMAGE_EXTS = frozenset({
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".tif", ".tiff"
+})
+
+
+@lru_cache(maxsize=4096)
+def _is_image_name(name_or_url: str) -> bool:
+    # 只看最后一段路径的扩展名；同一附件名/URL 在多轮之间反复出现，结果按原串缓存
+    name = name_or_url.rpartition("/")[2]
+    stem, dot, ext = name.rpartition(".")
+    if not dot or not stem:
+        return False
+    return ("." + ext.lower()) in IMAGE_EXTS
+
+
+# 历史图片相对路径的基准目录（backend 目录），模块加载时解析一次
+_UPLOADS_BASE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 按扩展名缓存推断出的 MIME 类型
+_MIME_BY_SUFFIX: Dict[str, str] = {}
+
+
+def _guess_image_mime(path_str: str) -> str:
+    suffix = os.path.splitext(path_str)[1].lower()
+    mime = _MIME_BY_SUFFIX.get(suffix)
+    if mime is None:
+        mime, _ = mimetypes.guess_type(f"x{suffix}")
+        if not mime or not mime.startswith("image/"):
+            # 基于扩展名的兜底
+            ext = suffix.lstrip('.')
+            mime = f"image/{ext}" if ext else "image/jpeg"
+        _MIME_BY_SUFFIX[suffix] = mime
+    return mime
+
+
+@lru_cache(maxsize=64)
+def _encode_data_url(path_str: str, mtime_ns: int, size: int, mime: str) -> str:
+    """读取图片并编码为 dataURL；以 (路径, mtime, 大小) 为键，同一图片在多轮/多会话间只编码一次。
+    单个条目最大约 2MB×4/3，条目数有上限，进程常驻时内存可控。"""
+    with open(path_str, "rb") as f:
+        data = f.read()
+    encoded = _b64encode_str(data)
+    # 原始数据在拼接前释放，峰值内存只保留编码结果与最终字符串两份
+    del data
+    return "data:" + mime + ";base64," + encoded
+
+
+# 多张历史图片并行读取与编码（文件读取与 pybase64/binascii 编码期间释放 GIL）；首次使用时创建
+_encode_executor: Optional[ThreadPoolExecutor] = None
+_encode_executor_lock = threading.Lock()
+
+
+def _get_encode_executor() -> ThreadPoolExecutor:
+    global _encode_executor
+    if _encode_executor is None:
+        with _encode_executor_lock:
+            if _encode_executor is None:
+                _encode_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="history-image")
+    return _encode_executor
+
+
+class LazyDataURL:
+    """延迟生成的历史图片 dataURL：构建历史时只记录文件信息，真正发送给模型前才读取并编码。
+
+    - 超出图片配额、被裁剪或回退为纯文本的历史图片不会被编码
+    - cache_token 由相对路径与文件 mtime/大小组成，用于回答缓存键，避免为计算键而编码图片
+    """
+
+    __slots__ = ("rel_url", "path_str", "mtime_ns", "size", "mime")
+
+    def __init__(self, rel_url: str, path_str: str, mtime_ns: int, size: int, mime: str):
+        self.rel_url = rel_url
+        self.path_str = path_str
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.mime = mime
+
+    @property
+    def cache_token(self) -> str:
+        return f"{self.rel_url}#{self.mtime_ns}:{self.size}"
+
+    def materialize(self) -> Optional[str]:
+        try:
+            return _encode_data_url(self.path_str, self.mtime_ns, self.size, self.mime)
+        except Exception as _e:
+            try:
+                print(f"⚠️ 构建历史图片URL失败: {_e}")
+            except Exception:
+                pass
+            return None
+
+    def __repr__(self) -> str:
+        return f"LazyDataURL({self.rel_url!r})"
+
+
+def _collect_text_part(part: Dict[str, Any], text_parts: List[str], image_names: List[str]):
+    text_parts.append(part.get("text", ""))
+
+
+def _collect_image_part(part: Dict[str, Any], text_parts: List[str], image_names: List[str]):
+    # 尝试从URL推断文件名
+    url = part.get("image_url", {}).get("url", "")
+    if isinstance(url, LazyDataURL):
+        url = url.rel_url
+    if isinstance(url, str) and "/uploads/" in url:
+        image_names.append(url.rpartition("/")[2])
+    else:
+        image_names.append(f"image_{len(image_names) + 1}")
+
+
+# 多模态转纯文本时按片段类型分派的处理函数
+_TEXT_FALLBACK_HANDLERS = {
+    "text": _collect_text_part,
+    "image_url": _collect_image_part,
+}
+
 
 class MultimodalProcessor:
     """多模态消息处理器"""
@@ -17,21 +162,16 @@ class MultimodalProcessor:
         self.history_image_max_file_bytes = history_image_max_file_bytes
     
     def attachment_is_image(self, name_or_url: str) -> bool:
-        """基于扩展名的简单判断（不读取文件）。"""
+        """基于扩展名的简单判断（不读取文件）；MessageProcessor 构建历史时内联了同样的判断。"""
         try:
-            suffix = (Path(name_or_url).suffix or "").lower()
-            if not suffix:
-                return False
-            image_exts = {
-                ".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".tif", ".tiff"
-            }
-            return suffix in image_exts
+            return _is_image_name(name_or_url)
         except Exception:
             return False
 
-    def build_image_url_from_relative(self, rel_url: str) -> Optional[str]:
+    def build_image_url_from_relative(self, rel_url: str, lazy: bool = False) -> Optional[Any]:
         """将数据库里 '/uploads/...' 的相对路径转为模型可用URL。
         优先使用 PUBLIC_BASE_URL 直接拼接；否则读取本地文件并转为 dataURL（受大小限制）。
+        lazy=True 时 dataURL 模式只检查文件，返回 LazyDataURL，由 materialize_image_urls 在发送前编码。
         """
         try:
             if not isinstance(rel_url, str) or not rel_url.strip():
@@ -46,25 +186,20 @@ class MultimodalProcessor:
 
             # 2) dataURL模式（读取本地 uploads 文件）
             # 绝对路径：backend 目录为基准
-            abs_path = Path(__file__).parent.parent / rel.lstrip("/")
-            if not abs_path.exists() or not abs_path.is_file():
+            abs_path = os.path.join(_UPLOADS_BASE, rel.lstrip("/"))
+            try:
+                st = os.stat(abs_path)
+            except OSError:
+                return None
+            if not stat.S_ISREG(st.st_mode):
                 return None
-            file_size = abs_path.stat().st_size
-            if file_size > max(0, int(self.history_image_max_file_bytes or 0)):
+            if st.st_size > max(0, int(self.history_image_max_file_bytes or 0)):
                 return None
 
-            mime, _ = mimetypes.guess_type(str(abs_path))
-            if not mime or not mime.startswith("image/"):
-                # 基于扩展名的兜底
-                ext = (abs_path.suffix or '').lower().lstrip('.')
-                if ext:
-                    mime = f"image/{ext}"
-                else:
-                    mime = "image/jpeg"
-
-            data = abs_path.read_bytes()
-            b64 = base64.b64encode(data).decode("ascii")
-            return f"data:{mime};base64,{b64}"
+            mime = _guess_image_mime(abs_path)
+            if lazy:
+                return LazyDataURL(rel, abs_path, st.st_mtime_ns, st.st_size, mime)
+            return _encode_data_url(abs_path, st.st_mtime_ns, st.st_size, mime)
         except Exception as _e:
             try:
                 print(f"⚠️ 构建历史图片URL失败: {_e}")
@@ -83,29 +218,18 @@ class MultimodalProcessor:
             content = msg.get("content")
             if isinstance(content, list):
                 # 提取文本部分和图片信息
-                text_parts = []
-                image_count = 0
-                image_names = []
-                
+                text_parts: List[str] = []
+                image_names: List[str] = []
+                handlers = _TEXT_FALLBACK_HANDLERS
                 for part in content:
                     if isinstance(part, dict):
-                        if part.get("type") == "text":
-                            text_parts.append(part.get("text", ""))
-                        elif part.get("type") == "image_url":
-                            image_count += 1
-                            # 尝试从URL推断文件名
-                            url = part.get("image_url", {}).get("url", "")
-                            if "/uploads/" in url:
-                                try:
-                                    filename = url.split("/")[-1]
-                                    image_names.append(filename)
-                                except:
-                                    image_names.append(f"image_{image_count}")
-                            else:
-                                image_names.append(f"image_{image_count}")
+                        handler = handlers.get(part.get("type"))
+                        if handler is not None:
+                            handler(part, text_parts, image_names)
                 
                 # 构建纯文本内容
                 final_text = " ".join(text_parts).strip()
+                image_count = len(image_names)
                 if image_count > 0:
                     image_info = f"\n\n[注意: 上传了 {image_count} 张图片: {', '.join(image_names)}，但当前模型不支持图片识别，已忽略图片内容]"
                     final_text = (final_text + image_info).strip()
@@ -116,18 +240,56 @@ class MultimodalProcessor:
         
         return converted_messages
 
+    @staticmethod
+    def materialize_image_urls(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """将消息中的 LazyDataURL 编码为 dataURL 字符串（发送给模型前调用）。
+
+        返回新的消息列表，只复制含延迟图片的消息，不修改共享历史；编码失败的图片片段被丢弃。
+        多张图片时提交到共享线程池并行读取与编码。
+        """
+        def _lazy_url(part: Any) -> Optional[LazyDataURL]:
+            if not isinstance(part, dict):
+                return None
+            url = (part.get("image_url") or {}).get("url")
+            return url if isinstance(url, LazyDataURL) else None
+
+        lazy_urls: List[LazyDataURL] = []
+        lazy_indexes: List[int] = []
+        for idx, msg in enumerate(messages):
+            content = msg.get("content")
+            if not isinstance(content, list):
+                continue
+            found = [url for url in map(_lazy_url, content) if url is not None]
+            if found:
+                lazy_urls.extend(found)
+                lazy_indexes.append(idx)
+        if not lazy_urls:
+            return messages
+
+        if len(lazy_urls) > 1:
+            encoded = list(_get_encode_executor().map(LazyDataURL.materialize, lazy_urls))
+        else:
+            encoded = [lazy_urls[0].materialize()]
+        data_urls = {id(url): data_url for url, data_url in zip(lazy_urls, encoded)}
+
+        materialized = list(messages)
+        for idx in lazy_indexes:
+            msg = messages[idx]
+            parts = []
+            for part in msg["content"]:
+                url = _lazy_url(part)
+                if url is not None:
+                    data_url = data_urls.get(id(url))
+                    if not data_url:
+                        continue
+                    part = {**part, "image_url": {**part["image_url"], "url": data_url}}
+                parts.append(part)
+            materialized[idx] = {**msg, "content": parts or ""}
+        return materialized
+
     @staticmethod
     def is_multimodal_error(error_str: str) -> bool:
         """判断是否为多模态格式不支持的错误"""
         if not isinstance(error_str, str):
             return False
-        error_lower = error_str.lower()
-        indicators = [
-            "failed to deserialize",
-            "chatcompletionrequestcontent",
-            "data did not match any variant",
-            "untagged enum",
-            "invalid content format",
-            "unsupported message format"
-        ]
-        return any(indicator in error_lower for indicator in indicators)
+        return _MULTIMODAL_ERROR_RE.search(error_str) is not None
@@ -0,0 +1,110 @@
+"""
+MySQL 连接池模块
+"""
+
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+import pymysql
+import pymysql.cursors
+
+
+class MySQLPool:
+    """线程安全的 PyMySQL 连接池（本地工具同步执行于线程池中）
+
+    - 最多同时借出 maxsize 个连接，超出时等待 acquire_timeout 秒
+    - 连接开启 autocommit，复用时不会读到旧事务快照；空闲超过 ping_interval 秒的连接借出前先 ping（必要时重连）
+    - 使用中抛出异常的连接直接关闭丢弃，不放回池中
+    """
+
+    def __init__(self, *, host: str, user: str, password: str, database: str, port: int = 3306,
+                 maxsize: int = 25, acquire_timeout: float = 30.0, ping_interval: float = 30.0,
+                 **connect_kwargs: Any):
+        self.maxsize = max(1, maxsize)
+        self.acquire_timeout = acquire_timeout
+        self.ping_interval = ping_interval
+        self._connect_kwargs = dict(
+            host=host,
+            user=user,
+            password=password,
+            database=database,
+            port=port,
+            charset='utf8mb4',
+            cursorclass=pymysql.cursors.DictCursor,
+            autocommit=True,
+        )
+        self._connect_kwargs.update(connect_kwargs)
+        self._idle: "queue.LifoQueue" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.maxsize)
+        self._closed = False
+
+    @contextmanager
+    def connection(self) -> Iterator[pymysql.connections.Connection]:
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise TimeoutError("MySQL connection pool exhausted")
+        conn = None
+        try:
+            conn = self._checkout()
+            yield conn
+        except BaseException:
+            self._discard(conn)
+            conn = None
+            raise
+        finally:
+            if conn is not None:
+                if self._closed:
+                    self._discard(conn)
+                else:
+                    self._idle.put((conn, time.monotonic()))
+            self._slots.release()
+
+    def prefill(self, count: int) -> int:
+        """预先建立最多 count 个空闲连接（不超过 maxsize），首批工具调用无需等待握手；返回实际建立的数量"""
+        created = 0
+        for _ in range(max(0, min(count, self.maxsize) - self._idle.qsize())):
+            if self._closed:
+                break
+            try:
+                conn = pymysql.connect(**self._connect_kwargs)
+            except Exception as e:
+                print(f"⚠️ MySQL 连接池预热失败: {e}")
+                break
+            self._idle.put((conn, time.monotonic()))
+            created += 1
+        return created
+
+    def _checkout(self) -> pymysql.connections.Connection:
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return pymysql.connect(**self._connect_kwargs)
+            if time.monotonic() - last_used < self.ping_interval:
+                return conn
+            try:
+                conn.ping(reconnect=True)
+                return conn
+            except Exception:
+                self._discard(conn)
+
+    @staticmethod
+    def _discard(conn: Optional[pymysql.connections.Connection]):
+        if conn is None:
+            return
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """关闭所有空闲连接；仍在使用中的连接归还时关闭"""
+        self._closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
@@ -0,0 +1,52 @@
+"""
+对话回答缓存模块
+"""
+
+import hashlib
+from typing import Any, Dict, List, Optional
+
+import orjson
+
+from .cache import TTLCache
+
+
+def _key_default(obj: Any) -> str:
+    # 延迟编码的图片（LazyDataURL）按文件标识参与键计算，不为算键而编码图片
+    token = getattr(obj, "cache_token", None)
+    return token if isinstance(token, str) else str(obj)
+
+
+class ResponseCache:
+    """精确匹配的回答缓存（进程内，有界 LRU + TTL）
+
+    - 键由调用方给出的各组成部分（模型档位、上下文、本轮输入等）规范化序列化后做 blake2b 摘要
+    - 值为最终回答文本及可选的 token 用量；自写入起 ttl 秒后过期，读取不续期
+    """
+
+    def __init__(self, maxsize: int = 512, ttl: float = 3600.0):
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl, refresh_on_read=False)
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = orjson.dumps(part, default=_key_default, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+            digest.update(part)
+            digest.update(b"\x1f")
+        return digest.hexdigest()
+
+    def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._entries.get(key)
+
+    def update(self, key: str, text: str, usage: Optional[Dict[str, Any]] = None,
+               tool_calls: Optional[List[Any]] = None):
+        if not text:
+            return
+        self._entries[key] = {"text": text, "usage": usage, "tool_calls": tool_calls}
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
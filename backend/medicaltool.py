@@ -1,16 +1,196 @@
+import copy
 import re
-import json
-from typing import Any, Dict, List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
 from pathlib import Path
 
-import pymysql
+import orjson
+import pymysql.cursors
+
+from mcp_modules.cache import TTLCache
+from mcp_modules.mysql_pool import MySQLPool
 from langchain_core.tools import StructuredTool
 from pydantic import BaseModel, Field
-from datetime import datetime, timedelta, date
+from functools import lru_cache
 from sqlglot import exp, parse_one
 from sqlglot.errors import ParseError
 
 
+# medical_query 每次调用都会用到的正则，模块加载时编译一次
+_WS_RE = re.compile(r"\s+")
+_DESCRIBE_RE = re.compile(r"(?:show columns from|describe)\s+([`\w\.]+)", re.IGNORECASE)
+
+# patient_count_stats 的分布维度：(结果键, patient_adsl 列名, 结果行中的取值字段名)
+_PATIENT_STAT_DIMENSIONS = (
+    ("sex_distribution", "sex", "sex"),
+    ("age_group_distribution", "agegr1", "age_group"),
+    ("treatment_distribution", "trt01p", "treatment"),
+    ("race_distribution", "race", "race"),
+    ("study_status_distribution", "eosstt", "study_status"),
+    ("bmi_distribution", "bmiblgr1", "bmi_group"),
+    ("site_distribution", "siteid", "site_id"),
+    ("discontinuation_distribution", "dcsreas", "discontinuation_reason"),
+    ("region_distribution", "strat1g", "region"),
+    ("ecog_distribution", "ecogbl", "ecog_score"),
+)
+
+
+def _build_patient_stats_sql() -> str:
+    """CTE 取出当前 msid 的病人行（只扫描一次），各维度分组结果与汇总行 UNION ALL 合并。
+    每个维度的取值放在各自的 v<i> 列中（其余分支为 NULL），以保留原列类型；汇总行 dim 为 -1。"""
+    value_cols = [f"v{idx}" for idx in range(len(_PATIENT_STAT_DIMENSIONS))]
+    branches = []
+    for idx, (_, column, _) in enumerate(_PATIENT_STAT_DIMENSIONS):
+        values = ", ".join(f"{column if pos == idx else 'NULL'} AS {name}" for pos, name in enumerate(value_cols))
+        branches.append(
+            f"SELECT {idx} AS dim, {values}, COUNT(DISTINCT usubjid) AS cnt, "
+            f"NULL AS avg_age, NULL AS min_age, NULL AS max_age "
+            f"FROM base WHERE {column} IS NOT NULL GROUP BY {column}"
+        )
+    nulls = ", ".join(f"NULL AS {name}" for name in value_cols)
+    branches.append(
+        f"SELECT -1 AS dim, {nulls}, COUNT(DISTINCT usubjid) AS cnt, "
+        f"AVG(age) AS avg_age, MIN(age) AS min_age, MAX(age) AS max_age FROM base"
+    )
+    columns = ", ".join(["usubjid", "age"] + [column for _, column, _ in _PATIENT_STAT_DIMENSIONS])
+    return f"WITH base AS (SELECT {columns} FROM patient_adsl WHERE msid = %s) " + " UNION ALL ".join(branches)
+
+
+_PATIENT_STATS_SQL = _build_patient_stats_sql()
+
+# sql/patient_date_columns.sql 中增加的日期生成列 (表名, 列名)
+_PATIENT_DATE_COLUMNS = (
+    ("patient_ae", "aestdtc_d"),
+    ("patient_cm", "cmstdtc_d"),
+    ("patient_cm", "cmendtc_d"),
+    ("patient_ex", "exstdtc_d"),
+    ("patient_ex", "exendtc_d"),
+)
+
+
+# descripttables 的样例行数，以及按 RAND() < 比例 抽样时期望命中的行数（留足余量，命中不足再回退）
+_SAMPLE_ROWS = 4
+_SAMPLE_TARGET_HITS = 40.0
+
+
+# adverse_event_analysis 的天数窗口上限：每一天对应天偏移表中的一个 UNION ALL 分支
+_AE_MAX_DAYS_BEFORE = 365
+
+
+# 结果随时间/调用变化的函数：含这些函数的查询不缓存结果
+_VOLATILE_SQL_FUNCS = frozenset({
+    "NOW", "SYSDATE", "CURDATE", "CURTIME", "CURRENT_DATE", "CURRENT_TIME", "CURRENT_TIMESTAMP",
+    "CURRENT_DATETIME", "LOCALTIME", "LOCALTIMESTAMP", "UTC_DATE", "UTC_TIME", "UTC_TIMESTAMP",
+    "UNIX_TIMESTAMP", "RAND", "UUID", "UUID_SHORT", "CONNECTION_ID", "LAST_INSERT_ID",
+    "FOUND_ROWS", "ROW_COUNT", "SLEEP",
+})
+
+
+def _is_volatile_func(func: exp.Func) -> bool:
+    name = func.name if isinstance(func, exp.Anonymous) else func.sql_name()
+    return str(name).upper() in _VOLATILE_SQL_FUNCS
+
+
+# adverse_event_analysis 中合并用药/试验药物两条统计查询互不依赖，用独立连接并发执行
+_medication_executor: Optional[ThreadPoolExecutor] = None
+_medication_executor_lock = threading.Lock()
+
+
+def _get_medication_executor() -> ThreadPoolExecutor:
+    global _medication_executor
+    if _medication_executor is None:
+        with _medication_executor_lock:
+            if _medication_executor is None:
+                _medication_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ae-medication")
+    return _medication_executor
+
+
+# patient_count_stats 结果：队列分布只在数据重新导入后变化，按 (库名, msid) 缓存 600 秒；
+# 数据导入后可调用 invalidate_patient_stats 立即失效
+_patient_stats_cache: TTLCache = TTLCache(maxsize=256, ttl=600, refresh_on_read=False)
+_patient_stats_lock = threading.Lock()
+
+
+def invalidate_patient_stats(msid: Any = None) -> None:
+    """Drop cached patient_count_stats results for one msid, or all of them when msid is None."""
+    with _patient_stats_lock:
+        if msid is None:
+            _patient_stats_cache.clear()
+            return
+        for key in [k for k in _patient_stats_cache if k[1] == msid]:
+            _patient_stats_cache.pop(key, None)
+
+
+# showtables / descripttables 的输出几乎不变，每次 agent 步骤却都可能调用：
+# 有数据的表列表按 (库名, msid) 缓存 300 秒，表结构按 (库名, 表名) 缓存 600 秒，
+# 样例行按 (库名, msid, 表名) 只缓存 60 秒，保持抽样的新鲜度
+_msid_tables_cache: TTLCache = TTLCache(maxsize=256, ttl=300, refresh_on_read=False)
+_table_schema_cache: TTLCache = TTLCache(maxsize=256, ttl=600, refresh_on_read=False)
+_sample_rows_cache: TTLCache = TTLCache(maxsize=256, ttl=60, refresh_on_read=False)
+_tool_cache_lock = threading.Lock()
+
+
+# 含 msid 列的表集合、日期生成列是否齐全都很少变化：按库名缓存 300 秒；
+# 表结构变更（如执行 sql/patient_date_columns.sql）后可调用 invalidate_schema_cache 立即失效
+_SCHEMA_TTL = 300.0
+_schema_cache: Dict[str, Tuple[float, FrozenSet[str], FrozenSet[str]]] = {}
+_date_columns_cache: Dict[str, Tuple[float, bool]] = {}
+
+
+def invalidate_schema_cache(db_name: Optional[str] = None) -> None:
+    """Drop cached allowed-table sets and date-column readiness for one database, or all of them when db_name is None."""
+    for cache in (_schema_cache, _date_columns_cache):
+        if db_name is None:
+            cache.clear()
+        else:
+            cache.pop(db_name, None)
+
+
+def clear_tool_caches() -> None:
+    """Drop cached schema metadata, table listings, table schemas, sample rows and patient stats (e.g. after a data reload)."""
+    invalidate_schema_cache()
+    with _tool_cache_lock:
+        _msid_tables_cache.clear()
+        _table_schema_cache.clear()
+        _sample_rows_cache.clear()
+    invalidate_patient_stats()
+
+
+# table_descriptions.json 解析结果常驻进程，文件 (mtime, size) 变化时才重新加载
+_TABLE_DESCRIPTIONS_PATH = Path(__file__).parent / "table_descriptions.json"
+_table_descriptions_cache: Dict[str, Any] = {"stamp": None, "data": {}}
+_table_descriptions_lock = threading.Lock()
+
+
+def _load_table_descriptions() -> Dict[str, str]:
+    try:
+        st = _TABLE_DESCRIPTIONS_PATH.stat()
+        stamp = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        stamp = None
+    with _table_descriptions_lock:
+        if stamp == _table_descriptions_cache["stamp"]:
+            return _table_descriptions_cache["data"]
+        data: Dict[str, str] = {}
+        if stamp is not None:
+            try:
+                data = orjson.loads(_TABLE_DESCRIPTIONS_PATH.read_bytes())
+            except Exception:
+                # 如果加载失败，使用空字典
+                data = {}
+        _table_descriptions_cache["stamp"] = stamp
+        _table_descriptions_cache["data"] = data
+        return data
+
+
+@lru_cache(maxsize=1024)
+def _parse_sql_cached(sql_text: str) -> exp.Expression:
+    # 同一 SQL 在多轮对话中经常重复出现，解析结果按原文缓存；调用方须 copy() 后再改写
+    return parse_one(sql_text, read="mysql")
+
+
 def create_medical_tools(
     *,
     db_host: str,
@@ -19,60 +199,123 @@ def create_medical_tools(
     db_name: str,
     db_port: int,
     session_contexts: Dict[str, Dict[str, Any]],
-    current_session_id_ctx,
+    get_current_session_id: Callable[[], Optional[str]],
     llm_nontool,
+    db_pool: Optional[MySQLPool] = None,
 ) -> List[StructuredTool]:
     """Create local medical data tools.
 
     Args:
     - db_host/db_user/db_password/db_name/db_port: database connection configs
     - session_contexts: session context map keyed by session_id
-    - current_session_id_ctx: contextvars.ContextVar for current session id
+    - get_current_session_id: callable returning the current session id
     - llm_nontool: reserved (no longer used)
+    - db_pool: shared MySQL connection pool; created from the configs above when omitted
     """
-
-    def _fetch_allowed_tables() -> set:
+    if db_pool is None:
+        db_pool = MySQLPool(host=db_host, user=db_user, password=db_password, database=db_name, port=db_port)
+
+    # medical_query 结果短时缓存：键为 (msid, 规范化后的最终 SQL, 参数)，60 秒过期且读取不续期；
+    # 工具在线程池中并发执行，读写加锁
+    query_result_cache: TTLCache = TTLCache(maxsize=512, ttl=60, refresh_on_read=False)
+    query_result_lock = threading.Lock()
+
+    # descripttables 抽样用的 (msid, 表名) -> 行数，只用于估算抽样比例，缓存 300 秒
+    sample_count_cache: TTLCache = TTLCache(maxsize=256, ttl=300, refresh_on_read=False)
+    sample_count_lock = threading.Lock()
+
+    # 含 msid 列的表集合缓存在模块级 _schema_cache 中（同时缓存小写形式供匹配）
+    def _load_allowed_tables() -> Tuple[FrozenSet[str], FrozenSet[str]]:
+        entry = _schema_cache.get(db_name)
+        now = time.monotonic()
+        if entry is not None and now - entry[0] < _SCHEMA_TTL:
+            return entry[1], entry[2]
+        # 元数据中的列名比较本身不区分大小写，直接等值匹配即可走数据字典索引；
+        # 同一张表不会有两个 msid 列，结果无需 GROUP BY 去重
         allowed = set()
-        conn = pymysql.connect(
-            host=db_host,
-            user=db_user,
-            password=db_password,
-            database=db_name,
-            port=db_port,
-            charset='utf8mb4',
-            cursorclass=pymysql.cursors.DictCursor,
-        )
-        with conn:
+        with db_pool.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute(
-                    "SELECT TABLE_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA = %s AND LOWER(COLUMN_NAME) = 'msid' GROUP BY TABLE_NAME",
+                    "SELECT TABLE_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA = %s AND COLUMN_NAME = 'msid'",
                     (db_name,),
                 )
                 for row in cur.fetchall():
                     allowed.add(row["TABLE_NAME"])
-        return allowed
+        tables = frozenset(allowed)
+        lookup = frozenset(t.lower() for t in tables)
+        _schema_cache[db_name] = (now, tables, lookup)
+        return tables, lookup
+
+    def _fetch_allowed_tables() -> FrozenSet[str]:
+        return _load_allowed_tables()[0]
+
+    # sql/patient_date_columns.sql 迁移增加的 DATE 生成列；齐全时不良事件分析直接使用（可走索引），
+    # 否则回退到查询时 STR_TO_DATE。检测结果与表集合同样缓存（模块级 _date_columns_cache）
+    def _date_columns_ready() -> bool:
+        entry = _date_columns_cache.get(db_name)
+        now = time.monotonic()
+        if entry is not None and now - entry[0] < _SCHEMA_TTL:
+            return entry[1]
+        placeholders = ", ".join(["(%s, %s)"] * len(_PATIENT_DATE_COLUMNS))
+        params: List[Any] = [db_name]
+        for table_col in _PATIENT_DATE_COLUMNS:
+            params.extend(table_col)
+        try:
+            with db_pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT COUNT(*) AS n FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA = %s "
+                        f"AND (TABLE_NAME, COLUMN_NAME) IN ({placeholders})",
+                        params,
+                    )
+                    row = cur.fetchone()
+            ready = bool(row) and int(row["n"]) == len(_PATIENT_DATE_COLUMNS)
+        except Exception:
+            ready = False
+        _date_columns_cache[db_name] = (now, ready)
+        return ready
 
     def _list_tables_with_current_msid() -> List[str]:
         """Return table names (having msid column) that contain rows for current msid."""
-        session_id = current_session_id_ctx.get()
+        session_id = get_current_session_id()
         ctx = session_contexts.get(session_id) or {}
         msid_value = ctx.get("msid")
         if msid_value is None:
             raise ValueError("Missing access scope, query denied.")
 
-        all_allowed_tables = _fetch_allowed_tables()
+        tables_key = (db_name, msid_value)
+        with _tool_cache_lock:
+            cached_tables = _msid_tables_cache.get(tables_key)
+        if cached_tables is not None:
+            return list(cached_tables)
+        tables = _probe_tables_with_msid(msid_value)
+        with _tool_cache_lock:
+            _msid_tables_cache[tables_key] = tuple(tables)
+        return tables
+
+    def _probe_tables_with_msid(msid_value: Any) -> List[str]:
+        all_allowed_tables = sorted(_fetch_allowed_tables())
+        if not all_allowed_tables:
+            return []
+
+        # 一条 UNION ALL 查询检查所有表（一次往返）；失败时回退到逐表探测
+        union_sql = " UNION ALL ".join(
+            f"SELECT %s AS t FROM DUAL WHERE EXISTS (SELECT 1 FROM `{table_name}` WHERE msid = %s)"
+            for table_name in all_allowed_tables
+        )
+        union_params: List[Any] = []
+        for table_name in all_allowed_tables:
+            union_params.extend((table_name, msid_value))
+        try:
+            with db_pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(union_sql, union_params)
+                    return sorted(row["t"] for row in cur.fetchall())
+        except Exception:
+            pass
 
         accessible_tables: List[str] = []
-        conn = pymysql.connect(
-            host=db_host,
-            user=db_user,
-            password=db_password,
-            database=db_name,
-            port=db_port,
-            charset='utf8mb4',
-            cursorclass=pymysql.cursors.DictCursor,
-        )
-        with conn:
+        with db_pool.connection() as conn:
             with conn.cursor() as cur:
                 for table_name in all_allowed_tables:
                     try:
@@ -88,7 +331,7 @@ def create_medical_tools(
         sql: str = Field(description="AI-generated SELECT/restricted SHOW statement. Access scope handled automatically by system.")
 
     def medical_query_impl(sql: str) -> Dict[str, Any]:
-        session_id = current_session_id_ctx.get()
+        session_id = get_current_session_id()
         ctx = session_contexts.get(session_id) or {}
         msid_value = ctx.get("msid")
         if msid_value is None:
@@ -96,7 +339,7 @@ def create_medical_tools(
 
         # 直接使用 AI 生成的 SQL，智能追加访问限制（不再调用 LLM 重写）
         sql_stripped = str(sql or "").strip()
-        sql_norm = re.sub(r"\s+", " ", sql_stripped).lower()
+        sql_norm = _WS_RE.sub(" ", sql_stripped).lower()
 
         if sql_norm.startswith("show tables"):
             tables_with_scope = _list_tables_with_current_msid()
@@ -109,12 +352,10 @@ def create_medical_tools(
         ):
             raise ValueError("Only SELECT and SHOW COLUMNS/DESCRIBE statements are allowed")
 
-        allowed_tables = _fetch_allowed_tables()
-        allowed_lookup = {t.lower() for t in allowed_tables}
+        allowed_tables, allowed_lookup = _load_allowed_tables()
 
         if sql_norm.startswith("show columns from ") or sql_norm.startswith("describe "):
-            pattern = re.compile(r"(?:show columns from|describe)\s+([`\w\.]+)", re.IGNORECASE)
-            match = pattern.search(sql_stripped)
+            match = _DESCRIBE_RE.search(sql_stripped)
             table_name = ""
             if match:
                 table_name = match.group(1).strip('`')
@@ -125,31 +366,31 @@ def create_medical_tools(
             if matching_table is None:
                 raise ValueError("Table is not accessible or does not exist")
             table = matching_table
-            conn = pymysql.connect(
-                host=db_host,
-                user=db_user,
-                password=db_password,
-                database=db_name,
-                port=db_port,
-                charset='utf8mb4',
-                cursorclass=pymysql.cursors.DictCursor,
-            )
-            with conn:
+            with db_pool.connection() as conn:
                 with conn.cursor() as cur:
                     cur.execute(f"DESCRIBE `{table}`")
-                    rows = [r for r in cur.fetchall() if str(r.get('Field', '')).lower() != 'msid']
+                    rows = [r for r in cur if str(r.get('Field', '')).lower() != 'msid']
             return {"ok": True, "rows": rows}
 
         try:
-            parsed_query = parse_one(sql_stripped, read="mysql")
+            # 取缓存 AST 的副本：后续注入访问限制会原地修改语法树
+            parsed_query = _parse_sql_cached(sql_stripped).copy()
         except ParseError as exc:
             raise ValueError(f"Invalid SQL syntax: {exc}") from exc
 
+        # 单次遍历语法树：同时收集引用的表、SELECT 节点，并判断是否含易变函数
         referenced_tables = set()
-        for table_expr in parsed_query.find_all(exp.Table):
-            table_name = (table_expr.name or "").strip()
-            if table_name:
-                referenced_tables.add(table_name)
+        select_nodes: List[exp.Select] = []
+        is_volatile = False
+        for node in parsed_query.walk():
+            if isinstance(node, exp.Table):
+                table_name = (node.name or "").strip()
+                if table_name:
+                    referenced_tables.add(table_name)
+            elif isinstance(node, exp.Select):
+                select_nodes.append(node)
+            elif isinstance(node, exp.Func) and not is_volatile:
+                is_volatile = _is_volatile_func(node)
         if referenced_tables and any((name.lower() not in allowed_lookup) for name in referenced_tables):
             raise ValueError("Only supported tables can be accessed")
 
@@ -213,43 +454,35 @@ def create_medical_tools(
             else:
                 select_node.set("where", exp.Where(this=combined_condition))
 
-        for select_expr in parsed_query.find_all(exp.Select):
+        for select_expr in select_nodes:
             _inject_scope_conditions(select_expr)
 
         sql_final = parsed_query.sql(dialect="mysql")
 
-        conn = pymysql.connect(
-            host=db_host,
-            user=db_user,
-            password=db_password,
-            database=db_name,
-            port=db_port,
-            charset='utf8mb4',
-            cursorclass=pymysql.cursors.DictCursor,
-        )
-        with conn:
-            with conn.cursor() as cur:
+        # 由 AST 重新生成的 SQL 已规范化空白与关键字大小写，写法不同的同一查询命中同一条缓存
+        cache_key = None if is_volatile else (msid_value, sql_final, tuple(parameters))
+        if cache_key is not None:
+            with query_result_lock:
+                cached_rows = query_result_cache.get(cache_key)
+            if cached_rows is not None:
+                return {"ok": True, "rows": [dict(row) for row in cached_rows]}
+
+        # 服务端游标逐行读取，读取时即去掉 msid 列，不再先整体 fetchall 再逐行删除
+        with db_pool.connection() as conn:
+            with conn.cursor(pymysql.cursors.SSDictCursor) as cur:
                 cur.execute(sql_final, parameters)
-                rows = cur.fetchall()
+                rows = [{k: v for k, v in row.items() if k != 'msid'} for row in cur]
 
-        for row in rows:
-            if 'msid' in row:
-                del row['msid']
+        if cache_key is not None:
+            with query_result_lock:
+                query_result_cache[cache_key] = [dict(row) for row in rows]
         return {"ok": True, "rows": rows}
 
     def show_tables_tool_impl() -> Dict[str, Any]:
         tables_with_scope = _list_tables_with_current_msid()
         
-        # 加载表描述
-        descriptions_path = Path(__file__).parent / "table_descriptions.json"
-        table_descriptions = {}
-        if descriptions_path.exists():
-            try:
-                with open(descriptions_path, 'r', encoding='utf-8') as f:
-                    table_descriptions = json.load(f)
-            except Exception:
-                # 如果加载失败，使用空字典
-                table_descriptions = {}
+        # 加载表描述（进程内缓存，文件变更后自动重新加载）
+        table_descriptions = _load_table_descriptions()
         
         # 构建带描述的表列表
         tables_with_descriptions = [
@@ -271,348 +504,272 @@ def create_medical_tools(
         if table not in allowed:
             raise ValueError("Table is not accessible or does not exist")
 
-        session_id = current_session_id_ctx.get()
+        session_id = get_current_session_id()
         ctx_local = session_contexts.get(session_id) or {}
         effective_scope = ctx_local.get("msid")
         if effective_scope is None:
             raise ValueError("Missing access scope")
 
-        conn = pymysql.connect(
-            host=db_host,
-            user=db_user,
-            password=db_password,
-            database=db_name,
-            port=db_port,
-            charset='utf8mb4',
-            cursorclass=pymysql.cursors.DictCursor,
-        )
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(f"DESCRIBE `{table}`")
-                schema_rows = [r for r in cur.fetchall() if str(r.get('Field', '')).lower() != 'msid']
-
-        conn = pymysql.connect(
-            host=db_host,
-            user=db_user,
-            password=db_password,
-            database=db_name,
-            port=db_port,
-            charset='utf8mb4',
-            cursorclass=pymysql.cursors.DictCursor,
-        )
-        with conn:
+        schema_key = (db_name, table)
+        sample_key = (db_name, effective_scope, table)
+        with _tool_cache_lock:
+            cached_schema = _table_schema_cache.get(schema_key)
+            cached_samples = _sample_rows_cache.get(sample_key)
+        if cached_schema is not None:
+            schema_rows = [dict(row) for row in cached_schema]
+        else:
+            with db_pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(f"DESCRIBE `{table}`")
+                    schema_rows = [r for r in cur if str(r.get('Field', '')).lower() != 'msid']
+            with _tool_cache_lock:
+                _table_schema_cache[schema_key] = tuple(dict(row) for row in schema_rows)
+        if cached_samples is not None:
+            return {"ok": True, "table": table, "schema": schema_rows,
+                    "sample_rows": [dict(row) for row in cached_samples]}
+
+        # 按行数估算抽样比例，RAND() < 比例 LIMIT N 边扫边取，避免 ORDER BY RAND() 的全量排序；
+        # 命中不足（或数据量本就很小）时回退到 ORDER BY RAND()
+        count_key = (effective_scope, table)
+        with sample_count_lock:
+            row_count = sample_count_cache.get(count_key)
+        with db_pool.connection() as conn:
             with conn.cursor() as cur:
-                cur.execute(f"SELECT * FROM `{table}` WHERE msid = %s ORDER BY RAND() LIMIT 4", (effective_scope,))
-                sample_rows = cur.fetchall()
-        for row in sample_rows:
-            if 'msid' in row:
-                del row['msid']
+                if row_count is None:
+                    cur.execute(f"SELECT COUNT(*) AS n FROM `{table}` WHERE msid = %s", (effective_scope,))
+                    row_count = int((cur.fetchone() or {}).get("n") or 0)
+                    with sample_count_lock:
+                        sample_count_cache[count_key] = row_count
+                fraction = min(1.0, _SAMPLE_TARGET_HITS / max(row_count, 1))
+                sample_rows: List[Dict[str, Any]] = []
+                if fraction < 1.0:
+                    cur.execute(
+                        f"SELECT * FROM `{table}` WHERE msid = %s AND RAND() < %s ORDER BY NULL LIMIT {_SAMPLE_ROWS}",
+                        (effective_scope, fraction),
+                    )
+                    sample_rows = [{k: v for k, v in row.items() if k != 'msid'} for row in cur]
+                if len(sample_rows) < _SAMPLE_ROWS:
+                    cur.execute(
+                        f"SELECT * FROM `{table}` WHERE msid = %s ORDER BY RAND() LIMIT {_SAMPLE_ROWS}",
+                        (effective_scope,),
+                    )
+                    sample_rows = [{k: v for k, v in row.items() if k != 'msid'} for row in cur]
 
+        with _tool_cache_lock:
+            _sample_rows_cache[sample_key] = tuple(dict(row) for row in sample_rows)
         return {"ok": True, "table": table, "schema": schema_rows, "sample_rows": sample_rows}
 
     # patient_info_by_id 工具已移除（通过 medical_query 可直接查询按 ID 的数据）
 
     def patient_count_stats_impl() -> Dict[str, Any]:
         """Summarize patient counts and distributions under current msid."""
-        session_id = current_session_id_ctx.get()
+        session_id = get_current_session_id()
         ctx = session_contexts.get(session_id) or {}
         scope_value = ctx.get("msid")
         if scope_value is None:
             raise ValueError("Missing access scope, query denied.")
 
-        conn = pymysql.connect(
-            host=db_host,
-            user=db_user,
-            password=db_password,
-            database=db_name,
-            port=db_port,
-            charset='utf8mb4',
-            cursorclass=pymysql.cursors.DictCursor,
-        )
-        
+        stats_key = (db_name, scope_value)
+        with _patient_stats_lock:
+            cached_stats = _patient_stats_cache.get(stats_key)
+        if cached_stats is not None:
+            return copy.deepcopy(cached_stats)
+
+        # 一次查询完成全部统计（总人数、各维度分布、年龄统计），结果按 dim 分拣
+        dims = _PATIENT_STAT_DIMENSIONS
         try:
-            with conn:
+            with db_pool.connection() as conn:
                 with conn.cursor() as cur:
-                    # 1. 统计总病人数
-                    cur.execute(
-                        "SELECT COUNT(DISTINCT usubjid) as total_patients FROM patient_adsl WHERE msid = %s",
-                        (scope_value,)
-                    )
-                    total_result = cur.fetchone()
-                    total_patients = total_result['total_patients'] if total_result else 0
-                    
-                    # 2. 性别分布统计
-                    cur.execute(
-                        "SELECT sex, COUNT(DISTINCT usubjid) as count FROM patient_adsl WHERE msid = %s AND sex IS NOT NULL GROUP BY sex ORDER BY count DESC",
-                        (scope_value,)
-                    )
-                    sex_distribution = cur.fetchall()
-                    
-                    # 3. 年龄组分布统计
-                    cur.execute(
-                        "SELECT agegr1 as age_group, COUNT(DISTINCT usubjid) as count FROM patient_adsl WHERE msid = %s AND agegr1 IS NOT NULL GROUP BY agegr1 ORDER BY count DESC",
-                        (scope_value,)
-                    )
-                    age_distribution = cur.fetchall()
-                    
-                    # 4. 治疗组分布统计
-                    cur.execute(
-                        "SELECT trt01p as treatment, COUNT(DISTINCT usubjid) as count FROM patient_adsl WHERE msid = %s AND trt01p IS NOT NULL GROUP BY trt01p ORDER BY count DESC",
-                        (scope_value,)
-                    )
-                    treatment_distribution = cur.fetchall()
-                    
-                    # 5. 种族分布统计
-                    cur.execute(
-                        "SELECT race, COUNT(DISTINCT usubjid) as count FROM patient_adsl WHERE msid = %s AND race IS NOT NULL GROUP BY race ORDER BY count DESC",
-                        (scope_value,)
-                    )
-                    race_distribution = cur.fetchall()
-                    
-                    # 6. 研究状态统计
-                    cur.execute(
-                        "SELECT eosstt as study_status, COUNT(DISTINCT usubjid) as count FROM patient_adsl WHERE msid = %s AND eosstt IS NOT NULL GROUP BY eosstt ORDER BY count DESC",
-                        (scope_value,)
-                    )
-                    status_distribution = cur.fetchall()
-                    
-                    # 7. BMI分组统计
-                    cur.execute(
-                        "SELECT bmiblgr1 as bmi_group, COUNT(DISTINCT usubjid) as count FROM patient_adsl WHERE msid = %s AND bmiblgr1 IS NOT NULL GROUP BY bmiblgr1 ORDER BY count DESC",
-                        (scope_value,)
-                    )
-                    bmi_distribution = cur.fetchall()
-                    
-                    # 8. 研究中心分布统计
-                    cur.execute(
-                        "SELECT siteid as site_id, COUNT(DISTINCT usubjid) as count FROM patient_adsl WHERE msid = %s AND siteid IS NOT NULL GROUP BY siteid ORDER BY count DESC",
-                        (scope_value,)
-                    )
-                    site_distribution = cur.fetchall()
-                    
-                    # 9. 停药原因分布统计
-                    cur.execute(
-                        "SELECT dcsreas as discontinuation_reason, COUNT(DISTINCT usubjid) as count FROM patient_adsl WHERE msid = %s AND dcsreas IS NOT NULL GROUP BY dcsreas ORDER BY count DESC",
-                        (scope_value,)
-                    )
-                    discontinuation_distribution = cur.fetchall()
-                    
-                    # 10. 地区分层因子统计（美国 vs 世界其他地区）
-                    cur.execute(
-                        "SELECT strat1g as region, COUNT(DISTINCT usubjid) as count FROM patient_adsl WHERE msid = %s AND strat1g IS NOT NULL GROUP BY strat1g ORDER BY count DESC",
-                        (scope_value,)
-                    )
-                    region_distribution = cur.fetchall()
-                    
-                    # 11. ECOG评分基线统计
-                    cur.execute(
-                        "SELECT ecogbl as ecog_score, COUNT(DISTINCT usubjid) as count FROM patient_adsl WHERE msid = %s AND ecogbl IS NOT NULL GROUP BY ecogbl ORDER BY count DESC",
-                        (scope_value,)
-                    )
-                    ecog_distribution = cur.fetchall()
-                    
-                    # 12. 基本年龄统计
-                    cur.execute(
-                        "SELECT AVG(age) as avg_age, MIN(age) as min_age, MAX(age) as max_age FROM patient_adsl WHERE msid = %s AND age IS NOT NULL",
-                        (scope_value,)
-                    )
-                    age_stats = cur.fetchone()
-                    
+                    cur.execute(_PATIENT_STATS_SQL, (scope_value,))
+                    rows = cur.fetchall()
         except Exception as e:
             raise ValueError(f"查询病人统计信息时出错: {str(e)}")
-        
-        return {
+
+        total_patients = 0
+        age_stats = None
+        distributions: List[List[Dict[str, Any]]] = [[] for _ in dims]
+        for row in rows:
+            dim = int(row["dim"])
+            if dim < 0:
+                total_patients = row["cnt"] or 0
+                age_stats = row
+                continue
+            alias = dims[dim][2]
+            distributions[dim].append({alias: row[f"v{dim}"], "count": row["cnt"]})
+        for bucket in distributions:
+            bucket.sort(key=lambda item: item["count"], reverse=True)
+
+        statistics: Dict[str, Any] = {key: distributions[idx] for idx, (key, _, _) in enumerate(dims)}
+        statistics["age_stats"] = {
+            "average_age": round(float(age_stats['avg_age']), 1) if age_stats and age_stats['avg_age'] else None,
+            "min_age": age_stats['min_age'] if age_stats else None,
+            "max_age": age_stats['max_age'] if age_stats else None
+        }
+        result = {
             "ok": True,
             "total_patients": total_patients,
-            "statistics": {
-                "sex_distribution": list(sex_distribution) if sex_distribution else [],
-                "age_group_distribution": list(age_distribution) if age_distribution else [],
-                "treatment_distribution": list(treatment_distribution) if treatment_distribution else [],
-                "race_distribution": list(race_distribution) if race_distribution else [],
-                "study_status_distribution": list(status_distribution) if status_distribution else [],
-                "bmi_distribution": list(bmi_distribution) if bmi_distribution else [],
-                "site_distribution": list(site_distribution) if site_distribution else [],
-                "discontinuation_distribution": list(discontinuation_distribution) if discontinuation_distribution else [],
-                "region_distribution": list(region_distribution) if region_distribution else [],
-                "ecog_distribution": list(ecog_distribution) if ecog_distribution else [],
-                "age_stats": {
-                    "average_age": round(float(age_stats['avg_age']), 1) if age_stats and age_stats['avg_age'] else None,
-                    "min_age": age_stats['min_age'] if age_stats else None,
-                    "max_age": age_stats['max_age'] if age_stats else None
-                }
-            }
+            "statistics": statistics,
         }
+        with _patient_stats_lock:
+            _patient_stats_cache[stats_key] = copy.deepcopy(result)
+        return result
 
 
     class AdverseEventAnalysisArgs(BaseModel):
         ae_name: str = Field(description="Adverse event name to analyze (supports fuzzy match)")
-        days_before: int = Field(default=3, description="Days window before AE onset to check medications (default 3)")
+        days_before: int = Field(default=3, ge=1, le=_AE_MAX_DAYS_BEFORE, description="Days window before AE onset to check medications (default 3, max 365)")
 
     def adverse_event_analysis_impl(ae_name: str, days_before: int = 3) -> Dict[str, Any]:
         """Analyze association between a specific adverse event and medications within given days before onset."""
-        session_id = current_session_id_ctx.get()
+        session_id = get_current_session_id()
         ctx = session_contexts.get(session_id) or {}
         scope_value = ctx.get("msid")
         if scope_value is None:
             raise ValueError("Missing access scope, query denied.")
 
-        conn = pymysql.connect(
-            host=db_host,
-            user=db_user,
-            password=db_password,
-            database=db_name,
-            port=db_port,
-            charset='utf8mb4',
-            cursorclass=pymysql.cursors.DictCursor,
-        )
+        # 直接调用（绕过参数校验）时同样限制窗口，避免生成超长的天偏移 UNION ALL
+        days_before = min(int(days_before), _AE_MAX_DAYS_BEFORE)
         
         try:
-            with conn:
+            # 已执行 sql/patient_date_columns.sql 时全部查询直接使用 DATE 生成列（可走索引），
+            # 否则回退到查询时 STR_TO_DATE；在借用连接前检测，避免持有连接时再借第二个
+            if _date_columns_ready():
+                ae_date_expr = "aestdtc_d"
+                ae_present_cond = "aestdtc_d IS NOT NULL"
+                ae_order_expr = "aestdtc_d"
+                date_exprs = (
+                    ("m.cmstdtc_d", "m.cmendtc_d"),
+                    ("m.exstdtc_d", "m.exendtc_d"),
+                )
+            else:
+                ae_date_expr = "STR_TO_DATE(aestdtc, '%%Y-%%m-%%d')"
+                ae_present_cond = "aestdtc IS NOT NULL"
+                ae_order_expr = "aestdtc"
+                date_exprs = (
+                    ("STR_TO_DATE(m.cmstdtc, '%%Y-%%m-%%d')", "STR_TO_DATE(m.cmendtc, '%%Y-%%m-%%d')"),
+                    (
+                        "STR_TO_DATE(SUBSTR(m.exstdtc, 1, 10), '%%Y-%%m-%%d')",
+                        "STR_TO_DATE(SUBSTR(m.exendtc, 1, 10), '%%Y-%%m-%%d')",
+                    ),
+                )
+
+            with db_pool.connection() as conn:
                 with conn.cursor() as cur:
                     # 1. 获取指定不良事件列表（支持模糊匹配）
                     cur.execute(
-                        """
+                        f"""
                         SELECT 
                             usubjid, aeterm, aedecod, aestdtc, aerel, aesev, aeout,
-                            STR_TO_DATE(aestdtc, '%%Y-%%m-%%d') as ae_date
+                            {ae_date_expr} as ae_date
                         FROM patient_ae 
-                        WHERE msid = %s AND aestdtc IS NOT NULL 
+                        WHERE msid = %s AND {ae_present_cond} 
                         AND (aeterm LIKE %s OR aedecod LIKE %s)
-                        ORDER BY aestdtc DESC
+                        ORDER BY {ae_order_expr} DESC
                         """,
                         (scope_value, f'%{ae_name}%', f'%{ae_name}%')
                     )
                     adverse_events = cur.fetchall()
-                    
-                    if not adverse_events:
-                        return {
-                            "ok": True,
-                            "analysis_params": {"ae_name": ae_name, "days_before": days_before},
-                            "events": 0,
-                            "patients": 0,
-                            "medication_counts": []
-                        }
-                    
-                    # 按天粒度统计药物频次（day_offset: 1..days_before）
-                    daily_counters: Dict[int, Dict[str, int]] = {d: {} for d in range(1, days_before + 1)}
-                    distinct_patients = set()
-
-                    def _parse_date_str(val):
-                        if not val:
-                            return None
-                        try:
-                            return datetime.strptime(str(val)[:10], '%Y-%m-%d').date()
-                        except Exception:
-                            return None
-
-                    def _to_date(obj):
-                        if isinstance(obj, datetime):
-                            return obj.date()
-                        if isinstance(obj, date):
-                            return obj
-                        return _parse_date_str(obj)
-                    
-                    for ae in adverse_events:
-                        usubjid = ae['usubjid']
-                        ae_date = ae['ae_date']
-                        ae_term = ae['aeterm']
-                        ae_decoded = ae['aedecod']
-                        
-                        if ae_date is None:
-                            continue
-                        distinct_patients.add(usubjid)
-                            
-                        # 计算查找用药的开始日期（不良事件前N天）
-                        search_start_date = ae_date - timedelta(days=days_before)
-                        
-                        # 2. 查找该患者在不良事件前N天内的合并用药
-                        cur.execute(
-                            """
-                            SELECT 
-                                cmtrt as medication_name,
-                                cmdecod as medication_decoded,
-                                cmstdtc as start_date,
-                                cmendtc as end_date,
-                                cmindc as indication,
-                                'Concomitant' as medication_type
-                            FROM patient_cm 
-                            WHERE msid = %s AND usubjid = %s 
-                            AND cmstdtc IS NOT NULL
-                            AND (
-                                (STR_TO_DATE(cmstdtc, '%%Y-%%m-%%d') <= %s AND 
-                                 (cmendtc IS NULL OR STR_TO_DATE(cmendtc, '%%Y-%%m-%%d') >= %s))
-                                OR
-                                (STR_TO_DATE(cmstdtc, '%%Y-%%m-%%d') BETWEEN %s AND %s)
-                            )
-                            """,
-                            (scope_value, usubjid, ae_date, search_start_date, search_start_date, ae_date)
-                        )
-                        concomitant_meds = cur.fetchall()
-                        
-                        # 3. 查找该患者在不良事件前N天内的试验药物
-                        cur.execute(
-                            """
-                            SELECT 
-                                extrt as medication_name,
-                                extrt as medication_decoded,
-                                exstdtc as start_date,
-                                exendtc as end_date,
-                                'N/A' as indication,
-                                'StudyDrug' as medication_type
-                            FROM patient_ex 
-                            WHERE msid = %s AND usubjid = %s 
-                            AND exstdtc IS NOT NULL
+
+            if not adverse_events:
+                return {
+                    "ok": True,
+                    "analysis_params": {"ae_name": ae_name, "days_before": days_before},
+                    "events": 0,
+                    "patients": 0,
+                    "medication_counts": []
+                }
+            
+            # 按天粒度统计药物频次（day_offset: 1..days_before）
+            daily_counters: Dict[int, Dict[str, int]] = {d: {} for d in range(1, days_before + 1)}
+            distinct_patients = set()
+            for ae in adverse_events:
+                if ae['ae_date'] is not None:
+                    distinct_patients.add(ae['usubjid'])
+
+            # 2/3. 合并用药与试验药物各用一条查询：将上面的不良事件集合作为派生表与用药表连接，
+            # 再与窗口内的天偏移（1..N）连接，在 SQL 中判断用药是否覆盖事件前第 d 天
+            # （开始日期 <= 该天 <= 结束日期，无结束日期时以事件日期为准），按 (药物, 天偏移) 分组计数
+            if daily_counters:
+                day_offsets = " UNION ALL ".join(
+                    f"SELECT {int(d)} AS day_offset" for d in range(1, days_before + 1)
+                )
+                ae_filter_params = (scope_value, f'%{ae_name}%', f'%{ae_name}%')
+                window_params = (days_before, days_before)
+                medication_queries = []
+                for (med_table, name_expr, start_col, end_col), (start_expr, end_expr) in zip((
+                    ("patient_cm", "COALESCE(NULLIF(m.cmdecod, ''), m.cmtrt)", "m.cmstdtc", "m.cmendtc"),
+                    ("patient_ex", "m.extrt", "m.exstdtc", "m.exendtc"),
+                ), date_exprs):
+                    medication_queries.append((
+                        f"""
+                        SELECT 
+                            {name_expr} as medication_name,
+                            d.day_offset,
+                            COUNT(*) as cnt
+                        FROM (
+                            SELECT usubjid, {ae_date_expr} as ae_date
+                            FROM patient_ae 
+                            WHERE msid = %s AND {ae_present_cond} 
+                            AND (aeterm LIKE %s OR aedecod LIKE %s)
+                        ) ae
+                        JOIN {med_table} m
+                            ON m.msid = %s AND m.usubjid = ae.usubjid
+                            AND {start_col} IS NOT NULL
                             AND (
-                                (STR_TO_DATE(SUBSTR(exstdtc, 1, 10), '%%Y-%%m-%%d') <= %s AND 
-                                 (exendtc IS NULL OR STR_TO_DATE(SUBSTR(exendtc, 1, 10), '%%Y-%%m-%%d') >= %s))
+                                ({start_expr} <= ae.ae_date AND 
+                                 ({end_col} IS NULL OR {end_expr} >= DATE_SUB(ae.ae_date, INTERVAL %s DAY)))
                                 OR
-                                (STR_TO_DATE(SUBSTR(exstdtc, 1, 10), '%%Y-%%m-%%d') BETWEEN %s AND %s)
+                                ({start_expr} BETWEEN DATE_SUB(ae.ae_date, INTERVAL %s DAY) AND ae.ae_date)
                             )
-                            """,
-                            (scope_value, usubjid, ae_date, search_start_date, search_start_date, ae_date)
-                        )
-                        study_meds = cur.fetchall()
-                        
-                        # 合并所有用药记录并统计药物频次（按天）
-                        for med in list(concomitant_meds) + list(study_meds):
-                            med_name = med['medication_decoded'] or med['medication_name']
-                            med_start = _parse_date_str(med.get('start_date'))
-                            base_date = _to_date(ae_date)
-                            med_end = _parse_date_str(med.get('end_date')) or base_date
-
-                            # 针对窗口内每一天做覆盖判断
-                            for d in range(1, days_before + 1):
-                                day_date = base_date - timedelta(days=d)
-                                if med_start and med_start <= day_date <= med_end:
-                                    day_map = daily_counters[d]
-                                    day_map[med_name] = day_map.get(med_name, 0) + 1
-                        
-                    
-                    # 4. 生成药物统计摘要
-                    # 将每日统计整理为排序后的列表
-                    daily_medication_counts = []
-                    for d in range(1, days_before + 1):
-                        items = [
-                            {"medication_name": name, "count": cnt}
-                            for name, cnt in daily_counters[d].items()
-                        ]
-                        items.sort(key=lambda x: x["count"], reverse=True)
-                        daily_medication_counts.append({
-                            "day_offset": d,
-                            "medications": items
-                        })
-                    
-                    return {
-                        "ok": True,
-                        "analysis_params": {
-                            "ae_name": ae_name,
-                            "days_before": days_before
-                        },
-                        "events": len(adverse_events),
-                        "patients": len(distinct_patients),
-                        "daily_medication_counts": daily_medication_counts
-                    }
-                    
+                        JOIN ({day_offsets}) d
+                            ON DATE_SUB(ae.ae_date, INTERVAL d.day_offset DAY)
+                               BETWEEN {start_expr} AND COALESCE({end_expr}, ae.ae_date)
+                        GROUP BY medication_name, d.day_offset
+                        """,
+                        ae_filter_params + (scope_value,) + window_params
+                    ))
+
+                def _fetch_medication_counts(query) -> List[Dict[str, Any]]:
+                    with db_pool.connection() as med_conn:
+                        with med_conn.cursor() as med_cur:
+                            med_cur.execute(*query)
+                            return med_cur.fetchall()
+
+                # 不良事件查询的连接已归还；两条查询各自借用独立连接并发执行，
+                # 任何一方都不会在持有连接的同时等待另一连接（连接池很小时也不会互相阻塞）
+                cm_future = _get_medication_executor().submit(_fetch_medication_counts, medication_queries[0])
+                ex_rows = _fetch_medication_counts(medication_queries[1])
+                for rows in (cm_future.result(), ex_rows):
+                    for row in rows:
+                        day_map = daily_counters[int(row['day_offset'])]
+                        med_name = row['medication_name']
+                        day_map[med_name] = day_map.get(med_name, 0) + int(row['cnt'])
+
+            # 4. 生成药物统计摘要
+            # 将每日统计整理为排序后的列表
+            daily_medication_counts = []
+            for d in range(1, days_before + 1):
+                items = [
+                    {"medication_name": name, "count": cnt}
+                    for name, cnt in daily_counters[d].items()
+                ]
+                items.sort(key=lambda x: x["count"], reverse=True)
+                daily_medication_counts.append({
+                    "day_offset": d,
+                    "medications": items
+                })
+            
+            return {
+                "ok": True,
+                "analysis_params": {
+                    "ae_name": ae_name,
+                    "days_before": days_before
+                },
+                "events": len(adverse_events),
+                "patients": len(distinct_patients),
+                "daily_medication_counts": daily_medication_counts
+            }
+            
         except Exception as e:
             raise ValueError(f"分析不良反应与用药关联时出错: {str(e)}")
 
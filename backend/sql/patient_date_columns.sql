@@ -0,0 +1,31 @@
+-- 医疗数据库（MySQL 8.0+）一次性迁移：为不良事件/用药日期增加 DATE 生成列与复合索引
+--
+-- adverse_event_analysis 检测到以下生成列齐全时，直接按 (msid, usubjid, 日期) 索引范围查找，
+-- 不再在查询时对每行执行 STR_TO_DATE；未执行本迁移时工具自动回退到 STR_TO_DATE 写法。
+--
+-- 只解析以 YYYY-MM-DD 开头的值（SDTM 中常见的部分日期如 '2020-01' 得到 NULL），
+-- 避免严格模式下无效日期导致 ALTER/INSERT 失败。
+
+ALTER TABLE patient_ae
+    ADD COLUMN aestdtc_d DATE AS (
+        IF(aestdtc REGEXP '^[0-9]{4}-[0-9]{2}-[0-9]{2}', STR_TO_DATE(SUBSTR(aestdtc, 1, 10), '%Y-%m-%d'), NULL)
+    ) STORED,
+    ADD INDEX idx_patient_ae_msid_usubjid_aestdtc_d (msid, usubjid, aestdtc_d);
+
+ALTER TABLE patient_cm
+    ADD COLUMN cmstdtc_d DATE AS (
+        IF(cmstdtc REGEXP '^[0-9]{4}-[0-9]{2}-[0-9]{2}', STR_TO_DATE(SUBSTR(cmstdtc, 1, 10), '%Y-%m-%d'), NULL)
+    ) STORED,
+    ADD COLUMN cmendtc_d DATE AS (
+        IF(cmendtc REGEXP '^[0-9]{4}-[0-9]{2}-[0-9]{2}', STR_TO_DATE(SUBSTR(cmendtc, 1, 10), '%Y-%m-%d'), NULL)
+    ) STORED,
+    ADD INDEX idx_patient_cm_msid_usubjid_cmstdtc_d (msid, usubjid, cmstdtc_d);
+
+ALTER TABLE patient_ex
+    ADD COLUMN exstdtc_d DATE AS (
+        IF(exstdtc REGEXP '^[0-9]{4}-[0-9]{2}-[0-9]{2}', STR_TO_DATE(SUBSTR(exstdtc, 1, 10), '%Y-%m-%d'), NULL)
+    ) STORED,
+    ADD COLUMN exendtc_d DATE AS (
+        IF(exendtc REGEXP '^[0-9]{4}-[0-9]{2}-[0-9]{2}', STR_TO_DATE(SUBSTR(exendtc, 1, 10), '%Y-%m-%d'), NULL)
+    ) STORED,
+    ADD INDEX idx_patient_ex_msid_usubjid_exstdtc_d (msid, usubjid, exstdtc_d);